@@ -0,0 +1,53 @@
+#!/usr/bin/python
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Benchmark serial versus slab-parallel bin_reduce.
+
+Usage: bench_bin_reduce.py [D,H,W,C [worker counts...]]
+
+Reduces a synthetic uint16 ZYXC volume (default 64,1024,1024,2) with
+typical view_reduction factors and reports wall time and speedup of
+each worker count against the serial whole-array reduction.
+
+"""
+
+import sys
+import time
+import multiprocessing
+import numpy as np
+
+from volspy.util import bin_reduce
+
+def timed(func, *args, **kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - t0, result
+
+def main(argv):
+    if len(argv) > 1:
+        shape = tuple(map(int, argv[1].split(',')))
+    else:
+        shape = (64, 1024, 1024, 2)
+
+    if len(argv) > 2:
+        worker_counts = list(map(int, argv[2:]))
+    else:
+        ncpu = multiprocessing.cpu_count()
+        worker_counts = [ n for n in (1, 2, 4, 8, 16, 32) if n <= ncpu ]
+
+    data = np.random.randint(0, 2**12, size=shape).astype(np.uint16)
+    print('input %s %s, %.1f MiB' % (shape, data.dtype, data.nbytes / 2.**20))
+
+    for factors in [ (1, 4, 4, 1), (2, 2, 2, 1) ]:
+        t_serial, expected = timed(bin_reduce, data, factors, streaming=False, workers=1)
+        print('%s serial: %.3fs' % (factors, t_serial))
+        for workers in worker_counts:
+            t, result = timed(bin_reduce, data, factors, streaming=True, workers=workers)
+            assert np.array_equal(result, expected), 'parallel result differs from serial result'
+            print('%s %2d workers: %.3fs speedup %.2fx' % (factors, workers, t, t_serial / t))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
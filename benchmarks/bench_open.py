@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Benchmark startup time on large synthetic OME-TIFF files.
+
+Usage: bench_open.py [pages [height,width [filename]]]
+
+Writes a synthetic 2-channel uint16 OME-TIFF with the given number of
+pages (default 10000 of 256x256) unless filename already exists, then
+reports time to parse every IFD with tifffile, time to open a
+TiffLazyNDArray, and time-to-first-texture: loading via ImageManager
+with bin_reduce to the default view grid and packing normalized texture
+data ready for upload.  Finally, it reports the time to reopen the
+file from its index sidecar and read one page, which should not grow
+with the number of pages.
+
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import tifffile
+
+from volspy.util import TiffLazyNDArray, bin_reduce, pack_texture3d
+from volspy.data import ImageManager
+
+ome_template = """<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">
+<Image ID="Image:0" Name="synthetic">
+<Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="uint16"
+ SizeX="%(W)d" SizeY="%(H)d" SizeC="2" SizeZ="%(D)d" SizeT="1"
+ PhysicalSizeX="0.125" PhysicalSizeY="0.125" PhysicalSizeZ="0.25">
+<TiffData PlaneCount="%(pages)d"/>
+</Pixels>
+</Image>
+</OME>
+"""
+
+def write_synthetic(fname, pages, H, W):
+    D = pages // 2
+    data = np.random.randint(0, 2**12, size=(D, 2, H, W)).astype(np.uint16)
+    tifffile.imsave(fname, data, description=ome_template % dict(D=D, H=H, W=W, pages=D*2), metadata=None)
+
+def timed(label, func, *args):
+    t0 = time.time()
+    result = func(*args)
+    print('%s: %.3fs' % (label, time.time() - t0))
+    return result
+
+def first_texture(fname):
+    vol = ImageManager(fname, lambda I, meta, r: bin_reduce(I, r + (1,)))
+    I0 = vol.data
+    tmpout = np.empty(I0.shape[0:3] + (len(vol.channels),), dtype=np.uint16)
+    stats = vol.get_stats()
+    minval, maxval = float(stats.min.min()), float(stats.max.max())
+    scale = (2.0**16-1) / (maxval - minval)
+    return pack_texture3d(I0, vol.channels, tmpout, minval, scale)
+
+def reopen(fname):
+    data = TiffLazyNDArray(fname)
+    return data[(-1,) * data.stack_ndim + (slice(None), slice(None))]
+
+def main(argv):
+    pages = len(argv) > 1 and int(argv[1]) or 10000
+    H, W = len(argv) > 2 and tuple(map(int, argv[2].split(','))) or (256, 256)
+    fname = len(argv) > 3 and argv[3] or 'bench_open_%d_%dx%d.ome.tif' % (pages, H, W)
+
+    if not os.path.exists(fname):
+        timed('write %s' % fname, write_synthetic, fname, pages, H, W)
+
+    timed('tifffile parse all IFDs', lambda: tifffile.TiffFile(fname).series[0].shape)
+    timed('TiffLazyNDArray open', TiffLazyNDArray, fname)
+    timed('time-to-first-texture', first_texture, fname)
+    timed('TiffLazyNDArray reopen and read last page', reopen, fname)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Benchmark texture packing of normalized channels.
+
+Usage: bench_texture_pack.py [D,H,W,C [repeats]]
+
+Packs a synthetic uint16 ZYXC volume (default 64,1024,1024,4) into an
+interleaved uint16 texture staging buffer, comparing the former
+whole-channel float32 conversion against the slab-wise fused
+pack_texture3d, and reports wall time and peak memory traced by
+tracemalloc beyond the input and output arrays.
+
+"""
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from volspy.util import pack_texture3d
+
+def pack_whole(data, channels, out, minval, scale):
+    for i in range(len(channels)):
+        out[:,:,:,i] = (data[:,:,:,channels[i]].astype(np.float32) - minval) * scale
+    return out
+
+def measure(func, repeats, *args):
+    """Return (best wall time, peak traced bytes) of repeated func(*args)."""
+    best = None
+    peak = 0
+    for r in range(repeats):
+        tracemalloc.start()
+        t0 = time.time()
+        func(*args)
+        elapsed = time.time() - t0
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = best is None and elapsed or min(best, elapsed)
+    return best, peak
+
+def main(argv):
+    if len(argv) > 1:
+        shape = tuple(map(int, argv[1].split(',')))
+    else:
+        shape = (64, 1024, 1024, 4)
+    repeats = len(argv) > 2 and int(argv[2]) or 3
+
+    data = np.random.randint(0, 2**12, size=shape).astype(np.uint16)
+    channels = tuple(range(shape[3]))
+    minval, maxval = float(data.min()), float(data.max())
+    scale = (2.0**16-1) / (maxval - minval)
+    print('packing %s %s (%d MiB) into uint16 texture' % (shape, data.dtype, data.nbytes // 2**20))
+
+    out1 = np.empty(shape[0:3] + (len(channels),), dtype=np.uint16)
+    out2 = np.empty(shape[0:3] + (len(channels),), dtype=np.uint16)
+    t1, m1 = measure(pack_whole, repeats, data, channels, out1, minval, scale)
+    t2, m2 = measure(pack_texture3d, repeats, data, channels, out2, minval, scale)
+    assert (out1 == out2).all()
+
+    print('%-24s %8s %12s' % ('method', 'time', 'peak MiB'))
+    print('%-24s %7.3fs %12.1f' % ('whole-channel float32', t1, m1 / 2.**20))
+    print('%-24s %7.3fs %12.1f' % ('slab-wise fused', t2, m2 / 2.**20))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
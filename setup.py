@@ -11,7 +11,7 @@ setup(
     description="volumetric image visualization using vispy",
     version="0.1-prerelease",
     packages=["volspy"],
-    scripts=["bin/volspy-viewer"],
+    scripts=["bin/volspy-viewer", "bin/volspy-convert"],
     requires=["vispy", "numpy", "tifffile"],
     maintainer_email="support@misd.isi.edu",
     license='(new) BSD',
@@ -0,0 +1,57 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+import tifffile
+
+from volspy import util
+
+def _reference(data, axes_s):
+    """Return float64 bin averages over whole bins, trimming partial bins."""
+    shape = tuple([ n // s for n, s in zip(data.shape, axes_s) ])
+    trimmed = data[tuple([ slice(0, n * s) for n, s in zip(shape, axes_s) ])].astype(np.float64)
+    split = []
+    for n, s in zip(shape, axes_s):
+        split += [ n, s ]
+    return trimmed.reshape(split).mean(axis=tuple(range(1, 2 * len(shape), 2)))
+
+def _data():
+    return np.random.RandomState(0).randint(0, 4000, size=(11, 18, 13, 2)).astype(np.uint16)
+
+def test_bin_reduce_matches_reference():
+    data = _data()
+    for axes_s in [ (2, 2, 2, 1), (3, 4, 1, 1), (1, 1, 5, 2) ]:
+        result = util.bin_reduce(data, axes_s, streaming=False, workers=1)
+        assert result.dtype == np.float32
+        assert np.allclose(result, _reference(data, axes_s), rtol=1e-5)
+
+def test_bin_reduce_streaming_identical():
+    data = _data()
+    for axes_s in [ (2, 2, 2, 1), (3, 4, 1, 1), (1, 1, 5, 2) ]:
+        expected = util.bin_reduce(data, axes_s, streaming=False, workers=1)
+        assert (util.bin_reduce(data, axes_s, streaming=True, workers=1) == expected).all()
+        out = np.zeros(expected.shape, dtype=np.float32)
+        assert util.bin_reduce_streaming(data, axes_s, out=out) is out
+        assert (out == expected).all()
+
+def test_bin_reduce_streaming_lazy_tiff(tmpdir):
+    data = _data()[..., 0]
+    fname = str(tmpdir.join('a.tif'))
+    tifffile.imwrite(fname, data, photometric='minisblack', compression='zlib')
+    view = util.TiffLazyNDArray(fname)
+    expected = util.bin_reduce(data, (2, 3, 2), streaming=False, workers=1)
+    assert (util.bin_reduce(view, (2, 3, 2), workers=1) == expected).all()
+
+def test_bin_reduce_nothing_to_reduce():
+    data = _data()
+    assert util.bin_reduce(data, (1, 1, 1, 1)) is data
+
+def test_bin_reduce_parallel_identical():
+    data = _data()
+    for axes_s in [ (2, 2, 2, 1), (5, 3, 1, 1), (11, 2, 1, 1) ]:
+        expected = util.bin_reduce(data, axes_s, streaming=False, workers=1)
+        for workers in [ 2, 3, 8 ]:
+            assert (util.bin_reduce(data, axes_s, streaming=False, workers=workers) == expected).all()
+            assert (util.bin_reduce_streaming(data, axes_s, workers=workers) == expected).all()
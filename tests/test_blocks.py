@@ -0,0 +1,56 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+import tifffile
+
+from volspy import util
+from volspy.blocks import block_grid, iter_blocks, map_blocks
+
+def box3(a):
+    """Return 3-voxel box filter of a along every axis, with nearest-edge padding."""
+    a = np.asarray(a, dtype=np.float32)
+    for axis in range(a.ndim):
+        if a.shape[axis] < 2:
+            continue
+        p = np.concatenate((a.take([0], axis), a, a.take([-1], axis)), axis)
+        n = a.shape[axis]
+        a = (p.take(range(0, n), axis) + p.take(range(1, n + 1), axis) + p.take(range(2, n + 2), axis)) / 3
+    return a
+
+def _data():
+    return np.random.RandomState(0).randint(0, 4000, size=(9, 22, 17)).astype(np.uint16)
+
+def test_block_grid_covers_array():
+    shape = (9, 22, 17)
+    count = np.zeros(shape, dtype=np.int32)
+    for core, outer, inner in block_grid(shape, (4, 8), halo=(1, 2, 0)):
+        count[core] += 1
+        for c, o, i in zip(core, outer, inner):
+            assert o.start <= c.start and o.stop >= c.stop
+            assert (i.start, i.stop) == (c.start - o.start, c.stop - o.start)
+    assert (count == 1).all()
+
+def test_iter_blocks_halo():
+    data = _data()
+    for core, inner, block in iter_blocks(data, (4, 8, 8), halo=1):
+        assert (block[inner] == data[core]).all()
+
+def test_map_blocks_matches_whole_array_threads():
+    data = _data()
+    expected = box3(data)
+    for workers in (1, 3):
+        result = map_blocks(box3, data, (4, 8, 8), halo=1, workers=workers, dtype=np.float32)
+        assert np.allclose(result, expected)
+
+def test_map_blocks_lazy_processes_to_npy(tmpdir):
+    data = _data()
+    fname = str(tmpdir.join('a.tif'))
+    tifffile.imwrite(fname, data, photometric='minisblack', compression='zlib')
+    view = util.TiffLazyNDArray(fname)
+    outname = str(tmpdir.join('out.npy'))
+    result = view.map_blocks(box3, (4, 8, 8), halo=1, workers=2, out=outname, dtype=np.float32)
+    assert np.allclose(result, box3(data))
+    assert np.allclose(np.load(outname), box3(data))
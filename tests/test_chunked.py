@@ -0,0 +1,52 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import os
+import numpy as np
+
+from volspy import chunked, util
+
+def _data(seed=0):
+    return np.random.RandomState(seed).randint(0, 4000, size=(10, 21, 17, 2)).astype(np.uint16)
+
+def test_chunked_round_trip(tmpdir):
+    data = _data()
+    path = str(tmpdir.join('vol'))
+    chunked.convert(data, path, chunk_shape=(4, 8, 8), workers=1)
+    assert chunked.is_chunked(path)
+    view = chunked.ChunkedLazyNDArray(path)
+    assert view.shape == data.shape
+    assert (view[:, :, :, :] == data).all()
+    assert (view[3:9, 5:20:3, 2, 1] == data[3:9, 5:20:3, 2, 1]).all()
+    assert (view.transpose(3, 0, 1, 2)[1, 2:4, :, :] == data.transpose(3, 0, 1, 2)[1, 2:4]).all()
+
+def test_chunked_missing_brick_reads_zeros(tmpdir):
+    data = _data()
+    path = str(tmpdir.join('vol'))
+    chunked.convert(data, path, chunk_shape=(4, 8, 8), workers=1)
+    os.remove(os.path.join(path, chunked.brick_name((2, 2, 2, 0))))
+    expected = data.copy()
+    expected[8:12, 16:24, 16:24] = 0
+    assert (chunked.ChunkedLazyNDArray(path)[:, :, :, :] == expected).all()
+
+def test_chunked_rewrite_not_served_from_cache(tmpdir):
+    path = str(tmpdir.join('vol'))
+    chunked.convert(_data(0), path, chunk_shape=(4, 8, 8), workers=1)
+    assert (chunked.ChunkedLazyNDArray(path)[:, :, :, :] == _data(0)).all()
+
+    # same shape and header size, with header mtime moved back
+    hname = os.path.join(path, chunked.header_name)
+    st = os.stat(hname)
+    chunked.convert(_data(1), path, chunk_shape=(4, 8, 8), workers=1)
+    os.utime(hname, (st.st_atime, st.st_mtime - 10))
+    assert (chunked.ChunkedLazyNDArray(path)[:, :, :, :] == _data(1)).all()
+
+def test_load_image_chunked(tmpdir):
+    data = _data()
+    path = str(tmpdir.join('vol'))
+    chunked.convert(data, path, chunk_shape=(4, 8, 8), workers=1)
+    image, meta = util.load_image(path)
+    assert isinstance(image, chunked.ChunkedLazyNDArray)
+    assert (image[:, :, :, :] == data.transpose(3, 0, 1, 2)).all()
@@ -0,0 +1,74 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+import pytest
+
+pytest.importorskip('vispy')
+
+from volspy.geometry import make_cube_clipped
+from volspy.render import VolumeRenderer
+
+class _Cropper (object):
+    def __init__(self, shape, Zaspect):
+        self.data = np.zeros(shape + (1,), np.uint8)
+        self.Zaspect = Zaspect
+        self.clips = 0
+
+    def make_cube_clipped(self, dataplane=None):
+        self.clips += 1
+        return make_cube_clipped(self.data.shape[0:3], self.Zaspect, 2, dataplane)
+
+class _Buffer (object):
+    def set_data(self, data, copy=False):
+        self.data = data
+
+def _renderer(shape=(8, 16, 16), Zaspect=1.0):
+    renderer = VolumeRenderer.__new__(VolumeRenderer)
+    renderer.vol_cropper = _Cropper(shape, Zaspect)
+    renderer.anti_view = np.eye(4, dtype=np.float32)
+    renderer.prog_ray_casters = [dict()]
+    renderer.cube_verts = _Buffer()
+    renderer.volume_faces = _Buffer()
+    renderer.slice_faces = _Buffer()
+    renderer.clip_key = None
+    renderer.clip_rebuilds = 0
+    renderer.clip_rebuilds_skipped = 0
+    return renderer
+
+def test_same_clip_plane_not_rebuilt():
+    renderer = _renderer()
+    renderer.set_clip_plane((0, 0, 1, 0.1))
+    verts = renderer.cube_verts.data
+    renderer.set_clip_plane((0, 0, 1, 0.1))
+    # unnormalized equation of the same plane
+    renderer.set_clip_plane((0, 0, 2, 0.2))
+    assert renderer.vol_cropper.clips == 1
+    assert renderer.clip_rebuilds == 1
+    assert renderer.clip_rebuilds_skipped == 2
+    assert renderer.cube_verts.data is verts
+
+def test_changed_plane_shape_or_aspect_rebuilt():
+    renderer = _renderer()
+    renderer.set_clip_plane((0, 0, 1, 0.1))
+    plane = renderer.prog_ray_casters[0]['u_clip_plane'].copy()
+    renderer.set_clip_plane((0, 0, 1, 0.2))
+    assert renderer.clip_rebuilds == 2
+    assert not np.allclose(renderer.prog_ray_casters[0]['u_clip_plane'], plane)
+
+    renderer.vol_cropper.data = np.zeros((8, 32, 32, 1), np.uint8)
+    renderer.set_clip_plane((0, 0, 1, 0.2))
+    assert renderer.clip_rebuilds == 3
+
+    renderer.vol_cropper.Zaspect = 2.0
+    renderer.set_clip_plane((0, 0, 1, 0.2))
+    assert renderer.clip_rebuilds == 4
+    assert renderer.vol_cropper.clips == 4
+    assert renderer.clip_rebuilds_skipped == 0
+
+    # a new view maps the same view plane to a different model plane
+    renderer.anti_view = np.diag([1, 1, -1, 1]).astype(np.float32)
+    renderer.set_clip_plane((0, 0, 1, 0.2))
+    assert renderer.clip_rebuilds == 5
@@ -0,0 +1,52 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+import pytest
+
+pytest.importorskip('vispy')
+
+from volspy.geometry import make_cube_clipped
+
+def _mesh_volume(position, faces):
+    """Return enclosed volume of closed triangle mesh, positive for outward CCW winding."""
+    tris = position[faces.reshape((-1, 3))].astype(np.float64)
+    return np.einsum('ij,ij->i', tris[:,0], np.cross(tris[:,1], tris[:,2])).sum() / 6.
+
+def _sampled_volume(shape, Zaspect, zoom, plane, n=80):
+    """Return clipped box volume estimated at n**3 cell centers."""
+    D, H, W = shape
+    span = float(max(W, H, D * Zaspect))
+    half = np.array([ W, H, D * Zaspect ]) * zoom / span / 2
+    axes = [ (np.arange(n) + 0.5) / n * 2 * h - h for h in half ]
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+    A, B, C, Dp = plane
+    inside = (A * x + B * y + C * z + Dp) < 0
+    return inside.mean() * np.prod(2 * half)
+
+def test_unclipped_cube():
+    verts, faces, cutfaces = make_cube_clipped((10, 20, 30), 1.5, 1.0)
+    assert len(faces) == 36 and len(cutfaces) == 0
+    assert np.isclose(_mesh_volume(verts['position'], faces), 1.0 * (20 / 30.) * (15 / 30.))
+
+@pytest.mark.parametrize('seed', range(20))
+def test_clipped_cube_matches_plane(seed):
+    rng = np.random.RandomState(seed)
+    shape, Zaspect, zoom = (10, 20, 30), 1.5, 1.3
+    normal = rng.normal(size=3)
+    plane = tuple(normal / np.linalg.norm(normal)) + (rng.uniform(-0.3, 0.3),)
+    verts, faces, cutfaces = make_cube_clipped(shape, Zaspect, zoom, plane)
+    position = verts['position'].astype(np.float64)
+    distance = position.dot(plane[0:3]) + plane[3]
+
+    # corners with positive plane distance are clipped, as before the case table
+    assert (distance[np.unique(faces)] < 1e-5).all()
+    assert (abs(distance[np.unique(cutfaces)]) < 1e-5).all()
+    assert set(cutfaces.tolist()).issubset(set(faces.tolist()))
+
+    if len(faces):
+        assert abs(_mesh_volume(position, faces) - _sampled_volume(shape, Zaspect, zoom, plane)) < 0.01
+    else:
+        assert _sampled_volume(shape, Zaspect, zoom, plane) < 0.01
@@ -0,0 +1,65 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import json
+import numpy as np
+import tifffile
+
+from volspy import util
+
+def _data():
+    return np.random.RandomState(0).randint(0, 4000, size=(5, 12, 9, 2)).astype(np.uint16)
+
+def _write_meta(fname, meta):
+    with open(util.sidecar_filename(fname, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+def test_load_npy_memmap_with_metadata(tmpdir):
+    data = _data()
+    fname = str(tmpdir.join('a.npy'))
+    np.save(fname, data)
+    _write_meta(fname, {'micron_spacing': [2, 0.5, 0.25]})
+    image, meta = util.load_image(fname)
+    assert image.shape == (2, 5, 12, 9)
+    assert (image[:, :, :, :] == data.transpose(3, 0, 1, 2)).all()
+    assert image.micron_spacing == (2.0, 0.5, 0.25)
+    assert meta is not None
+    # whole array is a view of the file mapping
+    assert isinstance(image.force(), np.memmap)
+
+def test_load_by_magic_bytes(tmpdir):
+    data = _data()
+    fname = str(tmpdir.join('a.dat'))
+    with open(fname, 'wb') as f:
+        np.save(f, data)
+    image, meta = util.load_image(fname)
+    assert (image[:, :, :, :] == data.transpose(3, 0, 1, 2)).all()
+
+    fname = str(tmpdir.join('b.dat'))
+    tifffile.imwrite(fname, data[..., 0], photometric='minisblack')
+    image, meta = util.load_image(fname)
+    assert (image[0, :, :, :] == data[..., 0]).all()
+
+def test_load_raw_with_sidecar(tmpdir):
+    data = _data()
+    fname = str(tmpdir.join('a.raw'))
+    with open(fname, 'wb') as f:
+        f.write(b'\0' * 16)
+        f.write(data.tobytes())
+    _write_meta(fname, {'shape': list(data.shape), 'dtype': '<u2', 'offset': 16, 'axes': 'ZYXC'})
+    image, meta = util.load_image(fname)
+    assert (image[:, :, :, :] == data.transpose(3, 0, 1, 2)).all()
+
+def test_register_loader_first(tmpdir, monkeypatch):
+    monkeypatch.setattr(util, '_loaders', list(util._loaders))
+    fname = str(tmpdir.join('a.npy'))
+    np.save(fname, _data())
+    calls = []
+    def load(fname):
+        calls.append(fname)
+        return 'custom', None
+    util.register_loader(load, match=lambda fname: fname.endswith('.npy'), first=True)
+    assert util.load_image(fname) == ('custom', None)
+    assert calls == [ fname ]
@@ -0,0 +1,25 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+
+from volspy import util
+
+def test_pack_texture3d_matches_whole_array_conversion():
+    data = np.random.RandomState(0).randint(0, 4000, size=(9, 16, 12, 3)).astype(np.uint16)
+    channels = (2, 0)
+    minval = float(data.min())
+    scale = (2.0**16 - 1) / (float(data.max()) - minval)
+
+    expected = np.empty((9, 16, 12, 2), dtype=np.uint16)
+    for i, c in enumerate(channels):
+        expected[:,:,:,i] = (data[:,:,:,c].astype(np.float32) - minval) * scale
+
+    out = np.zeros(expected.shape, dtype=np.uint16)
+    view = util.ArrayLazyNDArray(data, 'ZYXC')
+    for source in (data, view):
+        # small slabs exercise scratch buffer reuse
+        assert util.pack_texture3d(source, channels, out, minval, scale, slab_bytes=2000) is out
+        assert (out == expected).all()
@@ -0,0 +1,79 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+import pytest
+
+pytest.importorskip('vispy')
+
+from volspy.data import ImageManager
+from volspy.lazy import ArrayLazyNDArray
+from volspy.util import bin_reduce
+
+def _voxels(shape, strides):
+    return (shape[0] // strides[0]) * (shape[1] // strides[1]) * (shape[2] // strides[2])
+
+def test_preview_strides_within_budget():
+    shape = (64, 4096, 4096, 1)
+    strides = ImageManager.preview_strides(shape, (1, 1, 1))
+    assert strides[0] == 64 // ImageManager.preview_pages
+    assert _voxels(shape, strides) <= ImageManager.preview_voxels
+    # the XY strides are the smallest power of 2 within budget
+    assert _voxels(shape, (strides[0], strides[1] // 2, strides[2] // 2)) > ImageManager.preview_voxels
+
+    # XY strides grow from the view reduction
+    strides = ImageManager.preview_strides((64, 4096, 4096, 1), (2, 4, 4))
+    assert strides[1] % 4 == 0 and strides[2] % 4 == 0
+    assert _voxels(shape, strides) <= ImageManager.preview_voxels
+
+def test_preview_strides_small_image_is_view_reduction():
+    assert ImageManager.preview_strides((8, 64, 64, 2), (1, 2, 2)) == (1, 2, 2)
+
+def test_preview_shape_and_dtype():
+    data = np.random.RandomState(0).randint(0, 1000, size=(10, 20, 70, 2)).astype(np.uint16)
+    for I in (data, ArrayLazyNDArray(data, 'ZYXC')):
+        preview = ImageManager.preview(I, (3, 2, 2))
+        assert type(preview) is np.ndarray
+        assert preview.dtype == np.uint16
+        # 35 X samples trimmed to whole 16-pixel rows
+        assert preview.shape == (4, 10, 32, 2)
+        assert np.array_equal(preview, data[::3, ::2, 0:64:2, :])
+
+def test_refine_view_switches_to_full_resolution(tmpdir, monkeypatch):
+    import tifffile
+    monkeypatch.setenv('ZYX_IMAGE_GRID', '1,1,1')
+    monkeypatch.setenv('ZYX_VIEW_GRID', '1,1,1')
+    monkeypatch.setattr(ImageManager, 'preview_pages', 4)
+    fname = str(tmpdir.join('source.ome.tif'))
+    data = np.random.RandomState(1).randint(0, 1000, size=(2, 32, 16, 32)).astype(np.uint16)
+    tifffile.imwrite(fname, data, metadata={'axes': 'CZYX'})
+    reformed = []
+    def reform(I, meta, reduction):
+        reformed.append(reduction)
+        return bin_reduce(I, reduction + (1,))
+
+    manager = ImageManager(fname, reform, progressive=True)
+    assert reformed == []
+    assert manager.level == (8, 1, 1)
+    assert manager.data.shape == (4, 16, 32, 2)
+    assert manager.view_shape == (32, 16, 32, 2)
+
+    reduction, I, channels, payload = manager.refine_view()
+    assert reformed == [(1, 1, 1)]
+    assert reduction == (1, 1, 1)
+    assert channels == (0, 1)
+    # texture data is scaled to the full uint16 range
+    view = data.transpose(1, 2, 3, 0).astype(np.float64)
+    expected = (view - view.min()) * (2.0**16 - 1) / (view.max() - view.min())
+    assert payload.dtype == np.uint16
+    assert np.allclose(payload, expected, atol=1)
+    # the preview stays current until the refined view is committed
+    assert manager.level == (8, 1, 1)
+    assert manager.preview_source is None
+
+    manager.commit_view(reduction, I, channels)
+    assert manager.level == (1, 1, 1)
+    assert manager.data is I
+    assert manager.data.shape == manager.view_shape
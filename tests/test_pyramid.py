@@ -0,0 +1,96 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import os
+import numpy as np
+
+from volspy.pyramid import ImagePyramid
+from volspy.util import bin_reduce
+
+def _source(tmpdir):
+    fname = str(tmpdir.join('source.raw'))
+    with open(fname, 'wb') as f:
+        f.write(b'x' * 100)
+    data = np.random.RandomState(1).randint(0, 1000, size=(8, 16, 16, 2)).astype(np.uint16)
+    return fname, data
+
+def test_level_reductions():
+    assert ImagePyramid.level_reductions((2, 8, 8)) == [(2, 8, 8), (2, 4, 4), (2, 2, 2), (1, 1, 1)]
+    assert ImagePyramid.level_reductions((1, 1, 1)) == [(1, 1, 1)]
+
+def test_select_respects_zoom_and_budget():
+    p = ImagePyramid(np.zeros((8, 64, 64, 1), np.uint8), ImagePyramid.level_reductions((1, 8, 8)))
+    assert p.select((1, 8, 8), 1.0, 2**30, 1) == (1, 8, 8)
+    assert p.select((1, 8, 8), 2.0, 2**30, 1) == (1, 4, 4)
+    assert p.select((1, 8, 8), 100.0, 2**30, 1) == (1, 1, 1)
+    # (1,1,1) level needs 32 KiB
+    assert p.select((1, 8, 8), 100.0, 16 * 2**10, 1) == (1, 2, 2)
+
+def test_level_matches_bin_reduce_and_is_cached(tmpdir):
+    fname, data = _source(tmpdir)
+    p = ImagePyramid(data, [(1, 4, 4), (1, 2, 2)], fname, 'key')
+    level = p.get_level((1, 2, 2))
+    assert np.array_equal(level, bin_reduce(data, (1, 2, 2, 1)))
+    assert os.path.exists(p._cache_filename((1, 2, 2)))
+
+    # a new pyramid over different data reuses the cache of the unchanged source
+    p2 = ImagePyramid(data + 1, [(1, 4, 4), (1, 2, 2)], fname, 'key')
+    assert isinstance(p2.get_level((1, 2, 2)), np.memmap)
+    assert np.array_equal(p2.get_level((1, 2, 2)), level)
+
+def test_level_cache_invalidated_by_source_change(tmpdir):
+    fname, data = _source(tmpdir)
+    ImagePyramid(data, [(1, 2, 2)], fname, 'key').get_level((1, 2, 2))
+    st = os.stat(fname)
+    with open(fname, 'ab') as f:
+        f.write(b'y')
+    # restore mtime so only the size differs
+    os.utime(fname, (st.st_atime, st.st_mtime))
+    level = ImagePyramid(data + 1, [(1, 2, 2)], fname, 'key').get_level((1, 2, 2))
+    assert np.array_equal(level, bin_reduce(data + 1, (1, 2, 2, 1)))
+
+def test_levels_built_with_reform(tmpdir):
+    fname, data = _source(tmpdir)
+    def reform(I, reduction):
+        return bin_reduce(I, tuple(reduction) + (1,)) * 2
+    p = ImagePyramid(data, [(1, 2, 2), (1, 1, 1)], fname, 'reformed', reform)
+    assert np.array_equal(p.get_level((1, 2, 2)), bin_reduce(data, (1, 2, 2, 1)) * 2)
+    assert np.array_equal(p.get_level((1, 1, 1)), data.astype(np.float32) * 2)
+    # in-memory pyramid without file name
+    p = ImagePyramid(data, [(1, 2, 2), (1, 1, 1)], None, '', reform)
+    assert np.array_equal(p.get_level((1, 1, 1)), data.astype(np.float32) * 2)
+
+def test_select_respects_max_extent():
+    p = ImagePyramid(np.zeros((8, 64, 64, 1), np.uint8), ImagePyramid.level_reductions((1, 8, 8)))
+    assert p.select((1, 8, 8), 100.0, 2**30, 1, 32) == (1, 2, 2)
+    # Z voxels 8 times X size make (1,2,2) span 64/2 X voxels in Z
+    assert p.select((1, 8, 8), 100.0, 2**30, 1, 32, (4.0, 0.5, 0.5)) == (1, 2, 2)
+    assert p.select((1, 8, 8), 100.0, 2**30, 1, 32, (8.0, 0.5, 0.5)) == (1, 4, 4)
+    assert p.select((1, 8, 8), 100.0, 2**30, 1, 4) == (1, 8, 8)
+
+def test_lazy_tiff_source_with_viewer_reform(tmpdir):
+    import tifffile
+    from volspy.util import TiffLazyNDArray, load_tiff
+    data = np.random.RandomState(2).randint(0, 1000, size=(8, 16, 16, 2)).astype(np.uint16)
+    fname = str(tmpdir.join('source.tif'))
+    tifffile.imwrite(fname, data.transpose(3, 0, 1, 2), photometric='minisblack', compression='zlib')
+    # ZYXC view as loaded by ImageManager
+    source = load_tiff(fname)[0].transpose(1, 2, 3, 0)
+    assert isinstance(source, TiffLazyNDArray)
+    assert source.shape == data.shape
+
+    def reform(I, reduction):
+        # as viewer Canvas._reform_image
+        return bin_reduce(I, tuple(reduction) + (1,))
+    p = ImagePyramid(source, [(1, 2, 2), (1, 1, 1)], fname, 'lazy', reform)
+    assert np.array_equal(p.get_level((1, 2, 2)), bin_reduce(data, (1, 2, 2, 1)))
+    assert os.path.exists(p._cache_filename((1, 2, 2)))
+    level = p.get_level((1, 1, 1))
+    assert np.array_equal(level[:, :, :, :], data)
+
+    # lazy reform results are copied into the cache
+    p = ImagePyramid(source, [(1, 1, 1)], fname, 'copied', lambda I, reduction: I.lazyget((slice(None),) * 4))
+    assert isinstance(p.get_level((1, 1, 1)), np.memmap)
+    assert np.array_equal(p.get_level((1, 1, 1)), data)
@@ -0,0 +1,140 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import threading
+import numpy as np
+
+from volspy.reload import TextureReload
+
+class _Texture (object):
+    def __init__(self, shape):
+        self.data = np.zeros(shape, np.uint16)
+        self.offsets = []
+        self.deleted = False
+
+    def set_data(self, data, offset=(0, 0, 0), copy=False):
+        assert not self.deleted
+        self.offsets.append(offset[0])
+        self.data[offset[0]:offset[0] + data.shape[0]] = data
+
+    def delete(self):
+        self.deleted = True
+
+class _Viewer (object):
+    """Records reload callbacks in place of the viewer and its GL textures."""
+
+    def __init__(self, chunk_bytes, refine=False):
+        self.prepared = []
+        self.textures = []
+        self.committed = []
+        self.gate = None
+        self.reload = TextureReload(
+            self.prepare, self.new_texture, self.commit, chunk_bytes,
+            refine and (lambda: self.prepare('refined', None)) or None
+        )
+
+    def prepare(self, channels, zoom):
+        if self.gate is not None:
+            self.gate.wait()
+        self.prepared.append((channels, zoom))
+        payload = np.arange(10 * 4 * 4, dtype=np.uint16).reshape((10, 4, 4, 1)) + len(self.prepared)
+        return (zoom, None, channels, payload)
+
+    def new_texture(self, result):
+        texture = _Texture(result[3].shape)
+        self.textures.append(texture)
+        return texture
+
+    def commit(self, result, texture):
+        self.committed.append((result[2], texture))
+
+    def wait(self):
+        self.reload.job['thread'].join()
+        return self.reload.poll()
+
+def test_upload_chunks_in_order_then_commit():
+    # 32 bytes per payload plane, 3 planes per chunk
+    viewer = _Viewer(96)
+    viewer.reload.submit((0,), 2.0)
+    assert viewer.reload.start() == 'preparing'
+    assert viewer.wait() is None
+    texture = viewer.textures[0]
+    statuses = []
+    while viewer.reload.upload is not None:
+        assert viewer.committed == []
+        statuses.append(viewer.reload.upload_chunk())
+    assert statuses == ['uploading 30%', 'uploading 60%', 'uploading 90%', 'done']
+    assert texture.offsets == [0, 3, 6, 9]
+    assert viewer.committed == [((0,), texture)]
+    assert np.array_equal(texture.data, np.arange(160).reshape((10, 4, 4, 1)) + 1)
+    assert not viewer.reload.busy()
+
+def test_latest_request_wins_while_preparing():
+    viewer = _Viewer(2**20)
+    viewer.gate = threading.Event()
+    viewer.reload.submit((0,), 1.0)
+    viewer.reload.start()
+    viewer.reload.submit((1,), 2.0)
+    viewer.reload.submit((2,), 3.0)
+    assert viewer.reload.start() is None
+    viewer.gate.set()
+    # the first result starts uploading before the latest request runs
+    assert viewer.wait() is None
+    assert viewer.reload.upload_chunk() == 'done'
+    assert viewer.reload.poll() == 'preparing'
+    viewer.wait()
+    viewer.reload.upload_chunk()
+    assert viewer.prepared == [((0,), 1.0), ((2,), 3.0)]
+    assert [c for c, t in viewer.committed] == [(0,), (2,)]
+
+def test_new_request_cancels_upload():
+    viewer = _Viewer(32)
+    viewer.reload.submit((0,), 1.0)
+    viewer.reload.start()
+    viewer.wait()
+    viewer.reload.upload_chunk()
+    old = viewer.textures[0]
+
+    viewer.reload.submit((1,), 2.0)
+    assert old.deleted
+    assert viewer.reload.upload is None
+    assert viewer.reload.start() == 'preparing'
+    viewer.wait()
+    while viewer.reload.upload is not None:
+        viewer.reload.upload_chunk()
+    assert viewer.committed == [((1,), viewer.textures[1])]
+    assert viewer.textures[1].offsets == list(range(10))
+
+def test_refine_upload_not_cancelled():
+    viewer = _Viewer(32, refine=True)
+    assert viewer.reload.start() == 'refining preview'
+    viewer.wait()
+    viewer.reload.upload_chunk()
+    viewer.reload.submit((1,), 2.0)
+    assert viewer.reload.upload is not None
+    assert not viewer.textures[0].deleted
+    while viewer.reload.upload is not None:
+        viewer.reload.upload_chunk()
+    assert viewer.reload.poll() == 'preparing'
+    viewer.wait()
+    assert viewer.prepared == [('refined', None), ((1,), 2.0)]
+    assert viewer.committed[0] == ('refined', viewer.textures[0])
+
+def test_current_view_and_failure_skip_upload():
+    viewer = _Viewer(2**20)
+    viewer.new_texture = lambda result: None
+    viewer.reload.new_texture = viewer.new_texture
+    viewer.reload.submit((0,), 1.0)
+    viewer.reload.start()
+    assert viewer.wait() == 'done'
+    assert not viewer.reload.busy()
+
+    def fail(channels, zoom):
+        raise ValueError('bad view')
+    viewer.reload.prepare = fail
+    viewer.reload.submit((0,), 1.0)
+    viewer.reload.start()
+    assert viewer.wait() == 'failed'
+    assert viewer.committed == []
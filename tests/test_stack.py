@@ -0,0 +1,84 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import os
+import numpy as np
+import tifffile
+
+from volspy import stack, util
+from volspy.cache import page_cache
+
+def _data(seed=0):
+    return np.random.RandomState(seed).randint(0, 4000, size=(12, 30, 20)).astype(np.uint16)
+
+def _write_stack(path, data, **kwargs):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for z in range(data.shape[0]):
+        tifffile.imwrite(os.path.join(path, 'z%d.tif' % z), data[z], **kwargs)
+
+def test_stack_files_natural_order(tmpdir):
+    path = str(tmpdir.join('stack'))
+    _write_stack(path, _data())
+    names = [ os.path.basename(f) for f in stack.stack_files(path) ]
+    assert names == [ 'z%d.tif' % z for z in range(12) ]
+    assert stack.is_stack(path)
+
+def test_stack_round_trip(tmpdir):
+    data = _data()
+    path = str(tmpdir.join('stack'))
+    _write_stack(path, data, compression='zlib', rowsperstrip=4)
+    view = stack.StackLazyNDArray(path)
+    assert view.shape == data.shape
+    # partial reads decode regions before whole planes are cached
+    assert (view[2:9:3, 5:17, 3:11] == data[2:9:3, 5:17, 3:11]).all()
+    assert (view[:, :, :] == data).all()
+    assert (view[4, 7:9, :] == data[4, 7:9, :]).all()
+
+def test_stack_rewrite_not_served_from_cache(tmpdir):
+    path = str(tmpdir.join('stack'))
+    _write_stack(path, _data(0))
+    view = stack.StackLazyNDArray(path)
+    assert (view[:, :, :] == _data(0)).all()
+
+    # same plane file sizes, with mtime moved back
+    fname = os.path.join(path, 'z3.tif')
+    st = os.stat(fname)
+    _write_stack(path, _data(1))
+    os.utime(fname, (st.st_atime, st.st_mtime - 10))
+    assert os.stat(fname).st_size == st.st_size
+    # a new view stats the planes again
+    assert (stack.StackLazyNDArray(path)[3, 2:5, 1:4] == _data(1)[3, 2:5, 1:4]).all()
+    # the old view checks planes when rebuilding their cache entries
+    page_cache.clear()
+    assert (view[:, :, :] == _data(1)).all()
+
+def test_stack_planes_stat_once_while_cached(tmpdir, monkeypatch):
+    path = str(tmpdir.join('stack'))
+    _write_stack(path, _data())
+    page_cache.clear()
+    stats = []
+    source_signature = util.source_signature
+    def counting_signature(fname):
+        stats.append(fname)
+        return source_signature(fname)
+    monkeypatch.setattr(util, 'source_signature', counting_signature)
+    view = stack.StackLazyNDArray(path)
+    assert len(stats) == 12
+    # planes are not stat'ed again by reads while cached
+    assert (view[:, :, :] == _data()).all()
+    view[2:5, 3, :]
+    assert len(stats) == 12
+    # but are when rebuilding evicted entries
+    page_cache.clear()
+    view[2:5, 3, :]
+    assert len(stats) == 15
+
+def test_load_image_stack(tmpdir):
+    data = _data()
+    path = str(tmpdir.join('stack'))
+    _write_stack(path, data)
+    image, meta = util.load_image(path)
+    assert (image[0, :, :, :] == data).all()
@@ -0,0 +1,118 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import os
+import numpy as np
+
+from volspy import util
+from volspy.stats import ImageStats, image_stats
+
+def test_image_stats_matches_numpy():
+    data = np.random.RandomState(0).randint(0, 4000, size=(20, 30, 40, 2)).astype(np.uint16)
+    stats = image_stats(data, slab_bytes=4096)
+    for c in range(2):
+        assert stats.min[c] == data[..., c].min()
+        assert stats.max[c] == data[..., c].max()
+        assert np.isclose(stats.mean[c], data[..., c].mean())
+
+def test_image_stats_percentiles():
+    rng = np.random.RandomState(1)
+    data = rng.randint(0, 4000, size=(20, 30, 40, 2)).astype(np.uint16)
+    stats = image_stats(data, slab_bytes=4096)
+    for c in range(2):
+        for q in (1, 50, 99):
+            # within one histogram bin of the exact value
+            assert abs(stats.percentile(q, c) - np.percentile(data[..., c], q)) <= stats.hist_width[c] + 1
+
+    # float data growing beyond the first slab's range
+    data = rng.normal(size=(20, 30, 40)).astype(np.float32)
+    data[10:] *= 10
+    stats = image_stats(data, channels_last=False, slab_bytes=4096)
+    assert stats.nchannels == 1
+    assert stats.min[0] == data.min() and stats.max[0] == data.max()
+    for q in (5, 50, 95):
+        assert abs(stats.percentile(q) - np.percentile(data, q)) <= stats.hist_width[0]
+
+def test_image_stats_dict_round_trip():
+    data = np.random.RandomState(2).randint(0, 255, size=(5, 6, 7, 3)).astype(np.uint8)
+    stats = image_stats(data)
+    copy = ImageStats.from_dict(stats.to_dict())
+    assert (copy.hist == stats.hist).all()
+    assert (copy.mean == stats.mean).all()
+    assert copy.percentile(50, 2) == stats.percentile(50, 2)
+
+def _source(tmpdir, content):
+    fname = str(tmpdir.join('source.raw'))
+    with open(fname, 'wb') as f:
+        f.write(content)
+    return fname
+
+def test_stats_sidecar_reused_while_source_unchanged(tmpdir):
+    fname = _source(tmpdir, b'x' * 100)
+    data = np.arange(24, dtype=np.uint16).reshape((2, 3, 4, 1))
+    util.cached_image_stats(data, fname, 'stats-test.json')
+    sidecar = util.sidecar_filename(fname, 'stats-test.json')
+    assert os.path.exists(sidecar)
+
+    # different data gets cached stats of the unchanged source
+    stats = util.cached_image_stats(data * 2, fname, 'stats-test.json')
+    assert stats.max[0] == 23
+
+def test_stats_sidecar_invalidated_by_source_size(tmpdir):
+    fname = _source(tmpdir, b'x' * 100)
+    data = np.arange(24, dtype=np.uint16).reshape((2, 3, 4, 1))
+    util.cached_image_stats(data, fname, 'stats-test.json')
+    st = os.stat(fname)
+    _source(tmpdir, b'x' * 101)
+    # same mtime, different size
+    os.utime(fname, (st.st_atime, st.st_mtime))
+    stats = util.cached_image_stats(data * 2, fname, 'stats-test.json')
+    assert stats.max[0] == 46
+
+def test_stats_sidecar_invalidated_by_source_mtime(tmpdir):
+    fname = _source(tmpdir, b'x' * 100)
+    data = np.arange(24, dtype=np.uint16).reshape((2, 3, 4, 1))
+    util.cached_image_stats(data, fname, 'stats-test.json')
+    st = os.stat(fname)
+    # sidecar newer than source is not enough
+    os.utime(fname, (st.st_atime, st.st_mtime - 10))
+    stats = util.cached_image_stats(data * 2, fname, 'stats-test.json')
+    assert stats.max[0] == 46
+
+def test_stats_load_checks_source(tmpdir):
+    fname = str(tmpdir.join('stats.json'))
+    stats = image_stats(np.ones((2, 2, 2, 1), np.uint8))
+    stats.save(fname, [10, 1.5])
+    assert ImageStats.load(fname, [10, 1.5]) is not None
+    assert ImageStats.load(fname, [11, 1.5]) is None
+    assert ImageStats.load(fname) is not None
+
+class Reformer (object):
+    def reform(self, I, meta, view_reduction):
+        return I
+
+class SubReformer (Reformer):
+    def reform(self, I, meta, view_reduction):
+        return I * 2
+
+def test_view_cache_key_includes_reform_identity():
+    origin, shape = (0, 0, 0, 0), (10, 20, 30, 2)
+    keys = set([
+        util.view_cache_key(origin, shape),
+        util.view_cache_key(origin, shape, Reformer().reform),
+        util.view_cache_key(origin, shape, SubReformer().reform),
+    ])
+    assert len(keys) == 3
+    assert util.view_cache_key(origin, shape, Reformer().reform) == util.view_cache_key(origin, shape, Reformer().reform)
+
+def test_view_cache_key_includes_znoise(monkeypatch):
+    origin, shape = (0, 0, 0, 0), (10, 20, 30, 2)
+    monkeypatch.delenv('ZNOISE_PERCENTILE', raising=False)
+    plain = util.view_cache_key(origin, shape)
+    monkeypatch.setenv('ZNOISE_PERCENTILE', '5')
+    p5 = util.view_cache_key(origin, shape)
+    monkeypatch.setenv('ZNOISE_ZERO_LEVEL', '10')
+    p5z = util.view_cache_key(origin, shape)
+    assert len(set([plain, p5, p5z])) == 3
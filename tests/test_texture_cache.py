@@ -0,0 +1,49 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+import pytest
+
+pytest.importorskip('vispy')
+
+from volspy.cache import ByteLRUCache
+from volspy.data import ImageManager
+
+class _Stats (object):
+    min = np.array([0.])
+    max = np.array([100.])
+
+def _manager(budget_bytes):
+    manager = ImageManager.__new__(ImageManager)
+    manager.texture_buffer = None
+    manager.texture_buffer_key = None
+    manager.texture_cache = ByteLRUCache(budget_bytes)
+    manager.get_stats = lambda level, data: _Stats()
+    return manager
+
+def test_texture_data_staged_then_cached_on_demand():
+    data = np.random.RandomState(0).randint(0, 100, size=(4, 5, 6, 3)).astype(np.uint16)
+    manager = _manager(2**20)
+    first = manager._texture_data(0, data, (0,))
+    expected = first.copy()
+    assert first is manager.texture_buffer
+    assert manager._texture_data(0, data, (0,)) is first
+    assert len(manager.texture_cache) == 0
+
+    # packing another selection reuses the buffer, caching the old payload
+    assert manager._texture_data(0, data, (1,)) is first
+    assert len(manager.texture_cache) == 1
+    cached = manager._texture_data(0, data, (0,))
+    assert cached is not manager.texture_buffer
+    assert (cached == expected).all()
+
+def test_texture_data_uncached_with_zero_budget():
+    data = np.random.RandomState(0).randint(0, 100, size=(4, 5, 6, 3)).astype(np.uint16)
+    manager = _manager(0)
+    manager._texture_data(0, data, (0,))
+    staged = manager._texture_data(0, data, (1, 2))
+    assert staged is manager.texture_buffer
+    assert staged.shape == (4, 5, 6, 2)
+    assert len(manager.texture_cache) == 0
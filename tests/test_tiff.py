@@ -0,0 +1,162 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import time
+import numpy as np
+import tifffile
+
+from volspy import util
+from volspy.cache import ByteLRUCache, page_cache
+
+def _data():
+    return np.random.RandomState(0).randint(0, 4000, size=(6, 32, 24)).astype(np.uint16)
+
+def _write(tmpdir, data, name='a.tif', **kwargs):
+    fname = str(tmpdir.join(name))
+    tifffile.imwrite(fname, data, photometric='minisblack', **kwargs)
+    return fname
+
+def test_byte_lru_cache_budget():
+    cache = ByteLRUCache(3 * 800)
+    for i in range(4):
+        cache.put(i, np.zeros(100))
+    # oldest entry evicted to stay within budget
+    assert 0 not in cache and 3 in cache
+    assert cache.get(1) is not None
+    cache.put(4, np.zeros(100))
+    assert 1 in cache and 2 not in cache
+    # values larger than the whole budget are not cached
+    cache.put(5, np.zeros(1000))
+    assert 5 not in cache
+    assert cache.nbytes <= cache.budget_bytes
+
+def test_page_cache_reuses_decoded_pages(tmpdir):
+    data = _data()
+    fname = _write(tmpdir, data, compression='zlib')
+    view = util.TiffLazyNDArray(fname)
+    assert (view[:, :, :] == data).all()
+    hits = page_cache.hits
+    assert (view[2:5, 3:30, :] == data[2:5, 3:30, :]).all()
+    assert page_cache.hits == hits + 3
+    # derived views share cached pages
+    assert (view.lazyget((slice(1, 3), slice(None), slice(None)))[:, :, :] == data[1:3]).all()
+    assert page_cache.hits == hits + 5
+
+def test_parallel_page_decoding_identical(tmpdir, monkeypatch):
+    data = _data()
+    fname = _write(tmpdir, data, compression='zlib', tile=(16, 16))
+    page_cache.clear()
+    monkeypatch.setenv('VOLSPY_IO_WORKERS', '4')
+    view = util.TiffLazyNDArray(fname)
+    assert (view[:, :, :] == data).all()
+    page_cache.clear()
+    assert (view[1:6:2, 5:20, 3:21] == data[1:6:2, 5:20, 3:21]).all()
+    assert (view.transpose(2, 0, 1)[:, :, :] == data.transpose(2, 0, 1)).all()
+
+def test_contiguous_series_memmap(tmpdir):
+    data = _data()
+    view = util.TiffLazyNDArray(_write(tmpdir, data))
+    assert view.series_memmap is not None
+    assert view.is_memmappable
+    forced = view.force()
+    assert isinstance(forced, np.memmap) or isinstance(forced.base, np.memmap)
+    assert (forced == data).all()
+    assert (view[1:6:2, ::3, 4] == data[1:6:2, ::3, 4]).all()
+
+    compressed = util.TiffLazyNDArray(_write(tmpdir, data, 'b.tif', compression='zlib'))
+    assert compressed.series_memmap is None
+    assert (compressed.force() == data).all()
+
+def test_ome_tiff_opened_from_metadata(tmpdir):
+    data = _data()
+    fname = str(tmpdir.join('a.ome.tif'))
+    tifffile.imwrite(fname, data, ome=True, metadata={
+        'axes': 'ZYX', 'PhysicalSizeZ': 2.0, 'PhysicalSizeY': 0.5, 'PhysicalSizeX': 0.25,
+    })
+    source = util.TiffSource(fname)
+    # described without parsing every IFD with tifffile
+    assert source._tf is None
+    # OME series keeps singleton dimensions, e.g. TZCYX
+    assert tuple([ n for n in source.shape if n > 1 ]) == data.shape
+    assert source.micron_spacing == (2.0, 0.5, 0.25)
+    image, meta = util.load_tiff(fname)
+    assert image.shape == (1,) + data.shape
+    assert (image[:, :, :, :] == data[None]).all()
+    assert image.micron_spacing == (2.0, 0.5, 0.25)
+    assert image.source._tf is None
+
+def test_page_region():
+    assert util.page_region((slice(0, 32, 1), slice(0, 24, 1)), (32, 24)) is None
+    region, local = util.page_region((slice(3, 20, 4), 7), (32, 24))
+    assert region == (3, 20, 7, 8)
+    assert local == (slice(0, 17, 4), 0)
+
+def test_tiled_roi_reads_decode_region_only(tmpdir):
+    data = _data()
+    fname = _write(tmpdir, data, compression='zlib', tile=(16, 16))
+    page_cache.clear()
+    view = util.TiffLazyNDArray(fname)
+    for key in [ (slice(1, 4), slice(17, 30), slice(2, 9)), (2, slice(3, 31, 5), 20), (slice(None), 0, slice(None, None, 7)) ]:
+        assert (view[key] == data[key]).all()
+    # partial pages are not cached as whole pages
+    assert len(page_cache) == 0
+    assert (view[:, :, :] == data).all()
+    assert len(page_cache) == data.shape[0]
+    assert (view[2, 5:9, 5:9] == data[2, 5:9, 5:9]).all()
+
+def test_prefetcher_reads_ahead_sequential_pages(tmpdir, monkeypatch):
+    data = _data()
+    fname = _write(tmpdir, data, compression='zlib')
+    monkeypatch.setenv('VOLSPY_PREFETCH', '2')
+    page_cache.clear()
+    source = util.TiffSource(fname)
+    prefetcher = source.prefetcher
+    assert prefetcher is not None
+    prefetcher.advise(0)
+    prefetcher.advise(2)
+    prefetcher.advise(4)
+    # irregular access cancels read-ahead
+    prefetcher.advise(1)
+    assert not prefetcher.pending
+    prefetcher.advise(2)
+    deadline = time.time() + 10
+    with prefetcher.cond:
+        while (3 not in prefetcher.ready or 4 not in prefetcher.ready) and time.time() < deadline:
+            prefetcher.cond.wait(1)
+    assert (prefetcher.take(3) == data[3]).all()
+    assert prefetcher.hits == 1
+
+    # reads stepping through Z return the same data with read-ahead
+    page_cache.clear()
+    view = util.TiffLazyNDArray(fname)
+    for z in range(data.shape[0]):
+        assert (view[z, :, :] == data[z]).all()
+
+def test_worker_handles_closed_with_source(tmpdir, monkeypatch):
+    import gc
+    data = _data()
+    fname = _write(tmpdir, data, compression='zlib')
+    monkeypatch.setenv('VOLSPY_IO_WORKERS', '3')
+    page_cache.clear()
+    view = util.TiffLazyNDArray(fname)
+    assert (view[:, :, :] == data).all()
+    handles = list(view.source.thread_handles.handles)
+    # one private handle per pool thread used
+    assert 1 <= len(handles) <= 3
+    assert not any([ fh.closed for fh in handles ])
+    view.source.close()
+    assert all([ fh.closed for fh in handles ])
+    assert view.source.thread_handles.handles == []
+
+    # later reads reopen the file
+    page_cache.clear()
+    assert (view[:, :, :] == data).all()
+    handles = list(view.source.thread_handles.handles)
+    assert handles and not any([ fh.closed for fh in handles ])
+
+    # dropping the source closes its handles too
+    del view
+    gc.collect()
+    assert all([ fh.closed for fh in handles ])
@@ -0,0 +1,93 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import os
+import numpy as np
+import pytest
+import tifffile
+
+from volspy import util
+from volspy.tiffindex import TiffIndex, can_decode, decode_page, _decompressors
+
+def _write(path, data, compression=None, **kwargs):
+    try:
+        tifffile.imwrite(str(path), data, photometric='minisblack', compression=compression, **kwargs)
+    except KeyError as e:
+        # codec needs imagecodecs
+        pytest.skip(str(e))
+    return str(path)
+
+def _data(dtype=np.uint16):
+    return np.random.RandomState(0).randint(0, 1000, size=(3, 40, 50)).astype(dtype)
+
+@pytest.mark.parametrize('compression,kwargs', [
+    (None, dict(rowsperstrip=7)),
+    ('zlib', dict(rowsperstrip=7)),
+    ('zlib', dict(predictor=True, tile=(16, 16))),
+    ('lzma', dict(tile=(16, 32))),
+    ('packbits', dict()),
+    ('lzw', dict()),
+    ('zstd', dict()),
+])
+def test_decode_page_matches_tifffile(tmpdir, compression, kwargs):
+    data = _data()
+    fname = _write(tmpdir.join('a.tif'), data, compression, **kwargs)
+    index = TiffIndex(fname)
+    assert len(index.pages) == 3
+    assert index.page0.shape == (40, 50)
+    for info in index.pages:
+        assert can_decode(info)
+    with open(fname, 'rb') as fh:
+        for z, info in enumerate(index.pages):
+            assert (decode_page(fh, info) == data[z]).all()
+            assert (decode_page(fh, info, (5, 23, 17, 49)) == data[z, 5:23, 17:49]).all()
+
+def test_contiguous_pages(tmpdir):
+    data = _data()
+    fname = _write(tmpdir.join('a.tif'), data)
+    index = TiffIndex(fname)
+    offset, nbytes = index.contiguous(1)
+    assert nbytes == data[1].nbytes
+    with open(fname, 'rb') as fh:
+        fh.seek(offset)
+        assert (np.frombuffer(fh.read(nbytes), dtype=index.page0.dtype).reshape(40, 50) == data[1]).all()
+    fname = _write(tmpdir.join('b.tif'), data, 'zlib')
+    assert TiffIndex(fname).contiguous(1) is None
+
+def test_index_sidecar_round_trip(tmpdir):
+    data = _data()
+    fname = _write(tmpdir.join('a.tif'), data, 'zlib', rowsperstrip=8)
+    view = util.TiffLazyNDArray(fname)
+    assert (view[1:3, 4:30, 7:9] == data[1:3, 4:30, 7:9]).all()
+    assert view.source.pages is not None
+    sidecar = util.sidecar_filename(os.path.abspath(fname), 'index.json')
+    assert os.path.exists(sidecar)
+
+    source = util.TiffSource(os.path.abspath(fname))
+    assert source.index is None and source._pages is not None
+    assert source.shape == data.shape
+    assert (source.decode_page(2) == data[2]).all()
+
+def test_index_sidecar_invalidated_by_rewrite(tmpdir):
+    data = _data()
+    fname = _write(tmpdir.join('a.tif'), data, 'zlib', rowsperstrip=8)
+    util.TiffLazyNDArray(fname).source.pages
+    sidecar = util.sidecar_filename(os.path.abspath(fname), 'index.json')
+    assert os.path.exists(sidecar)
+
+    # different strip layout, with mtime moved back
+    st = os.stat(fname)
+    data = data[:, ::-1].copy()
+    _write(fname, data, 'zlib', rowsperstrip=5)
+    os.utime(fname, (st.st_atime, st.st_mtime - 10))
+    source = util.TiffSource(os.path.abspath(fname))
+    assert source.index is not None
+    assert source.pages[0].rowsperstrip == 5
+    assert (source.decode_page(0) == data[0]).all()
+
+def test_packbits_decoder_registered():
+    if 32773 not in _decompressors:
+        pytest.skip('no PackBits decoder')
+    assert bytes(_decompressors[32773](b'\x02abc\xfe\x07')) == b'abc\x07\x07\x07'
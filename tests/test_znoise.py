@@ -0,0 +1,73 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+import numpy as np
+import pytest
+
+from volspy.util import znoise_field
+from volspy.lazy import ArrayLazyNDArray
+
+def _data(dtype, D):
+    rng = np.random.RandomState(D)
+    if np.dtype(dtype).kind == 'f':
+        data = rng.normal(size=(2, D, 9, 11)).astype(dtype)
+    else:
+        info = np.iinfo(dtype)
+        data = rng.randint(info.min, info.max + 1, size=(2, D, 9, 11)).astype(dtype)
+    # constant column exercises ties
+    data[:, :, 0, 0] = data[0, 0, 0, 0]
+    return data
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16, np.float32])
+@pytest.mark.parametrize('D', [1, 2, 40])
+@pytest.mark.parametrize('slab_bytes', [64*2**20, 1000])
+def test_znoise_field_matches_percentile(dtype, D, slab_bytes):
+    data = _data(dtype, D)
+    lazy = ArrayLazyNDArray(data, 'CZYX')
+    for ntile in (0, 5, 50, 95, 100):
+        expected = np.percentile(data.astype(np.float64), ntile, axis=1)
+        result = znoise_field(lazy, ntile, slab_bytes=slab_bytes)
+        assert result.shape == (2, 9, 11)
+        assert np.allclose(result, expected, rtol=1e-6, atol=1e-3)
+
+def test_znoise_field_float_memory_bounded():
+    import tracemalloc
+    data = np.random.RandomState(3).normal(size=(1, 100, 32, 32)).astype(np.float32)
+    slab_bytes = 16 * 2**10
+    tracemalloc.start()
+    try:
+        result = znoise_field(data, 50, slab_bytes=slab_bytes)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert np.allclose(result, np.percentile(data, 50, axis=1))
+    # selecting the median would keep 50 planes of 4KiB
+    assert peak < 4 * slab_bytes
+
+def test_znoise_field_decodes_single_strip_pages_once_per_pass(tmpdir, monkeypatch):
+    import tifffile
+    from volspy import util
+    from volspy.cache import page_cache
+    data = np.random.RandomState(4).randint(0, 4000, size=(20, 64, 64)).astype(np.uint16)
+    fname = str(tmpdir.join('a.ome.tif'))
+    tifffile.imwrite(fname, data, ome=True, compression='zlib', rowsperstrip=64, metadata={
+        'axes': 'ZYX', 'PhysicalSizeZ': 1.0, 'PhysicalSizeY': 1.0, 'PhysicalSizeX': 1.0,
+    })
+    image = util.load_tiff(fname)[0]
+    assert util._znoise_row_align(image) == 64
+
+    decoded = []
+    def decode_page(fh, info, region=None):
+        decoded.append(info.dataoffsets[0])
+        return tiffindex_decode_page(fh, info, region)
+    from volspy.tiffindex import decode_page as tiffindex_decode_page
+    monkeypatch.setattr(util, 'decode_page', decode_page)
+    monkeypatch.setattr(page_cache, 'budget_bytes', 0)
+
+    result = znoise_field(image, 50, slab_bytes=64 * 2**10)
+    assert np.allclose(result, np.percentile(data[None], 50, axis=1))
+    # every page decoded whole, once in each pass
+    passes = set([ decoded.count(offset) for offset in decoded ])
+    assert len(set(decoded)) == 20 and len(passes) == 1 and passes.pop() <= 16
@@ -8,23 +8,50 @@
 
 Sub-modules:
 
+  blocks: block decomposition and parallel block processing
+
+  cache: in-memory caching
+
+  chunked: chunked compressed volume store
+
   data: 3D volume image handling
 
   geometry: 3D volume bounding-box geometry
 
+  lazy: lazy ND-array views of on-disk images
+
+  pyramid: multi-resolution image levels
+
+  reload: background texture reload scheduling
+
   render: OpenGL rendering methods
 
+  stack: directory stacks of 2D TIFF planes
+
+  stats: streaming image statistics
+
+  tiffindex: fast TIFF structure and metadata index
+
   util: file handling and basic functions
 
   viewer: a volume viewer user-interface
 
 """
 
+from . import blocks
+from . import cache
+from . import stats
+from . import tiffindex
+from . import lazy
 from . import util
+from . import chunked
+from . import stack
+from . import reload
 
 try:
     from . import data
     from . import geometry
+    from . import pyramid
     from . import render
     from . import viewer
 except ImportError as e:
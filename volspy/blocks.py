@@ -0,0 +1,154 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Block decomposition of large image arrays.
+
+The iter_blocks() generator visits an ND-array or TiffLazyNDArray as a
+grid of blocks, each read with an optional halo of neighboring voxels
+so that filters near block edges see the same context they would in
+the whole array.
+
+The map_blocks() engine applies a NumPy function to every block and
+assembles the halo-trimmed results into a preallocated output array
+or a .npy memmap file.  For lazy arrays, blocks are read and processed
+by a pool of worker processes, each reopening the image file itself,
+so whole stacks can be processed on all cores without holding them in
+RAM.  In-memory arrays are processed by a thread pool over the shared
+array instead.
+
+"""
+
+import pickle
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+def _per_axis(value, ndim, default):
+    """Expand scalar or short tuple value to ndim-tuple, padding with default."""
+    if value is None:
+        value = ()
+    elif not isinstance(value, (tuple, list)):
+        value = (value,) * ndim
+    value = tuple(value)
+    assert len(value) <= ndim, "block parameters must not exceed array dimensions"
+    return value + tuple([ default[d] for d in range(len(value), ndim) ])
+
+def block_grid(shape, block_shape, halo=0):
+    """Generate (core, outer, inner) slicing tuples for a grid of blocks over shape.
+
+       shape: array shape to decompose
+       block_shape: block size per axis, where trailing axes omitted
+         or given as None span the whole axis
+       halo: extra context per axis as int or tuple
+
+       Each block covers array[core].  The block read with its halo,
+       clipped at array bounds, is array[outer], and block[inner]
+       trims the halo back to the core region.
+    """
+    ndim = len(shape)
+    block_shape = _per_axis(block_shape, ndim, shape)
+    block_shape = tuple([ b is None and n or b for b, n in zip(block_shape, shape) ])
+    halo = _per_axis(halo, ndim, (0,) * ndim)
+
+    def generate(axis):
+        if axis == ndim:
+            yield (), (), ()
+            return
+        n, b, h = shape[axis], block_shape[axis], halo[axis]
+        for start in range(0, n, b):
+            stop = min(start + b, n)
+            ostart = max(start - h, 0)
+            ostop = min(stop + h, n)
+            for core, outer, inner in generate(axis + 1):
+                yield (
+                    (slice(start, stop),) + core,
+                    (slice(ostart, ostop),) + outer,
+                    (slice(start - ostart, stop - ostart),) + inner
+                )
+
+    return generate(0)
+
+def iter_blocks(data, block_shape, halo=0):
+    """Generate (core, inner, block) for each block of data.
+
+       The block array includes its halo, block[inner] is the part
+       corresponding to data[core].  See block_grid() for arguments.
+    """
+    for core, outer, inner in block_grid(data.shape, block_shape, halo):
+        yield core, inner, data[outer]
+
+# per-process state of map_blocks() worker processes
+_worker_func = None
+_worker_data = None
+
+def _init_worker(payload):
+    global _worker_func, _worker_data
+    from .util import reset_process_state
+    reset_process_state()
+    _worker_func, _worker_data = pickle.loads(payload)
+
+def _map_block(task):
+    core, outer, inner = task
+    result = np.asarray(_worker_func(_worker_data[outer]))
+    return core, result[inner]
+
+def map_blocks(func, data, block_shape, halo=0, workers=None, out=None, dtype=None):
+    """Apply func to each block of data and assemble results, returning output array.
+
+       func: function mapping a block array, including its halo, to a
+         result array of the same shape, e.g. a filter.  For lazy
+         data with workers > 1, func must be picklable, i.e. a
+         module-level function.
+       data: ND-array or TiffLazyNDArray
+       block_shape, halo: see block_grid()
+       workers: number of parallel workers (default VOLSPY_WORKERS)
+       out: None to allocate an array, an existing array of data
+         shape, or a .npy filename to write as a memmap
+       dtype: output dtype when allocating (default data.dtype)
+
+       Lazy data is read block by block in worker processes, which
+       reopen the file by name.  In-memory ndarrays are processed by
+       worker threads sharing the array.
+    """
+    from .util import default_workers
+    if workers is None:
+        workers = default_workers()
+    if dtype is None:
+        dtype = data.dtype
+
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=data.shape)
+    assert out.shape == data.shape, "output shape %s does not match data %s" % (out.shape, data.shape)
+
+    tasks = list(block_grid(data.shape, block_shape, halo))
+
+    if workers <= 1 or len(tasks) <= 1:
+        for core, outer, inner in tasks:
+            out[core] = np.asarray(func(data[outer]))[inner]
+    elif isinstance(data, np.ndarray):
+        def map_block(task):
+            core, outer, inner = task
+            out[core] = np.asarray(func(data[outer]))[inner]
+        pool = ThreadPool(min(workers, len(tasks)))
+        try:
+            pool.map(map_block, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        payload = pickle.dumps((func, data), pickle.HIGHEST_PROTOCOL)
+        pool = Pool(min(workers, len(tasks)), _init_worker, (payload,))
+        try:
+            for core, result in pool.imap_unordered(_map_block, tasks, chunksize=1):
+                out[core] = result
+        finally:
+            pool.close()
+            pool.join()
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
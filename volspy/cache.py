@@ -0,0 +1,90 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""In-memory caching support.
+
+The ByteLRUCache holds ndarray values under a total byte budget,
+evicting least-recently used entries first.  A shared page_cache
+instance holds decoded TIFF pages for all TiffLazyNDArray instances
+so that repeated reads of compressed stacks only decode each page
+once.  Its budget is set by the VOLSPY_PAGE_CACHE_MB environment
+parameter and a budget of 0 disables caching.
+
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+class ByteLRUCache (object):
+    """Thread-safe LRU cache of ndarray values bounded by total nbytes."""
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Return cached value for key and mark it most-recently used, or default."""
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache value for key, evicting older entries to stay within budget.
+
+           Values larger than the whole budget are not cached.
+        """
+        nbytes = value.nbytes
+        if nbytes > self.budget_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            while self.entries and self.nbytes + nbytes > self.budget_bytes:
+                k, v = self.entries.popitem(last=False)
+                self.nbytes -= v.nbytes
+            self.entries[key] = value
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Return dictionary of cache usage counters."""
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self.entries),
+            nbytes=self.nbytes,
+            budget_bytes=self.budget_bytes
+        )
+
+def _page_cache_budget():
+    try:
+        return int(float(os.getenv('VOLSPY_PAGE_CACHE_MB', 256)) * 2**20)
+    except ValueError:
+        print('Invalid VOLSPY_PAGE_CACHE_MB "%s", using 256 instead' % os.getenv('VOLSPY_PAGE_CACHE_MB'))
+        return 256 * 2**20
+
+page_cache = ByteLRUCache(_page_cache_budget())
@@ -0,0 +1,282 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Chunked compressed volume store.
+
+A chunked volume is a directory holding a header.json file and one
+zlib-compressed brick file per chunk of a ZYXC image array.  The
+header records the array shape, axes, dtype, chunk shape, compression
+and micron_spacing metadata.  Each brick named like 0_3_2_0.zlib holds
+the C-order bytes of the chunk at that grid position, trimmed at the
+array bounds.
+
+The ChunkedLazyNDArray reader offers the same lazy view interface as
+util.TiffLazyNDArray, but reading a region of interest only decodes
+the bricks it intersects, rather than whole XY planes.  Decoded
+bricks are kept in the shared cache.page_cache.
+
+The convert() function and volspy-convert command write a chunked
+volume from any image readable by util.load_image, e.g. OME-TIFF or
+LSM, compressing bricks in a pool of worker processes.
+
+"""
+
+import itertools
+import json
+import os
+import pickle
+import sys
+import zlib
+from multiprocessing import Pool
+import numpy as np
+
+from .cache import page_cache
+from .lazy import LazyNDArray
+from .blocks import block_grid
+from . import util
+
+header_name = 'header.json'
+
+def is_chunked(path):
+    """Return True if path names a chunked volume directory."""
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, header_name))
+
+def brick_name(index):
+    return '%s.zlib' % '_'.join([ '%d' % i for i in index ])
+
+class ChunkedLazyNDArray (LazyNDArray):
+    """Lazy wrapper for chunked compressed volumes.
+
+       Supports the same slicing, lazyget, transpose and block
+       processing interface as TiffLazyNDArray, with axes ZYXC of
+       the stored array.  Bricks intersecting a read are decoded
+       concurrently by VOLSPY_IO_WORKERS threads.
+
+    """
+
+    def __init__(self, src, _output_plan=None):
+        """Wrap chunked volume given by directory name or existing ChunkedLazyNDArray."""
+        if isinstance(src, ChunkedLazyNDArray):
+            self.filename = src.filename
+            self.header = src.header
+            self.cache_key = src.cache_key
+        else:
+            self.filename = os.path.abspath(src)
+            hname = os.path.join(self.filename, header_name)
+            with open(hname, 'r') as f:
+                self.header = json.load(f)
+            # identify volume in shared page cache, so a rewritten volume with a new header is read again
+            self.cache_key = (self.filename,) + tuple(util.source_signature(hname))
+            assert self.header.get('format') == 'volspy-chunked', "%s is not a chunked volume" % src
+            assert self.header.get('compression') == 'zlib', "unsupported compression %s" % self.header.get('compression')
+
+        self.dtype = np.dtype(self.header['dtype'])
+        self.input_shape = tuple(self.header['shape'])
+        self.input_axes = self.header['axes']
+        self.chunk_shape = tuple(self.header['chunk_shape'])
+        self._init_output_plan(_output_plan)
+
+        if isinstance(src, ChunkedLazyNDArray):
+            if hasattr(src, 'micron_spacing'):
+                self.micron_spacing = src.micron_spacing
+        elif self.header.get('micron_spacing'):
+            self.micron_spacing = tuple(self.header['micron_spacing'])
+
+    def _read_brick(self, index):
+        """Return read-only brick array for chunk grid index, using shared page cache."""
+        key = (self.cache_key, index)
+        brick = page_cache.get(key)
+        if brick is not None:
+            return brick
+
+        shape = tuple([
+            min(n, s - i * n)
+            for i, n, s in zip(index, self.chunk_shape, self.input_shape)
+        ])
+        fname = os.path.join(self.filename, brick_name(index))
+        if os.path.exists(fname):
+            with open(fname, 'rb') as f:
+                brick = np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(shape)
+        else:
+            # bricks never written are treated as empty
+            brick = np.zeros(shape, dtype=self.dtype)
+            brick.flags.writeable = False
+        page_cache.put(key, brick)
+        return brick
+
+    def _read(self, output_plan, copy=True):
+        """Return ND-array for output_plan, decoding only intersecting bricks."""
+        buffer_plan = [
+            (in_axis, in_slice, out_slice)
+            for in_axis, in_slice, out_slice in output_plan
+            if in_slice is not None
+        ]
+        input_plan = list(buffer_plan)
+        input_plan.sort(key=lambda p: p[0])
+        assert len(input_plan) == len(self.input_shape)
+
+        buffer_shape = tuple([
+            out_slice.stop
+            for in_axis, in_slice, out_slice in input_plan
+            if isinstance(in_slice, slice)
+        ])
+        buffer_axes = [
+            in_axis
+            for in_axis, in_slice, out_slice in input_plan
+            if isinstance(in_slice, slice)
+        ]
+        buffer = np.empty(buffer_shape, self.dtype)
+
+        # per axis, list of (chunk index, brick slicing, buffer slicing or None)
+        axis_parts = []
+        for in_axis, in_slice, out_slice in input_plan:
+            n = self.chunk_shape[in_axis]
+            if isinstance(in_slice, int):
+                c = in_slice // n
+                axis_parts.append([ (c, in_slice - c * n, None) ])
+                continue
+            start, stop, step = in_slice.start, in_slice.stop, in_slice.step
+            parts = []
+            for c in range(start // n, (stop - 1) // n + 1):
+                c0 = c * n
+                c1 = min(c0 + n, stop)
+                # first selected element within chunk
+                first = start + ((max(c0, start) - start + step - 1) // step) * step
+                if first >= c1:
+                    continue
+                o0 = (first - start) // step
+                count = (c1 - first + step - 1) // step
+                parts.append((c, slice(first - c0, c1 - c0, step), slice(o0, o0 + count)))
+            axis_parts.append(parts)
+
+        io_slices = [
+            (
+                tuple([ p[0] for p in parts ]),
+                tuple([ p[1] for p in parts ]),
+                tuple([ p[2] for p in parts if p[2] is not None ])
+            )
+            for parts in itertools.product(*axis_parts)
+        ]
+
+        def read_brick(io):
+            index, brick_slice, out_slicing = io
+            buffer[out_slicing] = self._read_brick(index)[brick_slice]
+
+        workers = util.default_io_workers()
+        if workers > 1 and len(io_slices) > 1:
+            util.io_pool(workers).map(read_brick, io_slices, chunksize=1)
+        else:
+            for io in io_slices:
+                read_brick(io)
+
+        return self._transpose_buffer(buffer, buffer_axes, output_plan)
+
+def load_chunked(path):
+    """Load chunked volume, returning (data, metadata) with data in CZYX form like util.load_image."""
+    data = ChunkedLazyNDArray(path).transpose(3, 0, 1, 2)
+    try:
+        z_microns, y_microns, x_microns = data.micron_spacing
+        md = util.ImageMetadata(x_microns, y_microns, z_microns, data.axes)
+    except AttributeError as e:
+        print('got error %s fetching metadata during load_chunked' % e)
+        md = None
+    return data, md
+
+# per-process state of convert() worker processes
+_worker_state = None
+
+def _init_worker(payload):
+    global _worker_state
+    util.reset_process_state()
+    _worker_state = pickle.loads(payload)
+
+def _write_brick(task):
+    """Compress and write one brick, returning its compressed size."""
+    data, path, chunk_shape, level = _worker_state
+    core = task
+    index = tuple([ slc.start // n for slc, n in zip(core, chunk_shape) ])
+    brick = np.ascontiguousarray(data[core])
+    fname = os.path.join(path, brick_name(index))
+    with open(fname + '.tmp', 'wb') as f:
+        f.write(zlib.compress(brick.tobytes(), level))
+    os.rename(fname + '.tmp', fname)
+    return os.path.getsize(fname)
+
+def convert(data, path, chunk_shape=(64, 256, 256), workers=None, level=6):
+    """Write ZYXC ndarray or lazy array data as chunked volume directory path.
+
+       chunk_shape: ZYX brick size, with all channels in each brick
+       workers: number of worker processes (default VOLSPY_WORKERS)
+       level: zlib compression level
+
+       The header is written last, so an interrupted conversion does
+       not leave a readable volume behind.
+    """
+    global _worker_state
+    assert data.ndim == 4, "chunked volumes must have ZYXC axes"
+    chunk_shape = tuple(chunk_shape[0:3]) + (data.shape[3],)
+    if workers is None:
+        workers = util.default_workers()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    tasks = [ core for core, outer, inner in block_grid(data.shape, chunk_shape) ]
+    state = (data, path, chunk_shape, level)
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)), _init_worker, (pickle.dumps(state, pickle.HIGHEST_PROTOCOL),))
+        try:
+            nbytes = sum(pool.imap_unordered(_write_brick, tasks, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _worker_state = state
+        try:
+            nbytes = sum(map(_write_brick, tasks))
+        finally:
+            _worker_state = None
+
+    header = {
+        'format': 'volspy-chunked',
+        'version': 1,
+        'shape': list(data.shape),
+        'axes': 'ZYXC',
+        'dtype': np.dtype(data.dtype).str,
+        'chunk_shape': list(chunk_shape),
+        'compression': 'zlib',
+        'micron_spacing': hasattr(data, 'micron_spacing') and list(map(float, data.micron_spacing)) or None,
+    }
+    with open(os.path.join(path, header_name + '.tmp'), 'w') as f:
+        json.dump(header, f, indent=2)
+    os.rename(os.path.join(path, header_name + '.tmp'), os.path.join(path, header_name))
+    print("Wrote %d bricks of %s with %d compressed bytes to %s" % (len(tasks), chunk_shape, nbytes, path))
+
+def main(argv):
+    """Convert image file to chunked volume.
+
+       Usage: volspy-convert input output [Z,Y,X]
+
+       The optional Z,Y,X argument sets the brick size (default
+       64,256,256).  ZYX_IMAGE_GRID overrides the micron spacing
+       metadata of the input as for the viewer, and VOLSPY_WORKERS
+       sets the number of worker processes.
+    """
+    if len(argv) not in (3, 4):
+        sys.stderr.write(main.__doc__ + '\n')
+        return 1
+    chunk_shape = len(argv) > 3 and tuple(map(int, argv[3].split(','))) or (64, 256, 256)
+    assert len(chunk_shape) == 3, "brick size must have comma-separated Z,Y,X sizes"
+
+    I, meta = util.load_image(argv[1])
+    I = I.transpose(1, 2, 3, 0)
+    try:
+        voxel_size = tuple(map(float, os.getenv('ZYX_IMAGE_GRID').split(",")))
+        assert len(voxel_size) == 3
+        I.micron_spacing = voxel_size
+    except:
+        pass
+
+    convert(I, argv[2], chunk_shape)
+    return 0
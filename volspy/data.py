@@ -21,20 +21,50 @@ The ImageCropper also understands image file metadata returned by the
 image reader to configure voxel aspect ratio for a spatial
 interpretation of the volume data.
 
+With VIEW_PYRAMID=true, the ImageManager also maintains finer
+resolution levels between the ZYX_VIEW_GRID reduction and the source
+grid, and switches to the finest level fitting the texture budget as
+the view is zoomed in.
+
+Packed and normalized texture data is kept in a bounded LRU cache by
+resolution level and channel selection, so switching back to recently
+viewed channels or levels only costs a texture upload.
+
+In progressive mode, the ImageManager starts with a nearest-neighbour
+preview sampled from a few pages of the image, and refine_view()
+prepares the view grid data afterwards, e.g. in a background thread.
+
 """
 
 import os
+import tempfile
 import numpy as np
 import math
 
 from vispy import gloo
 
-from .util import load_and_mangle_image, bin_reduce
+from .cache import ByteLRUCache
+from .util import load_and_mangle_image, bin_reduce, cached_image_stats, pack_texture3d, view_cache_key
+from .stats import image_stats
 from .geometry import make_cube_clipped
+from .pyramid import ImagePyramid
 
 class ImageManager (object):
 
-    def __init__(self, filename, reform_data=None):
+    # bounds on strided preview shown first in progressive mode
+    preview_pages = 16
+    preview_voxels = 2**21
+
+    def __init__(self, filename, reform_data=None, progressive=False, max_texture_extent=None):
+        """Load image filename and prepare view data.
+
+           reform_data: optional function (I, meta, view_reduction)
+             returning data at the view grid, e.g. bin-averaged
+           progressive: start with a strided nearest-neighbour preview
+             of a few pages, deferring reform_data to refine_view()
+           max_texture_extent: maximum 3D texture width, limiting
+             pyramid levels chosen for zoomed views
+        """
         I, self.meta, self.slice_origin = load_and_mangle_image(filename)
 
         voxel_size = I.micron_spacing
@@ -50,17 +80,141 @@ class ImageManager (object):
         print("Using %s view reduction factor on %s image grid." % (view_reduction, voxel_size))
         print("Final %s micron view grid after reduction." % (tuple(map(lambda vs, r: vs*r, voxel_size, view_reduction)),))
 
-        if reform_data is not None:
-            I = reform_data(I, self.meta, view_reduction)
-
-        voxel_size = list(map(lambda a, b: a*b, voxel_size, view_reduction))
-        self.Zaspect = voxel_size[0] / voxel_size[2]
+        self.filename = filename
+        self.max_texture_extent = max_texture_extent
+        self.source_voxel_size = tuple(voxel_size)
+        self.view_reduction = view_reduction
+        self.cache_key = view_cache_key(self.slice_origin, I.shape, reform_data)
+        self.stats = dict()
+
+        if os.getenv('VIEW_PYRAMID', 'false').lower() == 'true':
+            self.pyramid = ImagePyramid(
+                I,
+                ImagePyramid.level_reductions(view_reduction),
+                filename,
+                self.cache_key,
+                # build every level like the view grid data
+                reform_data is not None and (lambda I, reduction: reform_data(I, self.meta, reduction)) or None
+            )
+            try:
+                self.pyramid_budget = float(os.getenv('VIEW_PYRAMID_BUDGET_MB', 512)) * 2**20
+            except ValueError:
+                print('Invalid VIEW_PYRAMID_BUDGET_MB "%s", using 512 instead' % os.getenv('VIEW_PYRAMID_BUDGET_MB'))
+                self.pyramid_budget = 512 * 2**20
+            print("Using %s pyramid levels with %d MiB texture budget." % (self.pyramid.reductions, self.pyramid_budget / 2**20))
+        else:
+            self.pyramid = None
+
+        strides = progressive and self.preview_strides(I.shape, view_reduction) or view_reduction
+        if strides != view_reduction:
+            # show preview now, leaving reform of whole image to refine_view()
+            self.preview_source = (I, reform_data)
+            self.view_shape = tuple([ n // r for n, r in zip(I.shape[0:3], view_reduction) ]) + I.shape[3:]
+            I = self.preview(I, strides)
+            self.stats[strides] = image_stats(I)
+            print("Using %s preview with %s strides until refined." % (I.shape, strides))
+        else:
+            self.preview_source = None
+            I = self._reform(I, reform_data)
+            self.view_shape = I.shape
 
         self.data = I
+        self.set_level(strides)
         self.last_channels = None
         self.channels = None
+        self.texture_buffer = None
+        # (level, channels) of data in texture_buffer
+        self.texture_buffer_key = None
+        try:
+            texture_cache_budget = int(float(os.getenv('VIEW_TEXTURE_CACHE_MB', 512)) * 2**20)
+        except ValueError:
+            print('Invalid VIEW_TEXTURE_CACHE_MB "%s", using 512 instead' % os.getenv('VIEW_TEXTURE_CACHE_MB'))
+            texture_cache_budget = 512 * 2**20
+        # packed texture data by (level, channels)
+        self.texture_cache = ByteLRUCache(texture_cache_budget)
         self.set_view()
 
+    def _reform(self, I, reform_data):
+        """Return view grid data for image I, registering it as base pyramid level."""
+        if reform_data is not None:
+            I = reform_data(I, self.meta, self.view_reduction)
+
+        if self.pyramid is not None:
+            if I.shape == self.pyramid.level_shape(self.view_reduction):
+                self.pyramid.set_level(self.view_reduction, I)
+            else:
+                print("Disabling pyramid for %s reformed data not matching %s view reduction." % (I.shape, self.view_reduction))
+                self.pyramid = None
+        return I
+
+    @classmethod
+    def preview_strides(cls, shape, view_reduction):
+        """Return ZYX strides for a preview of ZYXC shape within preview bounds.
+
+           The Z stride limits the preview to about preview_pages
+           planes, and the XY strides grow in powers of 2 beyond
+           view_reduction until the preview has at most
+           preview_voxels voxels per channel.
+        """
+        D, H, W = shape[0:3]
+        sz = max(view_reduction[0], -(-D // cls.preview_pages))
+        f = 1
+        while (D // sz) * (H // (view_reduction[1] * f)) * (W // (view_reduction[2] * f)) > cls.preview_voxels:
+            f *= 2
+        return (sz, view_reduction[1] * f, view_reduction[2] * f)
+
+    @staticmethod
+    def preview(I, strides):
+        """Return nearest-neighbour strided sample of ZYXC image I as an ndarray.
+
+           The X extent is trimmed to whole 16-pixel rows like the
+           full image.
+        """
+        nx = len(range(0, I.shape[2], strides[2]))
+        if nx > 16:
+            nx = nx // 16 * 16
+        return np.array(I[
+            slice(0, None, strides[0]),
+            slice(0, None, strides[1]),
+            slice(0, nx * strides[2], strides[2]),
+            slice(None)
+        ])
+
+    def refine_view(self, channels=None):
+        """Return (reduction, data, channels, payload) at the view grid after a progressive start.
+
+           Performs the reform_data deferred by the constructor and
+           packs texture data as prepare_view() would, without
+           changing the current view, so it can run in a background
+           thread.  The result is applied by commit_view().
+        """
+        I, reform_data = self.preview_source
+        I = self._reform(I, reform_data)
+        self.preview_source = None
+        channels = self._view_channels(channels, I)
+        return self.view_reduction, I, channels, self._texture_data(self.view_reduction, I, channels)
+
+    def set_level(self, reduction):
+        """Record current resolution level and update voxel aspect ratio."""
+        self.level = tuple(reduction)
+        voxel_size = list(map(lambda a, b: a*b, self.source_voxel_size, self.level))
+        self.Zaspect = voxel_size[0] / voxel_size[2]
+
+    def get_stats(self, level=None, data=None):
+        """Return per-channel ImageStats for level data, cached alongside the image file.
+
+           Defaults to the current level and data.
+        """
+        if level is None:
+            level, data = self.level, self.data
+        if level not in self.stats:
+            self.stats[level] = cached_image_stats(
+                data,
+                self.filename,
+                'stats-%s-%s.json' % (self.cache_key, 'x'.join(map(str, level)))
+            )
+        return self.stats[level]
+
     def min_pixel_step_size(self, outtexture=None):
         if outtexture is not None:
             D, H, W, C = outtexture.shape
@@ -71,24 +225,71 @@ class ImageManager (object):
 
         return 1./span
 
-    def set_view(self, anti_view=None, channels=None):
-        if anti_view is not None:
-            self.anti_view = anti_view
+    def _zoom_level(self, zoom, channels):
+        """Return (reduction, data) of resolution level for zoom, or current level if zoom is None."""
+        if zoom is None or self.pyramid is None:
+            return self.level, self.data
+        # choose resolution level for zoom
+        nc = channels is not None and len(channels) or min(self.data.shape[3], 4)
+        bps = self.data.dtype == np.uint8 and 1 or 2
+        reduction = self.pyramid.select(
+            self.view_reduction, zoom, self.pyramid_budget, nc * bps,
+            self.max_texture_extent, self.source_voxel_size
+        )
+        if reduction == self.level:
+            return self.level, self.data
+        return reduction, self.pyramid.get_level(reduction)
+
+    def _view_channels(self, channels, data):
+        """Return validated channels tuple for data, defaulting to direct mapping of up to 4 channels."""
         if channels is not None:
             # use caller-specified sequence of channels
             assert type(channels) is tuple
             assert len(channels) <= 4
-            self.channels = channels
         else:
             # default to first N channels u to 4 for RGBA direct mapping
-            self.channels = tuple(range(0, min(self.data.shape[3], 4)))
-        for c in self.channels:
+            channels = tuple(range(0, min(data.shape[3], 4)))
+        for c in channels:
             assert c >= 0
-            assert c < self.data.shape[3]
+            assert c < data.shape[3]
+        return channels
+
+    def _switch_level(self, reduction, data):
+        if reduction != self.level:
+            print("Switching from %s to %s resolution level." % (self.level, reduction))
+            self.data = data
+            self.set_level(reduction)
+            self.last_channels = None
+
+    def set_view(self, anti_view=None, channels=None, zoom=None):
+        if anti_view is not None:
+            self.anti_view = anti_view
+        self._switch_level(*self._zoom_level(zoom, channels))
+        self.channels = self._view_channels(channels, self.data)
 
-    def _get_texture3d_format(self):
-        I0 = self.data
-        nc = len(self.channels)
+    def prepare_view(self, channels=None, zoom=None):
+        """Return (reduction, data, channels, payload) with packed texture data for view settings.
+
+           Unlike set_view() and get_texture3d(), this does not change
+           the current view or touch OpenGL state, so it can run in a
+           background thread while the current texture is drawn.  The
+           result is applied by commit_view() once uploaded.
+        """
+        reduction, data = self._zoom_level(zoom, channels)
+        channels = self._view_channels(channels, data)
+        return reduction, data, channels, self._texture_data(reduction, data, channels)
+
+    def commit_view(self, reduction, data, channels):
+        """Make prepared view settings current, once their texture data is uploaded."""
+        self._switch_level(reduction, data)
+        self.channels = channels
+        self.last_channels = channels
+
+    def _get_texture3d_format(self, channels=None, data=None):
+        if data is None:
+            channels, data = self.channels, self.data
+        I0 = data
+        nc = len(channels)
 
         if I0.dtype == np.uint8:
             bps = 1
@@ -115,6 +316,33 @@ class ImageManager (object):
             (4,4): ('rgba', 'rgba16f')
         }[(nc, bps)]
 
+    def _texture_payload(self, shape, dtype):
+        """Return the reused staging buffer to pack texture data of shape and dtype into.
+
+           The payload already in the staging buffer is first copied
+           into the texture cache if it fits the budget, in RAM or in
+           an anonymous temporary file under VIEW_TEXTURE_CACHE_DIR.
+           So cache entries only take memory once another channel
+           selection or level is packed.
+        """
+        tmpout = self.texture_buffer
+        if self.texture_buffer_key is not None and tmpout.nbytes <= self.texture_cache.budget_bytes:
+            cache_dir = os.getenv('VIEW_TEXTURE_CACHE_DIR')
+            if cache_dir:
+                # file is unlinked already and freed with the last mapping
+                entry = np.memmap(tempfile.TemporaryFile(dir=cache_dir), dtype=tmpout.dtype, mode='w+', shape=tmpout.shape)
+                entry[...] = tmpout
+            else:
+                entry = tmpout.copy()
+            self.texture_cache.put(self.texture_buffer_key, entry)
+        self.texture_buffer_key = None
+
+        if tmpout is None or tmpout.shape != shape or tmpout.dtype != dtype:
+            # release old buffer before allocating its replacement
+            tmpout = self.texture_buffer = None
+            tmpout = self.texture_buffer = np.empty(shape, dtype=dtype)
+        return tmpout
+
     def get_texture3d(self, outtexture=None):
         """Pack N-channel image data into R, RG, RGB, RGBA Texture3D using self.channels projection.
 
@@ -124,43 +352,64 @@ class ImageManager (object):
 
            sets data in outtexture and returns the texture.
         """
-        I0 = self.data
-
-        # choose size for texture data
-        D, H, W = self.data.shape[0:3]
-        C = len(self.channels)
-
         if outtexture is None:
-            format, internalformat = self._get_texture3d_format()
-            print('allocating texture3D', (D, H, W, C), internalformat)
-            outtexture = gloo.Texture3D(shape=(D, H, W, C), format=format, internalformat=internalformat)
+            outtexture = self.new_texture3d()
         elif self.last_channels == self.channels:
             print('reusing texture')
             return outtexture
         else:
             print('regenerating texture')
 
-        print((D, H, W, C), '<-', I0.shape, list(self.channels), I0.dtype)
+        tmpout = self._texture_data(self.level, self.data, self.channels)
+        self.last_channels = self.channels
+        outtexture.set_data(tmpout)
+        return outtexture
+
+    def new_texture3d(self, channels=None, data=None):
+        """Allocate empty Texture3D for channels of data, defaulting to the current view."""
+        if data is None:
+            channels, data = self.channels, self.data
+        D, H, W = data.shape[0:3]
+        C = len(channels)
+        format, internalformat = self._get_texture3d_format(channels, data)
+        print('allocating texture3D', (D, H, W, C), internalformat)
+        return gloo.Texture3D(shape=(D, H, W, C), format=format, internalformat=internalformat)
+
+    def _texture_data(self, level, data, channels):
+        """Return packed texture data for channels of level data, using the texture cache."""
+        I0 = data
+        D, H, W = data.shape[0:3]
+        C = len(channels)
+
+        key = (level, channels)
+        if key == self.texture_buffer_key:
+            print('using staged texture data for channels %s' % (channels,))
+            return self.texture_buffer
+        tmpout = self.texture_cache.get(key)
+        if tmpout is not None:
+            print('using cached texture data for channels %s' % (channels,))
+            return tmpout
+
+        print((D, H, W, C), '<-', I0.shape, list(channels), I0.dtype)
 
         # normalize for OpenGL [0,1.0] or [0,2**N-1] and zero black-level
-        maxval = I0.max()
-        minval = I0.min()
+        stats = self.get_stats(level, data)
+        maxval = float(stats.max.max())
+        minval = float(stats.min.min())
         scale = 1.0/(float(maxval) - float(minval))
         if I0.dtype == np.uint8 or I0.dtype == np.int8:
-            tmpout = np.zeros((D, H, W, C), dtype=np.uint8)
+            dtype = np.uint8
             scale *= float(2**8-1)
         else:
             assert I0.dtype == np.float16 or I0.dtype == np.float32 or I0.dtype == np.uint16 or I0.dtype == np.int16
-            tmpout = np.zeros((D, H, W, C), dtype=np.uint16 )
+            dtype = np.uint16
             scale *= (2.0**16-1)
 
-        # pack selected channels into texture
-        for i in range(C):
-            tmpout[:,:,:,i] = (I0[:,:,:,self.channels[i]].astype(np.float32) - minval) * scale
-
-        self.last_channels = self.channels
-        outtexture.set_data(tmpout)
-        return outtexture
+        tmpout = self._texture_payload((D, H, W, C), dtype)
+        # pack selected channels into texture, one slab at a time
+        pack_texture3d(I0, channels, tmpout, minval, scale)
+        self.texture_buffer_key = key
+        return tmpout
 
     def make_cube_clipped(self, dataplane=None):
         """Generate cube clipped against plane equation 4-tuple.
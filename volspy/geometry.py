@@ -34,93 +34,30 @@ import numpy as np
 
 from vispy.geometry import create_cube
 
-from .util import plane_distance
 
-
-def make_cube_clipped(shape, Zaspect, zoom, plane=None):
-    """Generate cube clipped against plane equation 4-tuple (A,B,C,D).
-
-       Excludes semi-space beneath plane, i.e. with negative plane
-       distance.  Omitting plane produces regular unclipped cube. The
-       clipped cube may have zero corners and edges if it falls
-       completely beneath the plane.
-
-       Returns (vertices, faces, cutfaces):
-         -- vertices is an array suitable for use as a vertex buffer
-         -- faces is an array of triangle-strip vertex indices
-         -- cutfaces is an array of triangle-strip vertex indices
-
-       The cutfaces triangle strip is a subset of the faces triangle
-       strip that only includes the face embedded within the clipping
-       plane (if any).
+# in CCW winding
+# corners, then edge-cuts (half-step ahead)
+_cube_quads = [
+    ( ( 0, 3, 2, 1 ), ( 11, 10,  9,  8 ) ),  # back
+    ( ( 4, 5, 6, 7 ), ( 12, 13, 14, 15 ) ), # front
+    ( ( 5, 1, 2, 6 ), ( 16,  9, 17, 13 ) ),  # right
+    ( ( 0, 4, 7, 3 ), ( 19, 15, 18, 11 ) ), # left
+    ( ( 0, 1, 5, 4 ), (  8, 16, 12, 19 ) ), # bottom
+    ( ( 2, 3, 7, 6 ), ( 10, 18, 14, 17 ) )   # top
+    ]
+
+def _clip_case(cubeclipped):
+    """Return clipped cube topology for set of clipped corner indices.
+
+       Returns (faces, cutfaces, cutpoints):
+         -- faces is a list of triangle vertex indices
+         -- cutfaces is the list of cut-face triangle vertex indices
+         -- cutpoints is a list of (v1, cut, v2) edge-cut vertices
+            to interpolate between corners v1 and v2
+
+       The topology only depends on which corners are clipped, so
+       make_cube_clipped() looks it up in _case_table.
     """
-    # shape is number of voxels in each dimension
-    D, H, W = shape
-
-    # span is max length in XY pixel units, correcting for Zaspect
-    # (X:Y must have 1:1 aspect, Zaspect is Z:X ratio)
-    span = float(max(W,H,D*Zaspect))
-
-    # fit shape into unit cube centered on origin w/ zoom 1.0
-    # zoom allows caller to shrink or grow unit cube
-
-    # make box to outline volumetric image region
-
-    # actual box shape
-    bW = zoom * W/span
-    bH = zoom * H/span
-    bD = zoom * D/span * Zaspect
-
-    # halved box shape for portion of box in each octant
-    hW = bW/2.
-    hH = bH/2.
-    hD = bD/2.
-
-    cube_verts = np.zeros(20, dtype=[ 
-                ('position', np.float32, 3), 
-                ('color', np.float32, 4) 
-                ])
-    
-    X = 5 # dummy value to be reset by clipping
-    cube_verts['position'] = np.array(
-        [
-            [ -hW, -hH, -hD ], [ hW, -hH, -hD ], [ hW, hH, -hD ], [ -hW, hH, -hD ], # back corners
-            [ -hW, -hH,  hD ], [ hW, -hH,  hD ], [ hW, hH,  hD ], [ -hW, hH,  hD ], # front corners
-            [ X, X,  X ], [  X, X,  X ], [  X,  X,  X ], [ X,  X,  X ], # back edge-cuts
-            [ X, X,  X ], [  X, X,  X ], [  X,  X,  X ], [ X,  X,  X ], # front edge-cuts
-            [ X, X,  X ], [  X, X,  X ], [  X,  X,  X ], [ X,  X,  X ]  # middle edge-cuts
-            ]
-        )
-
-    # colormap cube for regular 8 corners
-    for i in range(8):
-        for axis in range(3):
-            if cube_verts['position'][i,axis] > 0.:
-                cube_verts['color'][i,axis] = 1.0
-            else:
-                cube_verts['color'][i,axis] = 0.0
-        cube_verts['color'][i, 3] = 1.0
-
-    # in CCW winding
-    # corners, then edge-cuts (half-step ahead)
-    cube_quads = [
-        ( ( 0, 3, 2, 1 ), ( 11, 10,  9,  8 ) ),  # back
-        ( ( 4, 5, 6, 7 ), ( 12, 13, 14, 15 ) ), # front
-        ( ( 5, 1, 2, 6 ), ( 16,  9, 17, 13 ) ),  # right
-        ( ( 0, 4, 7, 3 ), ( 19, 15, 18, 11 ) ), # left
-        ( ( 0, 1, 5, 4 ), (  8, 16, 12, 19 ) ), # bottom
-        ( ( 2, 3, 7, 6 ), ( 10, 18, 14, 17 ) )   # top
-        ]
-
-    # check each cube corner against clip plane
-    corner_clipped = [ 
-        # plane is None means no clipping
-        plane is not None and plane_distance( c, plane ) > 0.
-        for c in cube_verts['position'][0:8]
-        ]
-
-    cubeclipped = set([ i for i in range(8) if corner_clipped[i] ])
-
     face_triangles = []
     cutface_triangles = []
     face_cutpoint_lists = []
@@ -159,23 +96,6 @@ def make_cube_clipped(shape, Zaspect, zoom, plane=None):
             for cp in edge_cutpoints(face[i], cuts[i], rolled[i]):
                 yield cp
 
-    def cutpoint_solve(v1, cut, v2):
-        # update geometry and colormap
-        p1 = cube_verts['position'][v1]
-        p2 = cube_verts['position'][v2]
-        c1 = cube_verts['color'][v1]
-        c2 = cube_verts['color'][v2]
-
-        # find cutpoint bisection of edge
-        d1 = abs(plane_distance(p1, plane))
-        d2 = abs(plane_distance(p2, plane))
-        cutratio = d1 / (d1 + d2)
-
-        # interpolate cutpoint position and color
-        cube_verts['position'][cut] = p1 + (p2 - p1) * cutratio
-        cube_verts['color'][cut][0:3] = c1[0:3] + (c2[0:3] - c1[0:3]) * cutratio
-        cube_verts['color'][cut][3] = 1.0
-
     def build_polygon(outline):
         # tesselate one polygon in CCW winding order
         mode = len(outline)
@@ -207,7 +127,7 @@ def make_cube_clipped(shape, Zaspect, zoom, plane=None):
         else:
             raise ValueError('%d vertex polygon %s not supported' % (mode, outline))
 
-    for face, cuts in cube_quads:
+    for face, cuts in _cube_quads:
         outline = list(outline_clip(face, cuts))
         build_polygon( outline )
         cplist = list(outline_cutpoints(face, cuts))
@@ -221,12 +141,13 @@ def make_cube_clipped(shape, Zaspect, zoom, plane=None):
             assert len(cplist) == 2
             face_cutpoint_lists.append( cplist )
         
-    # update cutpoint geometry where needed
+    # cutpoint geometry needed, in order of first use
+    cutpoints = []
     cutpoints_done = set()
     for cplist in face_cutpoint_lists:
         for v1, cut, v2 in cplist:
             if cut not in cutpoints_done:
-                cutpoint_solve(v1, cut, v2)
+                cutpoints.append((v1, cut, v2))
                 cutpoints_done.add(cut)
 
     # generate final cut-face 
@@ -254,11 +175,7 @@ def make_cube_clipped(shape, Zaspect, zoom, plane=None):
 
         while True:
             prev = outline[-1]
-            try:
-                next = next_corner[prev]
-            except KeyError:
-                #print sides, outline, next_corner
-                raise
+            next = next_corner[prev]
             if next in outline:
                 break
             else:
@@ -267,10 +184,129 @@ def make_cube_clipped(shape, Zaspect, zoom, plane=None):
         build_polygon(outline)
 
         cutface_triangles.extend( face_triangles[prev_top:] )
+
+    return face_triangles, cutface_triangles, cutpoints
+
+def _build_case_table():
+    """Return 256-entry list of clipped cube topology by corner clipping bitmask.
+
+       Bit i of the case index is set when corner i is clipped.
+       Entries are (faces, cutfaces, v1s, cuts, v2s) arrays, or None
+       for corner patterns no plane can produce.
+    """
+    table = []
+    for case in range(256):
+        try:
+            faces, cutfaces, cutpoints = _clip_case(set([ i for i in range(8) if case & (1 << i) ]))
+        except (ValueError, KeyError, AssertionError):
+            table.append(None)
+            continue
+        cutpoints = np.array(cutpoints, dtype=np.intp).reshape((len(cutpoints), 3))
+        table.append((
+            np.array(faces, dtype=np.uint32),
+            np.array(cutfaces, dtype=np.uint32),
+            cutpoints[:,0], cutpoints[:,1], cutpoints[:,2]
+        ))
+    return table
+
+_case_table = _build_case_table()
+
+# bit weight of each corner in case index
+_corner_bits = np.array([ 1 << i for i in range(8) ])
+
+def make_cube_clipped(shape, Zaspect, zoom, plane=None):
+    """Generate cube clipped against plane equation 4-tuple (A,B,C,D).
+
+       Excludes semi-space beneath plane, i.e. with negative plane
+       distance.  Omitting plane produces regular unclipped cube. The
+       clipped cube may have zero corners and edges if it falls
+       completely beneath the plane.
+
+       Returns (vertices, faces, cutfaces):
+         -- vertices is an array suitable for use as a vertex buffer
+         -- faces is an array of triangle-strip vertex indices
+         -- cutfaces is an array of triangle-strip vertex indices
+
+       The cutfaces triangle strip is a subset of the faces triangle
+       strip that only includes the face embedded within the clipping
+       plane (if any).
+
+       The face topology for each pattern of clipped corners comes
+       from a precomputed case table, so each call only computes
+       corner distances and interpolates the edge cuts.
+    """
+    # shape is number of voxels in each dimension
+    D, H, W = shape
+
+    # span is max length in XY pixel units, correcting for Zaspect
+    # (X:Y must have 1:1 aspect, Zaspect is Z:X ratio)
+    span = float(max(W,H,D*Zaspect))
+
+    # fit shape into unit cube centered on origin w/ zoom 1.0
+    # zoom allows caller to shrink or grow unit cube
+
+    # make box to outline volumetric image region
+
+    # actual box shape
+    bW = zoom * W/span
+    bH = zoom * H/span
+    bD = zoom * D/span * Zaspect
+
+    # halved box shape for portion of box in each octant
+    hW = bW/2.
+    hH = bH/2.
+    hD = bD/2.
+
+    cube_verts = np.zeros(20, dtype=[ 
+                ('position', np.float32, 3), 
+                ('color', np.float32, 4) 
+                ])
     
-    try:
-        return cube_verts, np.array(face_triangles, dtype=np.uint32), np.array(cutface_triangles, dtype=np.uint32)
-    except:
-        print(face_triangles, cutface_triangles)
-        raise
+    X = 5 # dummy value to be reset by clipping
+    cube_verts['position'] = np.array(
+        [
+            [ -hW, -hH, -hD ], [ hW, -hH, -hD ], [ hW, hH, -hD ], [ -hW, hH, -hD ], # back corners
+            [ -hW, -hH,  hD ], [ hW, -hH,  hD ], [ hW, hH,  hD ], [ -hW, hH,  hD ], # front corners
+            [ X, X,  X ], [  X, X,  X ], [  X,  X,  X ], [ X,  X,  X ], # back edge-cuts
+            [ X, X,  X ], [  X, X,  X ], [  X,  X,  X ], [ X,  X,  X ], # front edge-cuts
+            [ X, X,  X ], [  X, X,  X ], [  X,  X,  X ], [ X,  X,  X ]  # middle edge-cuts
+            ]
+        )
+    position = cube_verts['position']
+    color = cube_verts['color']
 
+    # colormap cube for regular 8 corners
+    color[0:8,0:3] = position[0:8] > 0.
+    color[0:8,3] = 1.0
+
+    if plane is None:
+        # no clipping
+        case = 0
+    else:
+        # check each cube corner against clip plane
+        A, B, C, Dp = plane
+        corners = position[0:8]
+        distance = A*corners[:,0] + B*corners[:,1] + C*corners[:,2] + Dp
+        case = int(np.dot(distance > 0., _corner_bits))
+
+    entry = _case_table[case]
+    if entry is None:
+        raise ValueError('corner clipping pattern %d not produced by a plane' % case)
+    face_triangles, cutface_triangles, v1, cut, v2 = entry
+
+    if len(cut):
+        # find cutpoint bisection of edges
+        d1 = abs(distance[v1])
+        d2 = abs(distance[v2])
+        cutratio = (d1 / (d1 + d2))[:,None]
+
+        # interpolate cutpoint positions and colors
+        p1 = position[v1]
+        p2 = position[v2]
+        c1 = color[v1,0:3]
+        c2 = color[v2,0:3]
+        position[cut] = p1 + (p2 - p1) * cutratio
+        color[cut,0:3] = c1 + (c2 - c1) * cutratio
+        color[cut,3] = 1.0
+
+    return cube_verts, face_triangles.copy(), cutface_triangles.copy()
@@ -0,0 +1,303 @@
+#
+# Copyright 2014-2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Lazy ND-array views of large on-disk images.
+
+The LazyNDArray base class implements the view logic shared by lazy
+image readers such as util.TiffLazyNDArray and
+chunked.ChunkedLazyNDArray: slicing, integer projection, fake axis
+insertion and transposition are recorded in an output plan against
+the full stored array, and only performed when data is actually read.
+
+Each output plan entry is a tuple (in_axis, in_slice, out_slice):
+
+  in_axis: axis of stored array, or None for a fake axis
+
+  in_slice: slice of stored axis, integer index for a projected
+    axis, or None for a fake axis
+
+  out_slice: extent of output axis, or None for a projected axis
+
+Subclasses set input_shape, input_axes and dtype and implement
+_read(output_plan, copy), returning an ND-array for a plan of whole
+stored dimensions in input axis order, and _derive(output_plan),
+returning a new view of the same source.
+
+The ArrayLazyNDArray subclass gives an existing ND-array or memmap the
+same interface, e.g. for memory-mapped .npy files.
+
+"""
+
+import hashlib
+from functools import reduce
+import numpy as np
+from tifffile import lazyattr
+
+class LazyNDArray (object):
+
+    def _init_output_plan(self, _output_plan=None):
+        if _output_plan:
+            self.output_plan = _output_plan
+        else:
+            self.output_plan = [
+                (a, slice(0, self.input_shape[a], 1), slice(0, self.input_shape[a], 1))
+                for a in range(len(self.input_shape))
+            ]
+
+    def _derive(self, output_plan):
+        return type(self)(self, output_plan)
+
+    def _plan_slicing(self, key):
+        assert isinstance(key, tuple)
+        output_plan = [
+            (in_axis, in_slice, out_slice)
+            for in_axis, in_slice, out_slice in self.output_plan
+            if out_slice is None and in_slice is not None
+        ]
+
+        current_plan = [ # FIFO of dimensions projected by key
+            (in_axis, in_slice, out_slice)
+            for in_axis, in_slice, out_slice in self.output_plan
+            if out_slice is not None
+        ]
+        
+        for elem in key:
+            if elem is None:
+                # inject fake output dimension
+                in_axis = None
+                out_slice = slice(0,1,1)
+                in_slice = None
+            else:
+                in_axis, in_slice, out_slice = current_plan.pop(0)
+                if isinstance(elem, int):
+                    # collapse projected dimension
+                    if elem < 0:
+                        elem += out_slice.stop
+                    if elem >= out_slice.stop or elem < 0:
+                        raise IndexError('index %d out of range [0,%d)' % (elem, out_slice.stop))
+                    if isinstance(in_slice, slice):
+                        in_slice = in_slice.start + elem * in_slice.step
+                    else:
+                        continue
+                    out_slice = None
+                elif isinstance(elem, slice):
+                    # modify sliced dimension
+                    if elem.step is None:
+                        step = 1
+                    else:
+                        step = elem.step
+                    assert step > 0, "only positive stepping is supported"
+                    if elem.start is None:
+                        start = 0
+                    elif elem.start < 0:
+                        start = elem.start + out_slice.stop
+                    else:
+                        start = elem.start
+                    if elem.stop is None:
+                        stop = out_slice.stop
+                    elif elem.stop < 0:
+                        stop = elem.stop + out_slice.stop
+                    else:
+                        stop = elem.stop
+                    start = max(min(start, out_slice.stop), 0)
+                    stop = max(min(stop, out_slice.stop), 0)
+                    assert start < stop, "empty slicing not supported"
+                    if isinstance(in_slice, slice):
+                        # output positions map to every in_slice.step stored elements
+                        in_slice = slice(
+                            in_slice.start + start * in_slice.step,
+                            min(in_slice.start + stop * in_slice.step, in_slice.stop),
+                            in_slice.step * step
+                        )
+                        w = in_slice.stop - in_slice.start
+                        w = w//in_slice.step + (w%in_slice.step and 1 or 0)
+                        out_slice = slice(0,w,1)
+                    else:
+                        in_slice = None
+                        out_slice = slice(0,1,1)
+            output_plan.append((in_axis, in_slice, out_slice))
+
+        assert not current_plan, "slicing key must project all image dimensions"
+            
+        return output_plan
+            
+    def __getitem__(self, key):
+        return self._read(self._plan_slicing(key))
+
+    def _transpose_buffer(self, buffer, buffer_axes, output_plan):
+        # apply current transposition to buffered dimensions
+        buffer_axis = dict([(buffer_axes[d], d) for d in range(len(buffer_axes))])
+        transposition = [
+            buffer_axis[in_axis]
+            for in_axis, in_slice, out_slice in output_plan
+            if isinstance(in_slice, slice)
+        ]
+        buffer = buffer.transpose(tuple(transposition))
+        
+        out_slicing = [
+            in_slice is not None and out_slice or in_slice
+            for in_axis, in_slice, out_slice in output_plan
+            if isinstance(in_slice, slice) or in_slice is None
+        ]
+        return buffer[tuple(out_slicing)]
+        
+    def transpose(self, *transposition):
+        output_plan = [
+            (in_axis, in_slice, out_slice)
+            for in_axis, in_slice, out_slice in self.output_plan
+            if out_slice is None
+        ]
+        current_plan = [ # FIFO of dimensions projected by key
+            (in_axis, in_slice, out_slice)
+            for in_axis, in_slice, out_slice in self.output_plan
+            if out_slice is not None
+        ]
+
+        for d in transposition:
+            assert current_plan[d] is not None, "transpose cannot repeat same dimension"
+            p = current_plan[d]
+            current_plan[d] = None
+            output_plan.append(p)
+
+        assert len([p for p in current_plan if p is not None]) == 0, "transpose must include dimensions"
+        return self._derive(output_plan)
+
+    def iter_blocks(self, block_shape, halo=0):
+        """Generate (core, inner, block) for blocks of this view, see blocks.iter_blocks()."""
+        from .blocks import iter_blocks
+        return iter_blocks(self, block_shape, halo)
+
+    def map_blocks(self, func, block_shape, halo=0, workers=None, out=None, dtype=None):
+        """Apply func to blocks of this view in worker processes, see blocks.map_blocks()."""
+        from .blocks import map_blocks
+        return map_blocks(func, self, block_shape, halo, workers, out, dtype)
+
+    def lazyget(self, key):
+        output_plan = self._plan_slicing(key)
+        return self._derive(output_plan)
+
+    def force(self):
+        """Return whole array, possibly as a read-only view of underlying storage."""
+        return self._read(self._plan_slicing(tuple(slice(None) for d in self.shape)), copy=False)
+    
+    @property
+    def ndim(self):
+        return len([p for p in self.output_plan if p[2] is not None])
+    
+    @property
+    def shape(self):
+        return tuple(p[2].stop for p in self.output_plan if p[2] is not None)
+
+    @property
+    def axes(self):
+        return ''.join(p[0] is not None and self.input_axes[p[0]] or 'Q' for p in self.output_plan if p[2] is not None)
+
+    @property
+    def strides(self):
+        plan = [(p[0], p[2].stop) for p in self.output_plan if p[2] is not None]
+        plan = [(i,) + plan[i] for i in range(len(plan))]
+        plan.sort(key=lambda p: p[1])
+        strides = []
+        for i in range(len(plan)):
+            strides.append((plan[i][0], reduce(lambda a, b: a*b, [p[2] for p in plan[i+1:]], 1)))
+        strides.sort(key=lambda p: p[0])
+        strides = [p[1] for p in strides]
+        return strides
+        
+    def _view_key(self):
+        """Return string identifying this view of the source in sidecar file names."""
+        return repr([ (p[0], p[1], p[2]) for p in self.output_plan ])
+
+    @lazyattr
+    def stats(self):
+        """Per-channel ImageStats of this view, cached alongside the file.
+
+           A 'C' axis, if present, is treated as channels and all other
+           axes are summarized together.
+        """
+        if 'C' in self.axes:
+            c = self.axes.index('C')
+            data = self.transpose(*([ d for d in range(self.ndim) if d != c ] + [ c ]))
+        else:
+            data = self
+        # identify this view of the file in sidecar name
+        key = data._view_key()
+        from .util import cached_image_stats
+        return cached_image_stats(
+            data,
+            self.filename,
+            'stats-%s.json' % hashlib.md5(key.encode('utf-8')).hexdigest()[0:12],
+            'C' in self.axes
+        )
+
+    @lazyattr
+    def min_max(self):
+        return (float(self.stats.min.min()), float(self.stats.max.max()))
+
+    def max(self):
+        return self.min_max[1]
+            
+    def min(self):
+        return self.min_max[0]
+
+class ArrayLazyNDArray (LazyNDArray):
+    """Lazy view of an existing ND-array or memmap with named axes.
+
+       Reads slice the wrapped array directly, so force() and other
+       reads with copy=False return views without copying, e.g. of a
+       memory-mapped .npy file.  Views of file-backed memmaps pickle
+       by filename and offset rather than by content.
+
+    """
+
+    def __init__(self, src, axes=None, _output_plan=None):
+        """Wrap ndarray src with axes string, or derive view from existing ArrayLazyNDArray."""
+        if isinstance(src, ArrayLazyNDArray):
+            self.array = src.array
+            self.filename = src.filename
+            axes = src.input_axes
+        else:
+            assert axes is not None and len(axes) == src.ndim, "axes %r do not match array shape %s" % (axes, src.shape)
+            self.array = src
+            self.filename = getattr(src, 'filename', None)
+        self.dtype = self.array.dtype.newbyteorder('=')
+        self.input_shape = self.array.shape
+        self.input_axes = axes
+        self._init_output_plan(_output_plan)
+
+        if isinstance(src, ArrayLazyNDArray) and hasattr(src, 'micron_spacing'):
+            self.micron_spacing = src.micron_spacing
+
+    def _derive(self, output_plan):
+        return ArrayLazyNDArray(self, None, output_plan)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if isinstance(self.array, np.memmap) and self.array.filename is not None:
+            state['array'] = (
+                self.array.filename,
+                self.array.dtype.str,
+                self.array.shape,
+                self.array.offset,
+                self.array.flags.f_contiguous and not self.array.flags.c_contiguous and 'F' or 'C'
+            )
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.array, tuple):
+            filename, dtype, shape, offset, order = self.array
+            self.array = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape, order=order)
+
+    def _read(self, output_plan, copy=True):
+        """Return ND-array for output_plan, as a view of the wrapped array if copy=False."""
+        input_plan = [ p for p in output_plan if p[1] is not None ]
+        input_plan.sort(key=lambda p: p[0])
+        assert len(input_plan) == len(self.input_shape)
+        buffer = self.array[tuple([ p[1] for p in input_plan ])]
+        buffer_axes = [ p[0] for p in input_plan if isinstance(p[1], slice) ]
+        if copy:
+            buffer = np.array(buffer, dtype=self.dtype)
+        return self._transpose_buffer(buffer, buffer_axes, output_plan)
@@ -0,0 +1,221 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Multi-resolution image pyramid support.
+
+An ImagePyramid holds several bin-averaged resolution levels of one
+ZYXC source image.  Each level is identified by its ZYX reduction
+factors relative to the source grid, e.g. (1, 4, 4) for 4x4 XY
+bin-averaging.  Levels are built on demand with bin_reduce, or with
+a caller's reform function applied to the source, and persisted as
+.npy files alongside the source image file, so that they can be
+memory-mapped in later sessions instead of being recomputed.  A JSON
+stamp next to each .npy file records the size and mtime of the source
+file it was built from.
+
+"""
+
+import json
+import os
+import numpy as np
+
+from .util import bin_reduce_streaming, sidecar_filename, source_signature
+
+class ImagePyramid (object):
+
+    def __init__(self, source, reductions, filename=None, cache_key='', reform=None):
+        """Wrap ZYXC source data to provide levels for given ZYX reductions.
+
+           source: ZYXC ndarray or lazy array at full resolution
+           reductions: sequence of ZYX reduction 3-tuples
+           filename: source file name to locate on-disk cache or None
+           cache_key: string distinguishing different ROIs, reform
+             functions and pre-processing of same file
+           reform: optional function (source, reduction) returning
+             level data, instead of bin-averaging the source
+        """
+        self.source = source
+        self.reform = reform
+        self.reductions = sorted(set(reductions), key=lambda r: (r[0]*r[1]*r[2], r))
+        self.filename = filename
+        self.cache_key = cache_key
+        self.levels = dict()
+
+    @staticmethod
+    def level_reductions(view_reduction):
+        """Return ZYX reductions from view_reduction down to full resolution.
+
+           Each finer level halves the reduction of the previous one
+           along each axis, i.e. factors (1, 2, 4, ...) relative to
+           the source are capped by view_reduction per axis.
+        """
+        reductions = [ tuple(view_reduction) ]
+        f = max(view_reduction)
+        while f > 1:
+            f = (f + 1) // 2
+            reductions.append(tuple([ min(r, f) for r in view_reduction ]))
+        return reductions
+
+    def level_shape(self, reduction):
+        return tuple([ n // r for n, r in zip(self.source.shape[0:3], reduction) ]) + self.source.shape[3:]
+
+    def set_level(self, reduction, data):
+        """Register existing data for level, e.g. as prepared by caller."""
+        assert data.shape == self.level_shape(reduction)
+        self.levels[tuple(reduction)] = data
+
+    def _cache_filename(self, reduction):
+        return sidecar_filename(
+            self.filename,
+            'pyramid-%s-%s.npy' % (self.cache_key, 'x'.join(map(str, reduction)))
+        )
+
+    def _stamp_filename(self, reduction):
+        return self._cache_filename(reduction) + '.json'
+
+    def _cache_is_fresh(self, reduction):
+        """Return True if level cache file was stamped with current source size and mtime."""
+        try:
+            with open(self._stamp_filename(reduction), 'r') as f:
+                doc = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        return doc.get('source') is not None and doc.get('source') == source_signature(self.filename) \
+            and os.path.exists(self._cache_filename(reduction))
+
+    def _stamp_cache(self, reduction, source):
+        """Record source signature for level cache file, ignoring unwritable locations."""
+        stamp_fname = self._stamp_filename(reduction)
+        tmp_fname = '%s.%d.tmp' % (stamp_fname, os.getpid())
+        try:
+            with open(tmp_fname, 'w') as f:
+                json.dump({'source': source}, f)
+            os.rename(tmp_fname, stamp_fname)
+        except (IOError, OSError) as e:
+            print('cannot write pyramid cache stamp %s: %s' % (stamp_fname, e))
+
+    @staticmethod
+    def _store(out, data, slab_bytes=64*2**20):
+        """Copy ndarray or lazy array data into out, one Z slab at a time."""
+        step = max(slab_bytes // max(out[0:1].nbytes, 1), 1)
+        rest = tuple([ slice(None) for n in data.shape[1:] ])
+        for z0 in range(0, data.shape[0], step):
+            z1 = min(z0 + step, data.shape[0])
+            out[z0:z1] = data[(slice(z0, z1),) + rest]
+        return out
+
+    def _build(self, reduction, out=None):
+        """Return level data for reduction computed from source, into out if given."""
+        if self.reform is not None:
+            data = self.reform(self.source, reduction)
+            if out is not None:
+                return self._store(out, data)
+            return data
+        if reduction == (1, 1, 1):
+            return self.source
+        return bin_reduce_streaming(self.source, reduction + (1,), out=out)
+
+    def get_level(self, reduction):
+        """Return level data for reduction, building and caching it if necessary."""
+        reduction = tuple(reduction)
+        if reduction in self.levels:
+            return self.levels[reduction]
+
+        if reduction == (1, 1, 1) and self.reform is None:
+            data = self.source
+        else:
+            data = None
+            shape = self.level_shape(reduction)
+            cache_fname = self.filename and self._cache_filename(reduction)
+
+            if cache_fname and self._cache_is_fresh(reduction):
+                try:
+                    data = np.load(cache_fname, mmap_mode='r')
+                    if data.shape != shape:
+                        print('ignoring mismatched pyramid cache %s' % cache_fname)
+                        data = None
+                    else:
+                        print('using pyramid cache %s' % cache_fname)
+                except (IOError, ValueError) as e:
+                    print('ignoring unreadable pyramid cache %s: %s' % (cache_fname, e))
+                    data = None
+
+            if data is None and cache_fname:
+                # stream reduction straight into the cache file
+                source = source_signature(self.filename)
+                tmp_fname = '%s.%d.tmp' % (cache_fname, os.getpid())
+                if self.reform is not None:
+                    # output dtype only known after reform
+                    print('building pyramid level %s for %s' % (reduction, cache_fname))
+                    data = self._build(reduction)
+                    dtype = data.dtype
+                else:
+                    dtype = np.float32
+                if data is self.source:
+                    # reform kept the source as is, which needs no cache
+                    out = None
+                else:
+                    try:
+                        out = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype, shape=shape)
+                    except (IOError, OSError) as e:
+                        print('cannot write pyramid cache %s: %s' % (cache_fname, e))
+                        out = None
+                if out is not None:
+                    print('building pyramid level %s into %s' % (reduction, cache_fname))
+                    try:
+                        if data is not None:
+                            self._store(out, data)
+                        else:
+                            self._build(reduction, out)
+                        out.flush()
+                        del out
+                        os.rename(tmp_fname, cache_fname)
+                    except:
+                        os.remove(tmp_fname)
+                        raise
+                    self._stamp_cache(reduction, source)
+                    data = np.load(cache_fname, mmap_mode='r')
+
+            if data is None:
+                print('building pyramid level %s in memory' % (reduction,))
+                data = self._build(reduction)
+
+        self.levels[reduction] = data
+        return data
+
+    def select(self, base_reduction, zoom, budget_bytes, voxel_bytes, max_extent=None, voxel_size=None):
+        """Choose finest reduction warranted by zoom and fitting texture budget.
+
+           base_reduction: reduction used at zoom 1.0
+           zoom: current view magnification relative to zoom 1.0
+           budget_bytes: maximum texture size in bytes
+           voxel_bytes: texture bytes per ZYX voxel
+           max_extent: maximum 3D texture width, or None
+           voxel_size: ZYX source voxel size, or None
+
+           A level is only warranted if it is at most zoom times finer
+           than base_reduction on every axis.  With max_extent, levels
+           with more voxels than that along any axis are skipped, and
+           with voxel_size also levels whose longest span in X voxel
+           units exceeds it, as ray steps cannot be finer than
+           1/max_extent.  Falls back to base_reduction if nothing else
+           fits.
+        """
+        for reduction in self.reductions:
+            ratio = max([ float(b) / r for b, r in zip(base_reduction, reduction) ])
+            if ratio > zoom:
+                continue
+            D, H, W = self.level_shape(reduction)[0:3]
+            if D * H * W * voxel_bytes > budget_bytes:
+                continue
+            if max_extent is not None:
+                if max(D, H, W) > max_extent:
+                    continue
+                if voxel_size is not None:
+                    extents = [ n * r * v for n, r, v in zip((D, H, W), reduction, voxel_size) ]
+                    if max(extents) / (reduction[2] * voxel_size[2]) > max_extent:
+                        continue
+            return reduction
+        return tuple(base_reduction)
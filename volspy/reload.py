@@ -0,0 +1,134 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Background texture reload scheduling.
+
+The TextureReload class prepares texture data for the latest view
+request in a worker thread and then uploads it into a new texture
+one Z chunk at a time, so the caller can keep drawing its current
+texture and only swap textures once the upload completes.  It does
+not touch OpenGL itself: textures are created, swapped and
+uploaded through callables and texture objects supplied by the
+caller.
+
+"""
+
+import threading
+
+class TextureReload (object):
+    """Schedule background texture reloads, latest request first.
+
+       prepare: function (channels, zoom) returning
+         (reduction, data, channels, payload) in a worker thread
+       new_texture: function (result) returning a new texture with
+         set_data() and delete() methods, or None if the current
+         texture already shows result
+       commit: function (result, texture) swapping in the uploaded
+         texture on the caller's thread
+       chunk_bytes: payload bytes uploaded per upload_chunk() call
+       refine: optional function () returning the refined result of
+         a progressive preview, prepared before any request
+
+       A request made while a reload is being prepared waits for it,
+       and a request made while one is being uploaded cancels that
+       upload, except for the upload of a refined preview which
+       later views build on.
+    """
+
+    def __init__(self, prepare, new_texture, commit, chunk_bytes, refine=None):
+        self.prepare = prepare
+        self.new_texture = new_texture
+        self.commit = commit
+        self.chunk_bytes = chunk_bytes
+        self.refine = refine
+        self.request = None
+        self.job = None
+        # (result, texture, next z, cancellable) of upload in progress
+        self.upload = None
+
+    def busy(self):
+        """Return True while a reload is being prepared or uploaded."""
+        return self.job is not None or self.upload is not None
+
+    def submit(self, channels, zoom):
+        """Request a reload, replacing any earlier request not yet started."""
+        self.request = (channels, zoom)
+        if self.upload is not None and self.upload[3]:
+            texture = self.upload[1]
+            self.upload = None
+            texture.delete()
+
+    def start(self):
+        """Start preparing the next reload in a worker thread.
+
+           Returns a status string, or None if busy or idle.
+        """
+        if self.busy():
+            return None
+        if self.refine is not None:
+            work, self.refine = self.refine, None
+            status = 'refining preview'
+            cancellable = False
+        elif self.request is not None:
+            channels, zoom = self.request
+            self.request = None
+            work = lambda: self.prepare(channels, zoom)
+            status = 'preparing'
+            cancellable = True
+        else:
+            return None
+        job = dict(done=False, result=None, error=None, cancellable=cancellable)
+
+        def run():
+            try:
+                job['result'] = work()
+            except Exception as e:
+                job['error'] = e
+            job['done'] = True
+
+        job['thread'] = threading.Thread(target=run)
+        job['thread'].daemon = True
+        self.job = job
+        job['thread'].start()
+        return status
+
+    def poll(self):
+        """Begin upload of a finished worker result, or start the next reload.
+
+           Returns a status string, or None if nothing changed.
+        """
+        status = None
+        job = self.job
+        if job is not None and job['done']:
+            self.job = None
+            if job['error'] is not None:
+                print('texture reload failed: %s' % job['error'])
+                status = 'failed'
+            else:
+                texture = self.new_texture(job['result'])
+                if texture is None:
+                    status = 'done'
+                else:
+                    self.upload = (job['result'], texture, 0, job['cancellable'])
+        return self.start() or status
+
+    def upload_chunk(self):
+        """Upload the next Z chunk, committing the texture after the last one.
+
+           Returns a status string.
+        """
+        result, texture, z0, cancellable = self.upload
+        payload = result[3]
+        D = payload.shape[0]
+        step = max(self.chunk_bytes // max(payload[0].nbytes, 1), 1)
+        z1 = min(z0 + step, D)
+        # copy, since the worker may reuse the staging buffer before upload
+        texture.set_data(payload[z0:z1], offset=(z0, 0, 0), copy=True)
+        if z1 < D:
+            self.upload = (result, texture, z1, cancellable)
+            return 'uploading %d%%' % (100 * z1 // D)
+        self.upload = None
+        self.commit(result, texture)
+        return 'done'
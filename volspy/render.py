@@ -11,6 +11,10 @@ ray-casting algorithm, with optional clipping and slicing tools and a
 near-clipping plane for valid rendering even when the camera moves
 inside the volume bounding box.
 
+Alternatively, ray entry and exit can be found analytically by each
+ray-casting fragment, intersecting its ray with the volume box and
+clipping plane, in a single pass without entry and exit textures.
+
 """
 
 import numpy as np
@@ -20,6 +24,7 @@ from vispy.util.transforms import ortho
 from vispy import gloo
 
 import os
+import math
 import datetime
 
 def rotate(M, angle, x, y, z):
@@ -55,6 +60,23 @@ def scale(M, x, y, z):
 # hueristic to configure ray-casting sampling pitch
 maxtexsize = float(os.getenv('MAX_3D_TEXTURE_WIDTH', 1024))
 
+# ray-casting samples per voxel step and early-termination opacity
+try:
+    oversample = float(os.getenv('VIEW_OVERSAMPLE', 1))
+    assert oversample > 0
+except (ValueError, AssertionError):
+    print('Invalid VIEW_OVERSAMPLE "%s", using 1.0 instead' % os.getenv('VIEW_OVERSAMPLE'))
+    oversample = 1.0
+try:
+    alpha_cutoff = float(os.getenv('VIEW_ALPHA_CUTOFF', 0.99))
+except ValueError:
+    print('Invalid VIEW_ALPHA_CUTOFF "%s", using 0.99 instead' % os.getenv('VIEW_ALPHA_CUTOFF'))
+    alpha_cutoff = 0.99
+
+# shader loop bound for the longest ray through the unit-span box at
+# the finest step set by VolumeRenderer.set_step_size()
+max_ray_steps = int(math.ceil(3**0.5 * maxtexsize * oversample)) + 1
+
 # center on origin and change box aspect ratio to match image
 cube_model = np.eye(4, dtype=np.float32)
 cube_anti_model = np.eye(4, dtype=np.float32)
@@ -157,13 +179,17 @@ _linear_alpha = """
 """
 
 # accumulate voxels with alpha transparency (front-to-back)
+# correcting alpha for ray step and stopping once nearly opaque
 _transparent_blend = """
+       col_smp.a = 1.0 - pow(1.0 - col_smp.a, step_scale);
        col_acc += (1.0 - col_acc.a) * col_smp * col_smp.a;
+       if (col_acc.a >= u_alpha_cutoff)
+         break;
 """
 
 # accumulate voxels with simple addition
 _additive_blend = """
-       col_acc = clamp(col_acc + col_smp * 0.01, 0.0, 1.0);
+       col_acc = clamp(col_acc + col_smp * 0.01 * step_scale, 0.0, 1.0);
 """
 
 # accumulate voxels with maximum intensity projection
@@ -297,6 +323,13 @@ class VolumeRayCastProgram (VolumeProgram):
               Accumulate col_smp vec4 into col_acc vec4 accumulator to
               perform ray-cast integration.  When None (default), use
               _transparent_blend global GLSL fragment.
+
+           The ray step follows the voxel pitch of the volume texture
+           set by VolumeRenderer.set_step_size().  Its length relative
+           to the reference step of 1/MAX_3D_TEXTURE_WIDTH texture
+           units is available to blendstmt as float step_scale, e.g.
+           for the opacity correction in _transparent_blend, and
+           blendstmt may break out of the loop to stop the ray.
         """
         if uniforms is None:
             uniforms = _color_uniforms
@@ -313,9 +346,56 @@ uniform sampler3D u_data_texture;
 uniform sampler2D u_entry_texture;
 uniform sampler2D u_exit_texture;
 uniform vec4 u_picked;
+uniform int u_analytic;
+uniform mat4 u_ray_origin;
+uniform mat4 u_ray_dir;
+uniform float u_ray_tmin;
+uniform vec3 u_box_half;
+uniform vec4 u_clip_plane;
+uniform float u_step;
+uniform vec3 u_tex_extent;
+uniform int u_max_steps;
+uniform float u_alpha_cutoff;
 %(uniforms)s
 varying vec2 v_texcoord;
 
+// intersect pixel ray with clipped volume box in model space
+void ray_box(vec2 ndc, out vec4 entry, out vec4 exit)
+{
+    vec3 orig = (u_ray_origin * vec4(ndc, 1.0, 0.0)).xyz;
+    vec3 dir = (u_ray_dir * vec4(ndc, 1.0, 0.0)).xyz;
+
+    // avoid division by zero for rays parallel to box faces
+    dir += vec3(equal(dir, vec3(0.0))) * 1.0e-7;
+
+    vec3 ta = (-u_box_half - orig) / dir;
+    vec3 tb = (u_box_half - orig) / dir;
+    vec3 tn = min(ta, tb);
+    vec3 tf = max(ta, tb);
+    float t0 = max(max(tn.x, tn.y), max(tn.z, u_ray_tmin));
+    float t1 = min(min(tf.x, tf.y), tf.z);
+
+    // keep non-positive plane distance as in make_cube_clipped
+    float d0 = dot(u_clip_plane, vec4(orig, 1.0));
+    float dd = dot(u_clip_plane.xyz, dir);
+    if (dd > 0.0)
+       t1 = min(t1, -d0 / dd);
+    else if (dd < 0.0)
+       t0 = max(t0, -d0 / dd);
+    else if (d0 > 0.0)
+       t1 = t0;
+
+    if (t0 < t1) {
+       // box corners map to texture coordinates 0 and 1
+       entry = vec4((orig + t0 * dir) / (2.0 * u_box_half) + 0.5, 1.0);
+       exit = vec4((orig + t1 * dir) / (2.0 * u_box_half) + 0.5, 1.0);
+    }
+    else {
+       entry = vec4(0.0, 0.0, 0.0, 1.0);
+       exit = entry;
+    }
+}
+
 float rand(vec3 co)
 {
     float a = 12.9898;
@@ -333,6 +413,7 @@ void main()
     float cast_len;
     float ray_len;
     float step_len;
+    float step_scale;
     vec2 f_pos;
     vec4 col_packed_smp;
     vec4 col_smp;
@@ -343,19 +424,26 @@ void main()
 
     f_pos = v_texcoord;
 
-    entry = vec4(texture2D(u_entry_texture, f_pos).xyz, 1.0);
-    exit = vec4(texture2D(u_exit_texture, f_pos).xyz, 1.0);
+    if (u_analytic != 0) {
+       ray_box(2.0 * f_pos - 1.0, entry, exit);
+    }
+    else {
+       entry = vec4(texture2D(u_entry_texture, f_pos).xyz, 1.0);
+       exit = vec4(texture2D(u_exit_texture, f_pos).xyz, 1.0);
+    }
 
-    step = 2.0 * normalize(exit - entry) / %(maxtexsize)d.0;
+    // step u_step model units, scaling texture units by box extent
+    step = (exit - entry) * u_step / max(length((exit - entry).xyz * u_tex_extent), 1.0e-12);
     step_len = length(step);
     ray_len = length(exit - entry) - step_len;
+    step_scale = step_len * %(refsteps)d.0;
 
     texcoord = entry + rand(entry.xyz) * step;
     cast_len = step_len;
 
-    for (int s = 0; s < %(maxtexsize)d; s++)
+    for (int s = 0; s < %(maxsteps)d; s++)
     {
-       if (cast_len > ray_len || entry == exit || col_acc.a > 1.0)
+       if (s >= u_max_steps || cast_len > ray_len || entry == exit || col_acc.a > 1.0)
          break;
 
        col_packed_smp = texture3D(u_data_texture, texcoord.xyz / texcoord.w);
@@ -374,7 +462,8 @@ void main()
 }
 
 """ % dict(
-            maxtexsize=maxtexsize * 2.0, 
+            refsteps=maxtexsize,
+            maxsteps=max_ray_steps,
             uniforms=uniforms,
             repack=colorunpack,
             alpha=alphastmt,
@@ -388,6 +477,9 @@ void main()
         self.frag_shader = VolumeRayCastProgram.frag_shader(**frag_glsl_parts)
         VolumeProgram.__init__(self, self.frag_shader, vol_texture, num_channels, entry_texture, gain)
         self['u_exit_texture'] = exit_texture
+        self['u_analytic'] = 0
+        self['u_clip_plane'] = (0, 0, 0, -1)
+        self['u_alpha_cutoff'] = alpha_cutoff
 
 
 class PolyhedronProgram (gloo.Program):
@@ -457,11 +549,12 @@ class RecentUniforms (dict):
 
 class VolumeRenderer (object):
 
-    def __init__(self, vol_cropper, vol_texture, num_channels, vol_view, fbo_size=(1024, 1024), zoom=1.0, frag_glsl_dicts=None, pick_glsl_index=None, vol_interp='linear'):
+    def __init__(self, vol_cropper, vol_texture, num_channels, vol_view, fbo_size=(1024, 1024), zoom=1.0, frag_glsl_dicts=None, pick_glsl_index=None, vol_interp='linear', analytic_rays=False):
         self.vol_cropper = vol_cropper
 
         self.uniform_changes = RecentUniforms()
         
+        self.vol_interp = vol_interp
         self.vol_texture = vol_texture
         self.vol_texture.interpolation = vol_interp
         self.vol_texture.wrapping = 'clamp_to_edge'
@@ -471,11 +564,12 @@ class VolumeRenderer (object):
         self.volume_faces = gloo.IndexBuffer(cube_faces)
         self.slice_faces = gloo.IndexBuffer(cut_face)
 
+        fbo_size = tuple(fbo_size)
         self.fbo_viewport = (0, 0) + fbo_size
-        #fbo_format = 'rgba32f'
-        fbo_format = 'rgba16'
-        self.entry_texture = gloo.Texture2D(shape=(fbo_size + (4,)), internalformat=fbo_format)
-        self.exit_texture = gloo.Texture2D(shape=(fbo_size + (4,)), internalformat=fbo_format)
+        #self.fbo_format = 'rgba32f'
+        self.fbo_format = 'rgba16'
+        self.entry_texture = gloo.Texture2D(shape=(fbo_size + (4,)), internalformat=self.fbo_format)
+        self.exit_texture = gloo.Texture2D(shape=(fbo_size + (4,)), internalformat=self.fbo_format)
         self.pick_texture = gloo.Texture2D(shape=(1, 1, 4), internalformat='rgba')
 
         self.entry_texture.interpolation = 'nearest'
@@ -511,12 +605,114 @@ class VolumeRenderer (object):
 
         self.prog_boundary = PolyhedronProgram(vol_view, cube_model)
         self.prog_boundary.bind(self.cube_verts)
+        self.vol_view = vol_view
+        self.vol_projection = np.eye(4, dtype=np.float32)
+        self.box_half = cube_verts['position'][6].copy()
+        self.set_analytic_rays(analytic_rays)
+        self.set_step_size(self.vol_cropper.min_pixel_step_size(outtexture=self.vol_texture))
         
         self.fbo_entry = gloo.FrameBuffer(self.entry_texture)
         self.fbo_exit = gloo.FrameBuffer(self.exit_texture)
         self.fbo_pick = gloo.FrameBuffer(self.pick_texture)
         self.anti_view = None
+
+        # model-space clip plane and volume geometry of current buffers
+        self.clip_key = None
+        self.clip_rebuilds = 0
+        self.clip_rebuilds_skipped = 0
         
+    def set_vol_texture(self, vol_texture):
+        """Replace volume texture sampled by all programs, e.g. after a background reload."""
+        vol_texture.interpolation = self.vol_interp
+        vol_texture.wrapping = 'clamp_to_edge'
+        self.vol_texture = vol_texture
+        for prog in self.prog_vol_slicers + self.prog_ray_casters:
+            prog['u_data_texture'] = vol_texture
+
+    def set_fbo_size(self, fbo_size):
+        """Resize ray entry and exit framebuffers, e.g. to follow the viewport size.
+
+           The textures are resized in place, so the framebuffers and
+           ray-casting programs keep using them.
+        """
+        fbo_size = tuple(fbo_size)
+        if fbo_size == self.fbo_viewport[2:4]:
+            return
+        print("ray entry/exit buffers resized to %dx%d" % fbo_size)
+        self.fbo_viewport = (0, 0) + fbo_size
+        self.entry_texture.resize(fbo_size + (4,), internalformat=self.fbo_format)
+        self.exit_texture.resize(fbo_size + (4,), internalformat=self.fbo_format)
+
+    def set_analytic_rays(self, enabled):
+        """Choose analytic or two-pass ray entry and exit for draw_volume().
+
+           The two-pass method rasterizes front and back faces of the
+           clipped cube into entry and exit textures before casting
+           rays.  The analytic method lets each ray-cast fragment
+           intersect its ray with the volume box and clip plane,
+           skipping those passes.
+        """
+        self.analytic_rays = enabled and True or False
+        for prog in self.prog_ray_casters:
+            prog['u_analytic'] = self.analytic_rays and 1 or 0
+
+    def set_step_size(self, voxel_step):
+        """Set ray-casting sample pitch from voxel_step of the volume texture.
+
+           voxel_step is the finest voxel pitch in model units where
+           the longest volume dimension spans 1.0, as returned by
+           ImageManager.min_pixel_step_size(), so smaller textures are
+           sampled with proportionally fewer steps.  Rays take
+           VIEW_OVERSAMPLE steps per voxel_step.
+
+           Steps are no finer than 1/MAX_3D_TEXTURE_WIDTH per
+           VIEW_OVERSAMPLE, so that the shader loop bound max_ray_steps
+           covers the box diagonal even for volumes spanning more
+           voxels, e.g. with a large Zaspect.
+        """
+        D, H, W, C = self.vol_texture.shape
+        step = max(voxel_step, 1. / maxtexsize) / oversample
+        extent = np.array((W, H, D * self.vol_cropper.Zaspect), dtype=np.float32) * voxel_step
+        max_steps = min(int(math.ceil(3**0.5 / step)) + 1, max_ray_steps)
+        for prog in self.prog_ray_casters:
+            prog['u_step'] = step
+            prog['u_tex_extent'] = extent
+            prog['u_max_steps'] = max_steps
+
+    def _set_ray_uniforms(self):
+        """Set model-space pixel ray uniforms for analytic ray entry and exit.
+
+           Ray origin and direction are affine in the normalized
+           device coordinates (nx, ny) of the pixel for perspective and
+           orthographic projections alike, so each is passed as a
+           matrix applied to (nx, ny, 1, 0).
+        """
+        P = self.vol_projection
+        anti_model_view = np.linalg.inv(np.dot(cube_model, self.vol_view))
+
+        # view-space ray from camera plane z=0 along -z
+        origin = np.zeros((4, 4), dtype=np.float32)
+        origin[0,0] = P[3,3] / P[0,0]
+        origin[1,1] = P[3,3] / P[1,1]
+        origin[2,0:4] = (-P[3,0] / P[0,0], -P[3,1] / P[1,1], 0., 1.)
+        direction = np.zeros((4, 4), dtype=np.float32)
+        direction[0,0] = -P[2,3] / P[0,0]
+        direction[1,1] = -P[2,3] / P[1,1]
+        direction[2,0:3] = (P[2,0] / P[0,0], P[2,1] / P[1,1], -1.)
+
+        if P[2,3] != 0:
+            # perspective rays start at the eye
+            tmin = 0.
+        else:
+            # orthographic rays also see content behind camera plane
+            tmin = -1e30
+
+        for prog in self.prog_ray_casters:
+            prog['u_ray_origin'] = np.dot(origin, anti_model_view)
+            prog['u_ray_dir'] = np.dot(direction, anti_model_view)
+            prog['u_ray_tmin'] = tmin
+            prog['u_box_half'] = self.box_half
+
     def set_color_mode(self, i=None, reverse=False):
         if i is None:
             self.color_mode = (self.color_mode + (reverse and -1 or 1)) % len(self.prog_ray_casters)
@@ -531,6 +727,12 @@ class VolumeRenderer (object):
            view_plane is (A,B,C,D) plane equation and clipping will
            exclude volume in negative half-space, i.e. with negative
            plane distance.  A value of None disables clipping.
+
+           The clipped cube geometry and its vertex and index buffers
+           are only rebuilt when the model-space plane or the volume
+           shape changed since the last call.  The clip_rebuilds and
+           clip_rebuilds_skipped counters record how often each
+           happened, for profiling.
         """
         # normalize (A,B,C,D) to make (A,B,C) a unit vector in world space
         # and D will be distance from origin in world space
@@ -567,13 +769,29 @@ class VolumeRenderer (object):
         # find D' offset from D by scalar projection
         model_plane[3] = D + sproject(m_p3[0:3]-m_p0[0:3], m_p4[0:3])
 
+        clip_key = (
+            model_plane.tobytes(),
+            tuple(self.vol_cropper.data.shape[0:3]),
+            self.vol_cropper.Zaspect
+        )
+        if clip_key == self.clip_key:
+            self.clip_rebuilds_skipped += 1
+            return
+        self.clip_key = clip_key
+        self.clip_rebuilds += 1
+
+        for prog in self.prog_ray_casters:
+            prog['u_clip_plane'] = model_plane
+
         cube_verts, cube_faces, cut_face = self.vol_cropper.make_cube_clipped(model_plane)
+        self.box_half = cube_verts['position'][6].copy()
         self.cube_verts.set_data(cube_verts)
         self.volume_faces.set_data(cube_faces, copy=True)
         self.slice_faces.set_data(cut_face, copy=True)
 
     def set_vol_projection(self, projection):
         self.prog_boundary['u_projection'] = projection
+        self.vol_projection = projection
 
     def set_uniform(self, name, value):
         self.uniform_changes[name] = value # track changes
@@ -587,11 +805,11 @@ class VolumeRenderer (object):
         
     def set_vol_view(self, view, anti_view):
         self.prog_boundary['u_view'] = view
+        self.vol_view = view
         self.anti_view = anti_view
 
-    def draw_volume(self, viewport, color_mask=(True, True, True, True), pick=None, on_pick=None):
-        gloo.set_color_mask(True, True, True, True)
-
+    def _draw_entry_exit(self):
+        """Draw ray entry and exit textures for two-pass ray casting."""
         with self.fbo_entry:
             # draw the ray entry map via front-faces
             gloo.set_clear_color('black')
@@ -610,6 +828,14 @@ class VolumeRenderer (object):
             gloo.set_state(blend=False, depth_test=False, cull_face=True)
             self.prog_boundary.draw(self.volume_faces)
 
+    def draw_volume(self, viewport, color_mask=(True, True, True, True), pick=None, on_pick=None):
+        gloo.set_color_mask(True, True, True, True)
+
+        if self.analytic_rays:
+            self._set_ray_uniforms()
+        else:
+            self._draw_entry_exit()
+
         if pick is not None:
             X, Y, W, H = viewport
             x, y = pick
@@ -639,7 +865,7 @@ class VolumeRenderer (object):
             pick_out = None
             self.set_uniform('u_picked', (0, 0, 0, 0))
             
-        # cast rays based on entry/exit textures
+        # cast rays based on entry/exit
         gloo.set_color_mask(* color_mask)
         gloo.set_clear_color('black')
         gloo.set_viewport(* viewport)
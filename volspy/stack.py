@@ -0,0 +1,346 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Directory stacks of 2D TIFF planes.
+
+Many acquisitions are stored as a directory holding one 2D TIFF file
+per Z plane.  The StackLazyNDArray reader presents such a directory as
+one ZYX or ZYXC image array, offering the same lazy view interface as
+util.TiffLazyNDArray without concatenating the planes first.
+
+Only the first plane file is examined when a stack is opened, and all
+planes are expected to share its shape and dtype.  Plane files are
+listed in natural order of their names, e.g. z2.tif before z10.tif,
+and opened on demand through a FileHandlePool which bounds the number
+of files kept open, however many planes the stack has.  Decoded
+planes are kept in the shared cache.page_cache, keyed by plane file
+size and mtime so that rewritten planes are decoded again.
+
+Stack metadata such as "micron_spacing" as [Z, Y, X] may be given in
+a <directory>.volspy-meta.json sidecar as for util.load_npy.
+
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+import tifffile
+
+from .cache import page_cache
+from .lazy import LazyNDArray
+from .tiffindex import TiffIndex, can_decode, decode_page
+from . import util
+
+plane_extensions = ('.tif', '.tiff')
+
+def _natural_key(name):
+    """Return sort key ordering embedded numbers in name by value."""
+    return [ s.isdigit() and (0, int(s), '') or (1, 0, s.lower()) for s in re.split(r'(\d+)', name) ]
+
+def stack_files(path):
+    """Return list of 2D TIFF plane filenames in directory path, in natural order."""
+    names = [
+        name
+        for name in os.listdir(path)
+        if name.lower().endswith(plane_extensions) and not name.startswith('.')
+    ]
+    names.sort(key=_natural_key)
+    return [ os.path.join(path, name) for name in names ]
+
+def is_stack(path):
+    """Return True if path names a directory of TIFF plane files."""
+    if not os.path.isdir(path) or util.is_chunked(path):
+        return False
+    for name in os.listdir(path):
+        if name.lower().endswith(plane_extensions):
+            return True
+    return False
+
+class FileHandlePool (object):
+    """Bounded pool of raw binary file handles shared by reader threads.
+
+       A handle is used by one thread between acquire() and
+       release().  Released handles stay open for reuse, closing the
+       least recently used ones so that at most size idle handles
+       remain open no matter how many files are read.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = OrderedDict() # fname -> [fh, ...]
+        self.nidle = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, fname):
+        """Return handle for fname, reusing an idle one if available."""
+        with self.lock:
+            handles = self.idle.get(fname)
+            if handles:
+                fh = handles.pop()
+                if not handles:
+                    del self.idle[fname]
+                self.nidle -= 1
+                return fh
+            self.opened += 1
+        return open(fname, 'rb')
+
+    def release(self, fname, fh):
+        """Return handle for fname to the pool, closing excess idle handles."""
+        closing = []
+        with self.lock:
+            # re-insert to mark most-recently used
+            handles = self.idle.pop(fname, [])
+            handles.append(fh)
+            self.idle[fname] = handles
+            self.nidle += 1
+            while self.nidle > self.size:
+                oldest = next(iter(self.idle))
+                handles = self.idle[oldest]
+                closing.append(handles.pop(0))
+                if not handles:
+                    del self.idle[oldest]
+                self.nidle -= 1
+        for fh in closing:
+            fh.close()
+
+    def discard(self, fname):
+        """Close idle handles for fname, e.g. after the file was replaced."""
+        with self.lock:
+            handles = self.idle.pop(fname, [])
+            self.nidle -= len(handles)
+        for fh in handles:
+            fh.close()
+
+    def close(self):
+        """Close all idle handles."""
+        with self.lock:
+            idle = list(self.idle.values())
+            self.idle.clear()
+            self.nidle = 0
+        for handles in idle:
+            for fh in handles:
+                fh.close()
+
+def default_handles():
+    """Return file handle pool size from VOLSPY_STACK_HANDLES environment."""
+    return util.default_workers('VOLSPY_STACK_HANDLES', 64)
+
+class StackLazyNDArray (LazyNDArray):
+    """Lazy wrapper for directory stacks of 2D TIFF planes.
+
+       Supports the same slicing, lazyget, transpose, min/max and
+       block processing interface as TiffLazyNDArray, with stack axis
+       Z followed by the plane axes of the first file, i.e. ZYX for
+       single-sample planes.
+
+       Planes intersecting a read are decoded concurrently by
+       VOLSPY_IO_WORKERS threads.  Partial reads of planes that are
+       not already cached decode only the strips or tiles
+       intersecting the region, as for TiffLazyNDArray.
+
+    """
+
+    def __init__(self, src, _output_plan=None):
+        """Wrap stack given by directory name or existing StackLazyNDArray."""
+        if isinstance(src, StackLazyNDArray):
+            self.filename = src.filename
+            self.files = src.files
+            self.plane_shape = src.plane_shape
+            self.input_axes = src.input_axes
+            self.dtype = src.dtype
+            self.handles = src.handles
+            self.plane_info = src.plane_info
+            self.signatures = src.signatures
+            self.unchecked = src.unchecked
+        else:
+            self.filename = os.path.abspath(src)
+            self.files = stack_files(self.filename)
+            assert self.files, "%s has no TIFF plane files" % src
+            with tifffile.TiffFile(self.files[0]) as tf:
+                page0 = tf.pages[0]
+                self.plane_shape = tuple(page0.shape)
+                plane_axes = page0.axes
+                self.dtype = np.dtype(page0.dtype).newbyteorder('=')
+            assert len(self.plane_shape) in (2, 3), "plane %s is not a 2D image" % self.files[0]
+            self.input_axes = 'Z' + plane_axes.replace('S', 'C')
+            self.handles = FileHandlePool(default_handles())
+            # per-plane (signature, TiffPageInfo), or None info where tiffindex cannot decode the plane
+            self.plane_info = dict()
+            # per-plane file (size, mtime) as of opening or last cache rebuild
+            self.signatures = [ tuple(util.source_signature(f) or ()) for f in self.files ]
+            # planes not yet cached since opening, needing no further stat
+            self.unchecked = set(range(len(self.files)))
+            print("STACK %s %s %s, %d planes of %s from %s" % (
+                (len(self.files),) + self.plane_shape, self.input_axes, self.dtype,
+                len(self.files), self.plane_shape, self.filename
+            ))
+
+        self.cache_key = self.filename
+        self.input_shape = (len(self.files),) + self.plane_shape
+        self._init_output_plan(_output_plan)
+
+        if isinstance(src, StackLazyNDArray):
+            if hasattr(src, 'micron_spacing'):
+                self.micron_spacing = src.micron_spacing
+        else:
+            meta = util.load_array_metadata(self.filename)
+            if meta.get('micron_spacing'):
+                self.micron_spacing = tuple(map(float, meta['micron_spacing']))
+
+    def __getstate__(self):
+        """Pickle view by filenames, so that other processes open the planes themselves."""
+        state = dict(self.__dict__)
+        for k in ['handles', 'plane_info', 'stats', 'min_max']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.handles = FileHandlePool(default_handles())
+        self.plane_info = dict()
+
+    def _plane_key(self, z):
+        """Return shared page cache key for plane z, including plane file size and mtime.
+
+           Plane files are stat'ed when the stack is opened, and again
+           only when a plane cached before must be rebuilt, e.g. after
+           eviction, so a plane file rewritten since it was cached
+           gets a new key rather than old data.
+        """
+        key = (self.cache_key, z) + self.signatures[z]
+        if key in page_cache:
+            return key
+        if z in self.unchecked:
+            self.unchecked.discard(z)
+        else:
+            self.signatures[z] = tuple(util.source_signature(self.files[z]) or ())
+            key = (self.cache_key, z) + self.signatures[z]
+        return key
+
+    def _info(self, z, key):
+        """Return TiffPageInfo of plane z with cache key if tiffindex can decode it, else None."""
+        signature = key[2:]
+        entry = self.plane_info.get(z)
+        if entry is not None:
+            if entry[0] == signature:
+                return entry[1]
+            # plane file changed, so its layout and open handles are stale
+            self.handles.discard(self.files[z])
+        try:
+            info = TiffIndex(self.files[z]).page0
+            if info.shape != self.plane_shape or not can_decode(info):
+                info = None
+        except (IOError, ValueError, KeyError):
+            info = None
+        self.plane_info[z] = (signature, info)
+        return info
+
+    def _check_plane(self, z, p):
+        if p.shape != self.plane_shape:
+            raise ValueError('plane %s shape %s does not match stack plane shape %s' % (
+                self.files[z], p.shape, self.plane_shape
+            ))
+        return p
+
+    def _read_plane(self, z, key=None):
+        """Return read-only plane array, using shared page cache for decoded planes."""
+        if key is None:
+            key = self._plane_key(z)
+        p = page_cache.get(key)
+        if p is not None:
+            return p
+
+        info = self._info(z, key)
+        if info is not None:
+            fname = self.files[z]
+            fh = self.handles.acquire(fname)
+            try:
+                p = decode_page(fh, info)
+            finally:
+                self.handles.release(fname, fh)
+        else:
+            # compression or layout not handled by tiffindex
+            with tifffile.TiffFile(self.files[z]) as tf:
+                p = tf.pages[0].asarray()
+        p = self._check_plane(z, np.asarray(p, dtype=self.dtype))
+        p.flags.writeable = False
+        page_cache.put(key, p)
+        return p
+
+    def _plane_data(self, z, plane_slice):
+        """Return plane_slice of plane z, decoding only its region if not cached."""
+        region = util.page_region(plane_slice, self.plane_shape)
+        key = self._plane_key(z)
+        info = region is not None and key not in page_cache and self._info(z, key) or None
+        if info is not None:
+            fname = self.files[z]
+            fh = self.handles.acquire(fname)
+            try:
+                p = decode_page(fh, info, region[0])
+            finally:
+                self.handles.release(fname, fh)
+            return p[region[1]]
+        return self._read_plane(z, key)[plane_slice]
+
+    def _read(self, output_plan, copy=True):
+        """Return ND-array for output_plan, decoding planes concurrently."""
+        buffer_plan = [
+            (in_axis, in_slice, out_slice)
+            for in_axis, in_slice, out_slice in output_plan
+            if in_slice is not None
+        ]
+        input_plan = list(buffer_plan)
+        input_plan.sort(key=lambda p: p[0])
+        assert len(input_plan) == len(self.input_shape)
+
+        buffer_shape = tuple([
+            out_slice.stop
+            for in_axis, in_slice, out_slice in input_plan
+            if isinstance(in_slice, slice)
+        ])
+        buffer_axes = [
+            in_axis
+            for in_axis, in_slice, out_slice in input_plan
+            if isinstance(in_slice, slice)
+        ]
+        buffer = np.empty(buffer_shape, self.dtype)
+
+        z_slice = input_plan[0][1]
+        plane_slice = tuple([ p[1] for p in input_plan[1:] ])
+        plane_out = tuple([ p[2] for p in input_plan[1:] if p[2] is not None ])
+        if isinstance(z_slice, slice):
+            io_slices = [
+                ((i,) + plane_out, z)
+                for i, z in enumerate(range(z_slice.start, z_slice.stop, z_slice.step))
+            ]
+        else:
+            io_slices = [ (plane_out, z_slice) ]
+
+        def read_plane(io):
+            out_slicing, z = io
+            buffer[out_slicing] = self._plane_data(z, plane_slice)
+
+        workers = util.default_io_workers()
+        if workers > 1 and len(io_slices) > 1:
+            util.io_pool(workers).map(read_plane, io_slices, chunksize=1)
+        else:
+            for io in io_slices:
+                read_plane(io)
+
+        return self._transpose_buffer(buffer, buffer_axes, output_plan)
+
+def load_stack(path):
+    """Load directory stack, returning (data, metadata) with data in CZYX form like util.load_image."""
+    data = util.canonicalize(StackLazyNDArray(path))
+    try:
+        z_microns, y_microns, x_microns = data.micron_spacing
+        md = util.ImageMetadata(x_microns, y_microns, z_microns, data.axes)
+    except AttributeError as e:
+        print('got error %s fetching metadata during load_stack' % e)
+        md = None
+    return data, md
@@ -0,0 +1,193 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Streaming image statistics.
+
+An ImageStats accumulates per-channel minimum, maximum, mean and a
+fixed-bin histogram over successive blocks of image data, so that
+large lazy arrays can be summarized in one pass while only buffering
+one slab at a time.  The histogram range grows by doubling as new
+values are seen, merging bins pairwise, so the counts stay exact
+without knowing the value range in advance.  Approximate percentiles
+are interpolated from the histogram.
+
+Statistics can be saved to and loaded from small JSON files, e.g.
+alongside the source image file, so normalization can reuse them in
+later sessions without rescanning the data.
+
+"""
+
+import json
+import os
+import numpy as np
+
+class ImageStats (object):
+
+    nbins = 4096
+
+    def __init__(self, nchannels, integer=False):
+        """Prepare empty statistics for nchannels, with integer-aligned bins if integer=True."""
+        self.nchannels = nchannels
+        self.integer = integer
+        self.count = np.zeros((nchannels,), dtype=np.int64)
+        self.sum = np.zeros((nchannels,), dtype=np.float64)
+        self.min = np.full((nchannels,), np.inf)
+        self.max = np.full((nchannels,), -np.inf)
+        self.hist = np.zeros((nchannels, self.nbins), dtype=np.int64)
+        self.hist_lo = np.zeros((nchannels,), dtype=np.float64)
+        self.hist_width = np.zeros((nchannels,), dtype=np.float64)
+
+    @property
+    def mean(self):
+        return self.sum / np.maximum(self.count, 1)
+
+    def _fit_range(self, c, vmin, vmax):
+        """Grow histogram range of channel c to cover [vmin, vmax]."""
+        if self.hist_width[c] == 0:
+            # initial range from first values seen
+            span = vmax - vmin
+            if self.integer:
+                self.hist_lo[c] = np.floor(vmin)
+                self.hist_width[c] = max(np.ceil((span + 1) / self.nbins), 1)
+            else:
+                self.hist_lo[c] = vmin
+                self.hist_width[c] = span > 0 and span / self.nbins * (1 + 1e-6) or max(abs(vmin), 1) * 1e-6
+            return
+
+        while True:
+            lo = self.hist_lo[c]
+            width = self.hist_width[c]
+            if vmin < lo:
+                # double range downward
+                merged = np.concatenate((np.zeros((self.nbins,), dtype=np.int64), self.hist[c]))
+                self.hist_lo[c] = lo - width * self.nbins
+            elif vmax >= lo + width * self.nbins:
+                # double range upward
+                merged = np.concatenate((self.hist[c], np.zeros((self.nbins,), dtype=np.int64)))
+            else:
+                return
+            self.hist[c] = merged.reshape((self.nbins, 2)).sum(axis=1)
+            self.hist_width[c] = width * 2
+
+    def update(self, block):
+        """Accumulate statistics for block with channels on last axis."""
+        assert block.shape[-1] == self.nchannels
+        for c in range(self.nchannels):
+            x = np.asarray(block[..., c], dtype=np.float64).ravel()
+            if not self.integer:
+                x = x[np.isfinite(x)]
+            if x.size == 0:
+                continue
+            vmin = x.min()
+            vmax = x.max()
+            self.count[c] += x.size
+            self.sum[c] += x.sum()
+            self.min[c] = min(self.min[c], vmin)
+            self.max[c] = max(self.max[c], vmax)
+            self._fit_range(c, vmin, vmax)
+            bins = ((x - self.hist_lo[c]) // self.hist_width[c]).astype(np.intp)
+            np.clip(bins, 0, self.nbins - 1, out=bins)
+            self.hist[c] += np.bincount(bins, minlength=self.nbins)
+
+    def percentile(self, q, channel=0):
+        """Return approximate q-th percentile (0-100) of channel values."""
+        c = channel
+        if self.count[c] == 0:
+            return np.nan
+        target = self.count[c] * q / 100.0
+        cum = np.cumsum(self.hist[c])
+        i = min(int(np.searchsorted(cum, target)), self.nbins - 1)
+        below = i > 0 and cum[i-1] or 0
+        frac = self.hist[c,i] and (target - below) / float(self.hist[c,i]) or 0.
+        value = self.hist_lo[c] + (i + frac) * self.hist_width[c]
+        return float(min(max(value, self.min[c]), self.max[c]))
+
+    def to_dict(self):
+        return {
+            'nchannels': self.nchannels,
+            'integer': self.integer,
+            'nbins': self.nbins,
+            'count': self.count.tolist(),
+            'sum': self.sum.tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'hist': self.hist.tolist(),
+            'hist_lo': self.hist_lo.tolist(),
+            'hist_width': self.hist_width.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, doc):
+        assert doc['nbins'] == cls.nbins
+        stats = cls(doc['nchannels'], doc['integer'])
+        stats.count[:] = doc['count']
+        stats.sum[:] = doc['sum']
+        stats.min[:] = doc['min']
+        stats.max[:] = doc['max']
+        stats.hist[:,:] = doc['hist']
+        stats.hist_lo[:] = doc['hist_lo']
+        stats.hist_width[:] = doc['hist_width']
+        return stats
+
+    def save(self, fname, source=None):
+        """Save statistics as JSON file fname, ignoring unwritable locations.
+
+           source: optional signature of the source data, e.g. from
+             util.source_signature(), to check in load()
+        """
+        tmpname = '%s.tmp%d' % (fname, os.getpid())
+        doc = self.to_dict()
+        if source is not None:
+            doc['source'] = source
+        try:
+            with open(tmpname, 'w') as f:
+                json.dump(doc, f)
+            os.rename(tmpname, fname)
+        except (IOError, OSError) as e:
+            print('Could not save image statistics %s: %s' % (fname, e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    @classmethod
+    def load(cls, fname, source=None):
+        """Return statistics loaded from JSON file fname, or None if unavailable.
+
+           If source is given, statistics saved with a different source
+           signature are also treated as unavailable.
+        """
+        try:
+            with open(fname, 'r') as f:
+                doc = json.load(f)
+            if source is not None and doc.get('source') != list(source):
+                return None
+            return cls.from_dict(doc)
+        except (IOError, OSError, ValueError, KeyError, AssertionError):
+            return None
+
+def image_stats(data, channels_last=True, slab_bytes=64*2**20):
+    """Return ImageStats for ndarray or lazy array data in one streaming pass.
+
+       data: array with channels on last axis, or single-channel
+         data when channels_last=False
+       slab_bytes: approximate buffer size for slabs read along
+         the first axis
+    """
+    dtype = np.dtype(data.dtype)
+    nchannels = channels_last and data.shape[-1] or 1
+    stats = ImageStats(nchannels, dtype.kind in 'uib')
+
+    row_bytes = dtype.itemsize
+    for n in data.shape[1:]:
+        row_bytes *= n
+    step = max(slab_bytes // max(row_bytes, 1), 1)
+    rest = tuple([ slice(None) for d in data.shape[1:] ])
+
+    for i in range(0, data.shape[0], step):
+        block = data[(slice(i, min(i + step, data.shape[0])),) + rest]
+        if not channels_last:
+            block = block[..., None]
+        stats.update(block)
+
+    return stats
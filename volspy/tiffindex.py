@@ -0,0 +1,328 @@
+#
+# Copyright 2017 University of Southern California
+# Distributed under the (new) BSD License. See LICENSE.txt for more info.
+#
+
+"""Minimal TIFF image file directory (IFD) index.
+
+The TiffIndex reads just enough of the TIFF structure to locate pixel
+data: image geometry, sample format, compression, and per-page strip
+or tile offsets and byte counts.  Opening an index only reads the
+file header and first IFD, which also carries the OME-XML metadata
+of an OME-TIFF file.  The remaining IFDs are scanned on demand with
+a few small reads each, without the full tag decoding performed by
+tifffile.
+
+Pages with common compression schemes can be decoded directly from
+their strips or tiles with decode_page(), so that previously indexed
+files can be read without tifffile parsing the file structure again.
+Uncompressed and deflate data are always supported, other schemes
+when tifffile (or imagecodecs) provides a decoder for them.
+
+"""
+
+import struct
+import zlib
+from collections import namedtuple
+from functools import reduce
+from xml.dom import minidom
+
+import numpy as np
+
+TiffPageInfo = namedtuple(
+    'TiffPageInfo',
+    [
+        'shape',           # page array shape, e.g. (H, W) or (H, W, S)
+        'dtype',           # numpy dtype string in file byte order
+        'compression',     # TIFF compression code, 1 means uncompressed
+        'predictor',       # TIFF predictor code, 1 means none
+        'tile',            # (TileLength, TileWidth) or None for strips
+        'rowsperstrip',    # rows per strip for strip layout
+        'dataoffsets',     # tuple of strip or tile file offsets
+        'databytecounts',  # tuple of strip or tile byte counts
+    ]
+)
+
+# TIFF field types as (struct format, item bytes)
+_field_types = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8), 13: ('I', 4), 16: ('Q', 8), 17: ('q', 8),
+    18: ('Q', 8),
+}
+
+_sample_formats = { 1: 'u', 2: 'i', 3: 'f' }
+
+# TIFF compression codes decoded directly, as {code: decompress(bytes)}
+_decompressors = {
+    1: lambda data: data,
+    8: zlib.decompress,
+    32946: zlib.decompress,
+}
+
+# LZW, PackBits, LZMA, and Zstd via tifffile's codec registry, which
+# needs the imagecodecs package for LZW and Zstd
+try:
+    from tifffile import TIFF
+    for _code in [5, 32773, 34925, 50000]:
+        try:
+            _decompressors[_code] = TIFF.DECOMPRESSORS[_code]
+        except (KeyError, ImportError):
+            pass
+except (ImportError, AttributeError):
+    pass
+
+def parse_ome_pixels(description):
+    """Return attribute dictionary of OME-XML Pixels element."""
+    d = minidom.parseString(description)
+    return dict(list(d.getElementsByTagName('Pixels')[0].attributes.items()))
+
+def page_contiguous(info):
+    """Return (offset, nbytes) if TiffPageInfo data is uncompressed and contiguous, else None."""
+    nbytes = reduce(lambda a, b: a*b, info.shape, 1) * np.dtype(info.dtype).itemsize
+    if info.compression != 1 or info.predictor != 1 or info.tile is not None:
+        return None
+    offset = info.dataoffsets[0]
+    pos = offset
+    for o, n in zip(info.dataoffsets, info.databytecounts):
+        if o != pos:
+            return None
+        pos += n
+    if pos - offset < nbytes:
+        return None
+    return (offset, nbytes)
+
+def can_decode(info):
+    """Return True if decode_page() supports the layout of TiffPageInfo."""
+    if info.compression not in _decompressors or len(info.shape) != 2:
+        return False
+    return info.predictor == 1 or (info.predictor == 2 and np.dtype(info.dtype).kind != 'f')
+
+def decode_page(fh, info, region=None):
+    """Return native-order page array for TiffPageInfo read from open file fh, or None if unsupported.
+
+       Handles single-sample pages in strip or tile layout, with
+       compression codes listed in _decompressors and optional
+       horizontal differencing predictor for integer samples.
+
+       With region=(y0, y1, x0, x1), only the strips or tiles
+       intersecting that window are read and decoded, and the
+       returned array covers just the window.
+    """
+    if not can_decode(info):
+        return None
+    decompress = _decompressors[info.compression]
+    dtype = np.dtype(info.dtype)
+
+    H, W = info.shape
+    if region is None:
+        region = (0, H, 0, W)
+    ry0, ry1, rx0, rx1 = region
+    out = np.empty((ry1 - ry0, rx1 - rx0), dtype.newbyteorder('='))
+
+    def read_block(i, h, w):
+        fh.seek(info.dataoffsets[i])
+        block = np.frombuffer(decompress(fh.read(info.databytecounts[i])), dtype=dtype, count=h*w).reshape(h, w)
+        if info.predictor == 2:
+            block = np.cumsum(block, axis=1, dtype=dtype)
+        return block
+
+    if info.tile is None:
+        th, tw = info.rowsperstrip, W
+    else:
+        th, tw = info.tile
+    across = (W + tw - 1) // tw
+    for ty in range(ry0 // th, (ry1 - 1) // th + 1):
+        y0 = ty * th
+        y1 = min(y0 + th, H)
+        for tx in range(rx0 // tw, (rx1 - 1) // tw + 1):
+            x0 = tx * tw
+            x1 = min(x0 + tw, W)
+            if info.tile is None:
+                # strips only cover rows of actual page height
+                block = read_block(ty, y1 - y0, W)
+            else:
+                block = read_block(ty * across + tx, th, tw)
+            a, b = max(y0, ry0), min(y1, ry1)
+            c, d = max(x0, rx0), min(x1, rx1)
+            out[a-ry0:b-ry0,c-rx0:d-rx0] = block[a-y0:b-y0,c-x0:d-x0]
+    return out
+
+class TiffIndex (object):
+
+    def __init__(self, filename):
+        """Index TIFF file by reading its header and first IFD."""
+        self.filename = filename
+        self._pages = None
+        self._ifd_offsets = None
+        with open(filename, 'rb') as fh:
+            header = fh.read(16)
+            if header[0:2] == b'II':
+                self.byteorder = '<'
+            elif header[0:2] == b'MM':
+                self.byteorder = '>'
+            else:
+                raise ValueError('%s is not a TIFF file' % filename)
+            version = struct.unpack(self.byteorder + 'H', header[2:4])[0]
+            if version == 42:
+                self.bigtiff = False
+                self.first_offset = struct.unpack(self.byteorder + 'I', header[4:8])[0]
+            elif version == 43:
+                self.bigtiff = True
+                self.first_offset = struct.unpack(self.byteorder + 'Q', header[8:16])[0]
+            else:
+                raise ValueError('%s has unknown TIFF version %d' % (filename, version))
+            tags, self.next_offset = self._read_ifd(fh, self.first_offset)
+            self.page0 = self._page_info(fh, tags)
+            self.description = self._tag_string(fh, tags.get(270))
+
+    def _read_ifd(self, fh, offset):
+        """Return ({tag: (type, count, value_bytes_or_offset)}, next_offset) for IFD at offset."""
+        if self.bigtiff:
+            count_fmt, entry_fmt, entry_size, inline_size = 'Q', 'HHQ8s', 20, 8
+        else:
+            count_fmt, entry_fmt, entry_size, inline_size = 'H', 'HHI4s', 12, 4
+        fh.seek(offset)
+        count_size = struct.calcsize(count_fmt)
+        count = struct.unpack(self.byteorder + count_fmt, fh.read(count_size))[0]
+        data = fh.read(count * entry_size + inline_size)
+        tags = dict()
+        for i in range(count):
+            tag, ftype, n, value = struct.unpack(self.byteorder + entry_fmt, data[i*entry_size:(i+1)*entry_size])
+            tags[tag] = (ftype, n, value)
+        next_offset = struct.unpack(self.byteorder + (self.bigtiff and 'Q' or 'I'), data[count*entry_size:])[0]
+        return tags, next_offset
+
+    def _tag_bytes(self, fh, entry):
+        """Return raw value bytes for tag entry, reading from file when not inline."""
+        ftype, n, value = entry
+        nbytes = n * _field_types[ftype][1]
+        if nbytes <= len(value):
+            return value[0:nbytes]
+        offset = struct.unpack(self.byteorder + (self.bigtiff and 'Q' or 'I'), value)[0]
+        fh.seek(offset)
+        return fh.read(nbytes)
+
+    def _tag_values(self, fh, entry, default=None):
+        """Return tuple of integer values for tag entry, or default if entry is None."""
+        if entry is None:
+            return default
+        ftype, n, value = entry
+        fmt = _field_types[ftype][0]
+        return tuple(np.frombuffer(self._tag_bytes(fh, entry), dtype=self.byteorder + fmt[0], count=n * len(fmt)).tolist())
+
+    def _tag_string(self, fh, entry):
+        if entry is None:
+            return None
+        return self._tag_bytes(fh, entry).rstrip(b'\0').decode('utf-8', 'replace')
+
+    def _page_info(self, fh, tags):
+        """Return TiffPageInfo for tags of one IFD."""
+        width = self._tag_values(fh, tags[256])[0]
+        length = self._tag_values(fh, tags[257])[0]
+        samples = self._tag_values(fh, tags.get(277), (1,))[0]
+        bits = self._tag_values(fh, tags.get(258), (1,))[0]
+        sampleformat = self._tag_values(fh, tags.get(339), (1,))[0]
+        compression = self._tag_values(fh, tags.get(259), (1,))[0]
+        predictor = self._tag_values(fh, tags.get(317), (1,))[0]
+        planar = self._tag_values(fh, tags.get(284), (1,))[0]
+
+        if bits % 8 or sampleformat not in _sample_formats:
+            raise ValueError('unsupported TIFF sample format %d bits %d' % (bits, sampleformat))
+        dtype = np.dtype('%s%s%d' % (self.byteorder, _sample_formats[sampleformat], bits // 8)).str
+
+        if samples == 1:
+            shape = (length, width)
+        elif planar == 2:
+            shape = (samples, length, width)
+        else:
+            shape = (length, width, samples)
+
+        if 322 in tags:
+            tile = (self._tag_values(fh, tags[323])[0], self._tag_values(fh, tags[322])[0])
+            offsets = self._tag_values(fh, tags[324])
+            counts = self._tag_values(fh, tags[325])
+        else:
+            tile = None
+            offsets = self._tag_values(fh, tags[273])
+            counts = self._tag_values(fh, tags[279])
+        rowsperstrip = min(self._tag_values(fh, tags.get(278), (length,))[0], length)
+
+        return TiffPageInfo(shape, dtype, compression, predictor, tile, rowsperstrip, offsets, counts)
+
+    def _scan(self):
+        pages = [ self.page0 ]
+        ifd_offsets = [ self.first_offset ]
+        seen = set(ifd_offsets)
+        offset = self.next_offset
+        with open(self.filename, 'rb') as fh:
+            while offset and offset not in seen:
+                seen.add(offset)
+                tags, next_offset = self._read_ifd(fh, offset)
+                pages.append(self._page_info(fh, tags))
+                ifd_offsets.append(offset)
+                offset = next_offset
+        self._pages = pages
+        self._ifd_offsets = ifd_offsets
+
+    @property
+    def pages(self):
+        """List of TiffPageInfo for all IFDs, scanned on first use."""
+        if self._pages is None:
+            self._scan()
+        return self._pages
+
+    @property
+    def ifd_offsets(self):
+        """List of file offsets of all IFDs, in the same order as pages."""
+        if self._ifd_offsets is None:
+            self._scan()
+        return self._ifd_offsets
+
+    def contiguous(self, page):
+        """Return (offset, nbytes) if page data is uncompressed and contiguous, else None."""
+        return page_contiguous(self.pages[page])
+
+    @property
+    def is_ome(self):
+        return self.description is not None \
+            and self.description.lstrip().startswith('<?xml') \
+            and '<OME' in self.description
+
+    def ome_series(self):
+        """Return (shape, axes, dtype, micron_spacing) for single-file OME-TIFF, else None.
+
+           The series is described from OME-XML metadata and first
+           page geometry alone, with planes stored one per IFD in
+           DimensionOrder sequence.  Returns None for layouts this
+           does not cover, e.g. multiple images, multi-file datasets,
+           explicit plane-to-IFD mappings, or multi-sample pages.
+        """
+        if not self.is_ome:
+            return None
+        d = minidom.parseString(self.description)
+        if len(d.getElementsByTagName('Image')) != 1 or d.getElementsByTagName('UUID'):
+            return None
+        tiffdata = d.getElementsByTagName('TiffData')
+        if len(tiffdata) > 1:
+            return None
+        for elem in tiffdata:
+            for k, v in elem.attributes.items():
+                if k not in ('IFD', 'FirstC', 'FirstT', 'FirstZ', 'PlaneCount') or (k != 'PlaneCount' and int(v) != 0):
+                    return None
+
+        a = parse_ome_pixels(self.description)
+        if len(self.page0.shape) != 2 or self.page0.shape != (int(a['SizeY']), int(a['SizeX'])):
+            return None
+
+        axes = ''.join(reversed(a['DimensionOrder'][2:])) + 'YX'
+        shape = tuple([ int(a['Size%s' % ax]) for ax in axes ])
+        try:
+            micron_spacing = (
+                float(a['PhysicalSizeZ']),
+                float(a['PhysicalSizeY']),
+                float(a['PhysicalSizeX'])
+            )
+        except KeyError:
+            micron_spacing = None
+        return shape, axes, np.dtype(self.page0.dtype).newbyteorder('='), micron_spacing
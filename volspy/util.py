@@ -4,16 +4,184 @@
 # Distributed under the (new) BSD License. See LICENSE.txt for more info.
 #
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
+import hashlib
+import json
 import os
+import itertools
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tifffile
 from tifffile import lazyattr
-from xml.dom import minidom
 from functools import reduce
 
+from .cache import page_cache
+from .lazy import LazyNDArray, ArrayLazyNDArray
+from .stats import ImageStats, image_stats
+from .tiffindex import TiffIndex, TiffPageInfo, decode_page, page_contiguous, parse_ome_pixels
+
 ImageMetadata = namedtuple('ImageMetadata', ['x_microns', 'y_microns', 'z_microns', 'axes'])
 
+def default_workers(envname='VOLSPY_WORKERS', default=1):
+    """Return default worker count for parallel processing from environment."""
+    try:
+        return max(int(os.getenv(envname, default)), 1)
+    except ValueError:
+        print('Invalid %s "%s", using %d instead' % (envname, os.getenv(envname), default))
+        return default
+
+def default_io_workers():
+    """Return default worker count for concurrent page decoding from VOLSPY_IO_WORKERS environment."""
+    return default_workers('VOLSPY_IO_WORKERS', default_workers())
+
+_io_pools = dict()
+_io_pools_lock = threading.Lock()
+
+def io_pool(workers):
+    """Return shared thread pool with given number of workers for concurrent I/O.
+
+       Pools persist for the life of the process so that per-thread
+       file handles can be reused by subsequent reads.
+    """
+    with _io_pools_lock:
+        pool = _io_pools.get(workers)
+        if pool is None:
+            pool = ThreadPool(workers)
+            _io_pools[workers] = pool
+        return pool
+
+_thread_state = threading.local()
+
+class ThreadHandles (object):
+    """Registry of file handles for fname private to each calling thread.
+
+       Handles are opened on first use by each thread, e.g. by I/O
+       pool workers, and all of them are closed by close().  A
+       thread using the registry after close() opens new handles.
+    """
+
+    _keys = itertools.count()
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.key = next(self._keys)
+        self.handles = []
+
+    def _get(self, kind, opener):
+        files = getattr(_thread_state, 'files', None)
+        if files is None:
+            files = _thread_state.files = dict()
+        entry = files.get((self.key, kind))
+        if entry is not None:
+            return entry[2]
+        # forget handles of this thread closed since its last use
+        for k in [ k for k, e in files.items() if e[0].key != e[1] ]:
+            del files[k]
+        h = opener(self.fname)
+        with self.lock:
+            files[(self.key, kind)] = (self, self.key, h)
+            self.handles.append(h)
+        return h
+
+    def file(self):
+        """Return raw binary file handle private to the calling thread."""
+        return self._get('file', lambda fname: open(fname, 'rb'))
+
+    def tifffile(self):
+        """Return tifffile.TiffFile private to the calling thread."""
+        return self._get('tifffile', tifffile.TiffFile)
+
+    def close(self):
+        """Close handles opened by all threads so far."""
+        with self.lock:
+            handles = self.handles
+            self.handles = []
+            self.key = next(self._keys)
+        for h in handles:
+            h.close()
+
+def reset_process_state():
+    """Discard thread pools and file handles inherited from a parent process, e.g. after fork.
+
+       Inherited handles stay registered with their ThreadHandles and
+       are closed along with it, but no thread here will use them.
+    """
+    global _io_pools, _io_pools_lock, _thread_state
+    _io_pools = dict()
+    _io_pools_lock = threading.Lock()
+    _thread_state = threading.local()
+
+def sidecar_filename(fname, tag):
+    """Return filename for derived data cached alongside source file fname."""
+    return '%s.volspy-%s' % (fname, tag)
+
+def source_signature(fname):
+    """Return [size, mtime] of source file fname to record in sidecar files, or None.
+
+       For directory sources such as plane stacks or chunked volumes,
+       sizes are summed and the latest mtime taken over the files in
+       the directory.
+    """
+    try:
+        if os.path.isdir(fname):
+            size, mtime = 0, os.stat(fname).st_mtime
+            for name in os.listdir(fname):
+                if name.startswith('.'):
+                    continue
+                st = os.stat(os.path.join(fname, name))
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+            return [size, mtime]
+        st = os.stat(fname)
+        return [st.st_size, st.st_mtime]
+    except OSError:
+        return None
+
+def view_cache_key(slice_origin, shape, reform_data=None):
+    """Return string identifying view data of an image ROI in sidecar file names.
+
+       Combines the ROI origin and shape with a digest of the
+       reform_data function identity and ZNOISE pre-processing
+       settings, which change values without changing shape.
+    """
+    roi = '_'.join([ '%d' % x for x in tuple(slice_origin) + tuple(shape) ])
+    if reform_data is not None:
+        func = getattr(reform_data, '__func__', reform_data)
+        reform = '%s.%s' % (
+            getattr(func, '__module__', ''),
+            getattr(func, '__qualname__', getattr(func, '__name__', repr(func)))
+        )
+    else:
+        reform = ''
+    znoise = os.getenv('ZNOISE_PERCENTILE') and 'znoise%s_%s' % (
+        os.getenv('ZNOISE_PERCENTILE'), os.getenv('ZNOISE_ZERO_LEVEL', 0)
+    ) or ''
+    digest = hashlib.md5(('%s;%s' % (reform, znoise)).encode('utf-8')).hexdigest()[0:12]
+    return '%s-%s' % (roi, digest)
+
+def cached_image_stats(data, fname, tag, channels_last=True):
+    """Return ImageStats for data, reusing sidecar file of source fname when fresh.
+
+       tag: sidecar name distinguishing this data from other data
+         derived from the same source file
+
+       The sidecar records the size and mtime of the source file and
+       is only reused while they match.
+    """
+    sidecar = fname and sidecar_filename(fname, tag)
+    source = fname and source_signature(fname)
+    if sidecar and source:
+        stats = ImageStats.load(sidecar, source)
+        if stats is not None and stats.nchannels == (channels_last and data.shape[-1] or 1):
+            print("Using image statistics from %s" % sidecar)
+            return stats
+    stats = image_stats(data, channels_last)
+    if sidecar and source:
+        stats.save(sidecar, source)
+    return stats
 
 def plane_distance(p, plane):
     """Return signed distance to plane of point."""
@@ -24,7 +192,60 @@ def plane_distance(p, plane):
 def clamp(x, x_min, x_max):
     return max(x_min, min(x, x_max))
 
-def bin_reduce(data, axes_s):
+def _bin_reduce_axes(data):
+    """Return data axes sorted by stride distance to optimize for locality."""
+    # doesn't seem to make much difference on modern systems...
+    axes = [ (axis, data.strides[axis]) for axis in range(data.ndim) ]
+    axes.sort(key=lambda p: p[1])
+    return [ p[0] for p in axes ]
+
+def _bin_reduce(data, axes_s, axes, accumulators=None):
+    """Reduce data one axis at a time in the given axes order.
+
+       When accumulators is a dict, float32 accumulation buffers are
+       kept there by axis and reused on subsequent calls with the same
+       input shape, instead of allocating fresh temporaries.
+
+    """
+    d1 = data
+
+    # reduce one axis at a time to shrink work for subsequent axes
+    for axis in axes:
+        s = axes_s[axis]
+
+        if s == 1:
+            # skip useless copying for non-reducing axis
+            continue
+
+        def axis_slice(slc):
+            return tuple(
+                [ slice(None) for i in range(axis) ]
+                + [ slc ]
+                + [ slice(None) for i in range(d1.ndim - axis - 1) ]
+            )
+
+        # accumulate s-strided subsets that belong to each bin
+        first = d1[axis_slice(slice(0, 1-s, s))]
+        if accumulators is None:
+            a = first.astype(np.float32, copy=True)
+        else:
+            a = accumulators.get(axis)
+            if a is None or a.shape != first.shape:
+                a = np.empty(first.shape, dtype=np.float32)
+                accumulators[axis] = a
+            a[...] = first
+        first = None
+
+        for step in range(1, s):
+            a += d1[axis_slice(slice(step, step < s and 1-s+step or None, s))]
+
+        # compute single-axis bin averages from accumulation
+        a *= (1./s)
+        d1 = a
+
+    return d1
+
+def bin_reduce(data, axes_s, streaming=None, workers=None):
     """Reduce ndarray data via bin-averaging for specified per-axis bin sizes.
 
        For a 3-D input data with shape (D, H, W) and axes_s of [s1, s2,
@@ -41,103 +262,334 @@ def bin_reduce(data, axes_s):
        it is the caller's responsibility to convert back to a desired
        type.
 
+       The streaming argument selects the out-of-core mode of
+       bin_reduce_streaming:
+         None:  stream lazy inputs such as TiffLazyNDArray (default)
+         True:  always stream
+         False: never stream
+
+       The workers argument sets a thread count for slab-parallel
+       reduction, defaulting to VOLSPY_WORKERS environment or 1.
+       Parallel reduction also uses the slab decomposition of
+       bin_reduce_streaming and returns identical results.
+
     """
-    d1 = data
-        
-    # sort axes by stride distance to optimize for locality
-    # doesn't seem to make much difference on modern systems...
-    axes = [ (axis, d1.strides[axis]) for axis in range(d1.ndim) ]
-    axes.sort(key=lambda p: p[1])
     assert len(axes_s) == data.ndim
 
-    # reduce one axis at a time to shrink work for subsequent axes
-    for axis in [p[0] for p in axes]:
-        s = axes_s[axis]
+    if not [ s for s in axes_s if s > 1 ]:
+        # nothing to reduce
+        return data
 
-        if s == 1:
-            # skip useless copying for non-reducing axis
-            continue
+    if workers is None:
+        workers = default_workers()
 
-        # accumulate s-strided subsets that belong to each bin
-        a = d1[ 
-            tuple(
-                [ slice(None) for i in range(axis) ]
-                + [ slice(0, 1-s, s) ]
-                + [ slice(None) for i in range(d1.ndim - axis - 1) ]
-            )
-        ].astype(np.float32, copy=True)
-        
-        for step in range(1, s):
-            a += d1[ 
-                tuple(
-                    [ slice(None) for i in range(axis) ]
-                    + [ slice(step, step < s and 1-s+step or None, s) ]
-                    + [ slice(None) for i in range(d1.ndim - axis - 1) ]
-                )
-            ]
+    if streaming is None:
+        streaming = hasattr(data, 'lazyget')
 
-        # compute single-axis bin averages from accumulation
-        d1 = a * (1./s)
+    if streaming or workers > 1:
+        return bin_reduce_streaming(data, axes_s, workers=workers)
+    else:
+        return _bin_reduce(data, axes_s, _bin_reduce_axes(data))
 
-    return d1
+def bin_reduce_streaming(data, axes_s, out=None, workers=1):
+    """Reduce data via bin-averaging one slab at a time along the first axis.
 
-class TiffLazyNDArray (object):
-    """Lazy wrapper for large TIFF image stacks.
+       Each slab holds axes_s[0] elements of the first axis, i.e. one
+       bin's worth of Z pages for ZYXC image data, and is reduced with
+       accumulation buffers reused from slab to slab.  Results are
+       written into out, or a newly allocated float32 array, which is
+       returned.
 
-       Supports some basic ND-array compatibility for data access,
-       with an intended use case of sub-block decomposition of large
-       TIFF stacks, where it is not desirable to hold the entire image
-       array in RAM at one time.
+       Results are identical to bin_reduce(data, axes_s, streaming=False)
+       but peak memory is bounded by the output size plus one slab,
+       so this is suitable for lazy TiffLazyNDArray input much larger
+       than RAM.
 
-       Slicing via the usual __getitem__ interface will perform
-       memmapped file I/O to build and return an actual numpy
-       ND-array.
+       With workers > 1, slabs are reduced concurrently by a thread
+       pool, and slabs are further split into bands along the second
+       axis when there are fewer slabs than workers.  Peak memory
+       then grows to the output plus one slab per worker.
+
+    """
+    assert len(axes_s) == data.ndim
+
+    out_shape = tuple([ n // s for n, s in zip(data.shape, axes_s) ])
+    if out is None:
+        out = np.empty(out_shape, dtype=np.float32)
+    assert out.shape == out_shape
+
+    # use same axis order as whole-array reduction for identical rounding
+    axes = _bin_reduce_axes(data)
+
+    if data.ndim < 2:
+        out[...] = _bin_reduce(data, axes_s, axes)
+        return out
+
+    # trim partial bins which would be discarded anyway
+    s0 = axes_s[0]
+    s1 = axes_s[1]
+    rest = tuple([ slice(0, n * s) for n, s in zip(out_shape[2:], axes_s[2:]) ])
+
+    # split second axis into bands if needed to keep workers busy
+    nbands = 1
+    if workers > 1 and out_shape[0] < workers:
+        nbands = min(-(-workers // max(out_shape[0], 1)), out_shape[1])
+    bands = [
+        (out_shape[1] * b // nbands, out_shape[1] * (b+1) // nbands)
+        for b in range(nbands)
+    ]
+    tasks = [ (i, j0, j1) for i in range(out_shape[0]) for j0, j1 in bands if j1 > j0 ]
+
+    local = threading.local()
+
+    def reduce_slab(task):
+        i, j0, j1 = task
+        if not hasattr(local, 'accumulators'):
+            local.accumulators = dict()
+        slab = data[(slice(i * s0, (i+1) * s0), slice(j0 * s1, j1 * s1)) + rest]
+        out[i:i+1,j0:j1] = _bin_reduce(slab, axes_s, axes, local.accumulators)
+
+    if workers > 1 and len(tasks) > 1:
+        pool = ThreadPool(min(workers, len(tasks)))
+        try:
+            pool.map(reduce_slab, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            reduce_slab(task)
 
-       Basic min/max methods will stream through the whole image file
-       while only buffering one page of image data at a time.
+    return out
 
+def pack_texture3d(data, channels, out, minval, scale, slab_bytes=16*2**20):
+    """Pack normalized channels of ZYXC data into interleaved out array, returning out.
+
+       Each selected channel c = channels[i] is mapped as
+
+         out[...,i] = (data[...,c] - minval) * scale
+
+       in float32 arithmetic and cast to the dtype of out, which must
+       have shape (D, H, W, len(channels)).
+
+       Work proceeds one Z slab of about slab_bytes of float32 data
+       at a time, reusing one scratch buffer for all slabs and
+       channels, so no full-volume temporaries are made.  The
+       result is identical to whole-array conversion.
+    """
+    D, H, W = data.shape[0:3]
+    assert out.shape == (D, H, W, len(channels))
+    step = max(slab_bytes // max(H * W * 4, 1), 1)
+    scratch = np.empty((min(step, D), H, W), dtype=np.float32)
+    minval = np.float32(minval)
+    scale = np.float32(scale)
+
+    for z0 in range(0, D, step):
+        z1 = min(z0 + step, D)
+        buf = scratch[0:z1-z0]
+        for i, c in enumerate(channels):
+            buf[...] = data[(slice(z0, z1), slice(None), slice(None), c)]
+            buf -= minval
+            buf *= scale
+            out[z0:z1,:,:,i] = buf
+    return out
+
+def page_region(page_slice, page_shape):
+    """Return ((y0, y1, x0, x1), local_slice) bounding 2D page_slice, or None for whole page.
+
+       The region can be decoded by tiffindex.decode_page(), and
+       local_slice applied to the decoded region gives page_slice.
+    """
+    if len(page_slice) != 2 or len(page_shape) != 2:
+        return None
+    bounds = []
+    local = []
+    for slc in page_slice:
+        if isinstance(slc, slice):
+            last = slc.start + ((slc.stop - 1 - slc.start) // slc.step) * slc.step
+            bounds += [ slc.start, last + 1 ]
+            local.append(slice(0, last + 1 - slc.start, slc.step))
+        else:
+            bounds += [ slc, slc + 1 ]
+            local.append(0)
+    if bounds == [ 0, page_shape[0], 0, page_shape[1] ]:
+        return None
+    return tuple(bounds), tuple(local)
+
+class PagePrefetcher (object):
+    """Background read-ahead of TIFF pages for sequential access.
+
+       Readers advise() each page they request.  Once consecutive
+       requests step through pages with a constant positive stride,
+       a background thread reads up to depth pages ahead.  Compressed
+       pages are decoded into a bounded buffer for take().
+       Uncompressed pages are just read to warm the OS file cache for
+       the memory-mapped reads that follow.
     """
 
-    def __init__(self, src, _output_plan=None):
-        """Wrap an image source given by filename or an existing tifffile.TiffFile instance."""
-        if isinstance(src, str):
-            self.tf = tifffile.TiffFile(src)
-        elif isinstance(src, tifffile.TiffFile):
-            self.tf = src
-        elif isinstance(src, TiffLazyNDArray):
-            self.tf = src.tf
+    def __init__(self, source, depth):
+        self.source = source
+        self.depth = depth
+        self.cond = threading.Condition()
+        self.ready = OrderedDict()
+        self.pending = deque()
+        self.inflight = None
+        self.last = None
+        self.stride = None
+        self.thread = None
+        self.hits = 0
+
+    def advise(self, page):
+        """Note request for page and schedule read-ahead if access is sequential."""
+        with self.cond:
+            stride = self.last is not None and page - self.last or None
+            sequential = stride is not None and stride > 0 and (stride == 1 or stride == self.stride)
+            self.last = page
+            self.stride = stride
+            if not sequential:
+                self.pending.clear()
+                return
+            # discard buffered pages already passed by the reader
+            for p in list(self.ready):
+                if p < page:
+                    del self.ready[p]
+            for i in range(1, self.depth + 1):
+                p = page + i * stride
+                if p >= self.source.npages:
+                    break
+                if p not in self.ready and p not in self.pending and p != self.inflight \
+                   and (self.source.filename, p) not in page_cache:
+                    self.pending.append(p)
+            if self.pending:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run)
+                    self.thread.daemon = True
+                    self.thread.start()
+                self.cond.notify_all()
+
+    def take(self, page):
+        """Return prefetched page array or None, waiting if page is being read ahead."""
+        with self.cond:
+            while page == self.inflight:
+                self.cond.wait()
+            p = self.ready.pop(page, None)
+            if p is not None:
+                self.hits += 1
+            return p
+
+    def _fetch(self, page):
+        fh = self.source.thread_handles.file()
+        contig = self.source.pages is not None and self.source.contiguous(page)
+        if contig:
+            # warm OS cache for memory-mapped read
+            fh.seek(contig[0])
+            fh.read(contig[1])
+            return None
+        p = self.source.decode_page(page, fh)
+        if p is None:
+            p = self.source.thread_handles.tifffile().series[0].pages[page].asarray()
+        p.flags.writeable = False
+        return p
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                page = self.pending.popleft()
+                self.inflight = page
+            p = None
+            try:
+                p = self._fetch(page)
+            except Exception as e:
+                print('Prefetch of page %d failed: %s' % (page, e))
+            finally:
+                with self.cond:
+                    self.inflight = None
+                    if p is not None:
+                        self.ready[page] = p
+                        while len(self.ready) > self.depth:
+                            self.ready.popitem(last=False)
+                    self.cond.notify_all()
+
+class TiffSource (object):
+    """Shared state of a TIFF file wrapped by TiffLazyNDArray views.
+
+       Opening a file by name only reads its header and first IFD
+       via TiffIndex.  For single-file OME-TIFF, the image series is
+       described from OME-XML metadata and the page offsets are
+       scanned from the IFD chain when first needed.  The complete
+       tifffile.TiffFile structure, which parses every IFD, is opened
+       on demand for other formats and to decode pages with
+       compression schemes not handled by tiffindex.decode_page().
+
+       Once page offsets are known, the series description and
+       per-page layout are saved in a JSON sidecar file.  Later opens
+       of the same unmodified file load that sidecar and read pixels
+       directly, without parsing the TIFF structure at all.
 
+    """
+
+    index_version = 1
+
+    def __init__(self, filename=None, tf=None):
+        self.filename = filename
+        # serialize access to shared file handles by concurrent readers
+        self.io_lock = threading.RLock()
+        self._tf = tf
+        self._tf_given = tf
+        self._fh = None
+        self._pages = None
+        self._prefetcher = None
+        self.index = None
+        self.micron_spacing = None
+        # private handles of I/O worker threads, closed with this source
+        self.thread_handles = ThreadHandles(filename)
+        if hasattr(weakref, 'finalize'):
+            weakref.finalize(self, self.thread_handles.close)
+
+        if tf is None and self._load_index():
+            return
+
+        series = None
+        if tf is None:
+            try:
+                self.index = TiffIndex(filename)
+                series = self.index.ome_series()
+            except (IOError, ValueError, KeyError) as e:
+                print('TIFF index unavailable for %s: %s' % (filename, e))
+                self.index = None
+
+        if series is not None:
+            self.shape, self.axes, self.dtype, self.micron_spacing = series
+            self.byteorder = self.index.byteorder
+            self.stack_ndim = len(self.shape) - 2
+            self.npages = reduce(lambda a,b: a*b, self.shape[0:self.stack_ndim], 1)
+            print("TIFF %s %s %s, page0 %s, stack %s, axes %s? (OME metadata)" % (
+                self.shape, self.axes, self.dtype, self.shape[self.stack_ndim:], self.shape[0:self.stack_ndim], self.axes
+            ))
+        else:
+            self._init_from_tifffile()
+
+    def _init_from_tifffile(self):
         tfimg = self.tf.series[0]
         page0 = tfimg.pages[0]
 
         self.dtype = tfimg.dtype
-        self.tf_shape = tfimg.shape
-        self.tf_axes = tfimg.axes
-        
+        self.shape = tfimg.shape
+        self.axes = tfimg.axes
+        self.byteorder = self.tf.byteorder
+
         self.stack_ndim = len(tfimg.shape) - len(page0.shape)
-        self.stack_shape = tfimg.shape[0:self.stack_ndim]
-        print("TIFF %s %s %s, page0 %s, stack %s, axes %s?" % (tfimg.shape, tfimg.axes, tfimg.dtype, page0.shape, self.stack_shape, tfimg.axes))
-        assert reduce(lambda a,b: a*b, self.stack_shape, 1) == len(tfimg.pages)
+        stack_shape = tfimg.shape[0:self.stack_ndim]
+        self.npages = len(tfimg.pages)
+        print("TIFF %s %s %s, page0 %s, stack %s, axes %s?" % (tfimg.shape, tfimg.axes, tfimg.dtype, page0.shape, stack_shape, tfimg.axes))
+        assert reduce(lambda a,b: a*b, stack_shape, 1) == len(tfimg.pages)
         assert tfimg.shape[self.stack_ndim:] == page0.shape, "TIFF page packing structure not understood"
 
-        if _output_plan:
-            self.output_plan = _output_plan
-        else:
-            self.output_plan = [
-                (a, slice(0, self.tf_shape[a], 1), slice(0, self.tf_shape[a], 1))
-                for a in range(len(tfimg.shape))
-            ]
-
-        if isinstance(src, TiffLazyNDArray):
-            # preserve existing metadata
-            self.micron_spacing = src.micron_spacing
-        elif self.tf.is_ome:
+        if self.tf.is_ome:
             # get OME-TIFF XML metadata
-            p = list(self.tf)[0]
-            d = minidom.parseString(p.tags['image_description'].value)
-            a = dict(list(d.getElementsByTagName('Pixels')[0].attributes.items()))
-            p = None
-            d = None
+            a = parse_ome_pixels(self.tf.pages[0].tags['image_description'].value)
             assert len(self.tf.series) == 1
 
             self.micron_spacing = (
@@ -146,11 +598,8 @@ class TiffLazyNDArray (object):
                 float(a['PhysicalSizeX'])
             )
         elif self.tf.is_lsm:
-            # get LSM metadata
-            lsmi = None
-            for page in self.tf:
-                if page.is_lsm:
-                    lsmi = page.cz_lsm_info
+            # get LSM metadata from first page
+            lsmi = self.tf.pages[0].cz_lsm_info
 
             assert lsmi is not None
 
@@ -160,80 +609,394 @@ class TiffLazyNDArray (object):
                 lsmi.voxel_size_x * 10**6
             )
 
-    def _plan_slicing(self, key):
-        assert isinstance(key, tuple)
-        tfimg = self.tf.series[0]
-        output_plan = [
-            (tf_axis, in_slice, out_slice)
-            for tf_axis, in_slice, out_slice in self.output_plan
-            if out_slice is None and in_slice is not None
-        ]
+            if self.index is not None and os.path.getsize(self.filename) >= 2**32:
+                # tifffile corrects wrapped 32-bit strip offsets of large LSM files
+                self.index = None
 
-        current_plan = [ # FIFO of dimensions projected by key
-            (tf_axis, in_slice, out_slice)
-            for tf_axis, in_slice, out_slice in self.output_plan
-            if out_slice is not None
-        ]
-        
-        for elem in key:
-            if elem is None:
-                # inject fake output dimension
-                tf_axis = None
-                out_slice = slice(0,1,1)
-                in_slice = None
-            else:
-                tf_axis, in_slice, out_slice = current_plan.pop(0)
-                if isinstance(elem, int):
-                    # collapse projected dimension
-                    if elem < 0:
-                        elem += out_slice.stop
-                    if elem >= out_slice.stop or elem < 0:
-                        raise IndexError('index %d out of range [0,%d)' % (elem, out_slice.stop))
-                    if isinstance(in_slice, slice):
-                        in_slice = elem + in_slice.start
-                    else:
-                        continue
-                    out_slice = None
-                elif isinstance(elem, slice):
-                    # modify sliced dimension
-                    if elem.step is None:
-                        step = 1
-                    else:
-                        step = elem.step
-                    assert step > 0, "only positive stepping is supported"
-                    if elem.start is None:
-                        start = 0
-                    elif elem.start < 0:
-                        start = elem.start + out_slice.stop
-                    else:
-                        start = elem.start
-                    if elem.stop is None:
-                        stop = out_slice.stop
-                    elif elem.stop < 0:
-                        stop = elem.stop + out_slice.stop
-                    else:
-                        stop = elem.stop
-                    start = max(min(start, out_slice.stop), 0)
-                    stop = max(min(stop, out_slice.stop), 0)
-                    assert start < stop, "empty slicing not supported"
-                    if isinstance(in_slice, slice):
-                        in_slice = slice(in_slice.start + start, in_slice.start + stop, in_slice.step * step)
-                        w = in_slice.stop - in_slice.start
-                        w = w/in_slice.step + (w%in_slice.step and 1 or 0)
-                        out_slice = slice(0,w,1)
-                    else:
-                        in_slice = None
-                        out_slice = slice(0,1,1)
-            output_plan.append((tf_axis, in_slice, out_slice))
-
-        assert not current_plan, "slicing key must project all image dimensions"
-            
-        return output_plan
-            
-    def __getitem__(self, key):
-        tfimg = self.tf.series[0]
-        output_plan = self._plan_slicing(key)
-        
+    @property
+    def tf(self):
+        """The tifffile.TiffFile for this source, opened on first use."""
+        with self.io_lock:
+            if self._tf is None:
+                self._tf = tifffile.TiffFile(self.filename)
+            return self._tf
+
+    def close(self):
+        """Close file handles opened by this source, including those of I/O worker threads.
+
+           A tifffile.TiffFile passed to the constructor is left open.
+           Later reads reopen the file.
+        """
+        with self.io_lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            if self._tf is not None and self._tf is not self._tf_given:
+                self._tf.close()
+                self._tf = None
+        self.thread_handles.close()
+
+    @property
+    def prefetcher(self):
+        """PagePrefetcher reading VOLSPY_PREFETCH pages ahead, or None if disabled."""
+        if self._prefetcher is None and self.filename is not None:
+            try:
+                depth = int(os.getenv('VOLSPY_PREFETCH', 0))
+            except ValueError:
+                print('Invalid VOLSPY_PREFETCH "%s", using 0 instead' % os.getenv('VOLSPY_PREFETCH'))
+                depth = 0
+            with self.io_lock:
+                if self._prefetcher is None:
+                    self._prefetcher = depth > 0 and PagePrefetcher(self, depth) or False
+        return self._prefetcher or None
+
+    @property
+    def fh(self):
+        """Shared raw file handle for direct reads, opened on first use."""
+        with self.io_lock:
+            if self._fh is None:
+                self._fh = open(self.filename, 'rb')
+            return self._fh
+
+    @property
+    def pages(self):
+        """List of TiffPageInfo for each series page, or None if not indexed.
+
+           The IFD chain is scanned on first use and the result saved
+           in the index sidecar file.
+        """
+        with self.io_lock:
+            if self._pages is None and self.index is not None:
+                try:
+                    self._pages = self._series_pages()
+                except (IOError, ValueError, KeyError) as e:
+                    print('TIFF index unavailable for %s: %s' % (self.filename, e))
+                if self._pages is None:
+                    self.index = None
+                else:
+                    self._save_index()
+            return self._pages
+
+    def _series_pages(self):
+        """Return index pages for series pages, or None if they cannot be matched."""
+        if self._tf is None:
+            # OME metadata maps series pages to leading IFDs
+            assert len(self.index.pages) >= self.npages, "TIFF has fewer pages than series metadata"
+            return self.index.pages[0:self.npages]
+        if len(self.index.pages) == self.npages:
+            return self.index.pages
+        # IFD chain also holds other images, e.g. LSM thumbnails
+        pages = dict(zip(self.index.ifd_offsets, self.index.pages))
+        offsets = [ getattr(page, 'offset', None) for page in self.tf.series[0].pages ]
+        if None in offsets or not set(offsets).issubset(pages):
+            return None
+        return [ pages[offset] for offset in offsets ]
+
+    def _index_filename(self):
+        return sidecar_filename(self.filename, 'index.json')
+
+    def _load_index(self):
+        """Restore series description from index sidecar file if it matches the file, returning True on success."""
+        if self.filename is None or os.getenv('VOLSPY_TIFF_INDEX', 'true').lower() == 'false':
+            return False
+        try:
+            with open(self._index_filename(), 'r') as f:
+                doc = json.load(f)
+            st = os.stat(self.filename)
+            if doc['version'] != self.index_version or doc['size'] != st.st_size or doc['mtime'] != st.st_mtime:
+                return False
+            self.shape = tuple(doc['shape'])
+            self.axes = doc['axes']
+            self.dtype = np.dtype(doc['dtype'])
+            self.byteorder = doc['byteorder']
+            self.stack_ndim = doc['stack_ndim']
+            self.npages = len(doc['dataoffsets'])
+            self.micron_spacing = doc['micron_spacing'] and tuple(doc['micron_spacing'])
+            page = doc['page']
+            tile = page['tile'] and tuple(page['tile'])
+            self._pages = [
+                TiffPageInfo(
+                    tuple(page['shape']), page['dtype'], page['compression'], page['predictor'],
+                    tile, page['rowsperstrip'], tuple(offsets), tuple(counts)
+                )
+                for offsets, counts in zip(doc['dataoffsets'], doc['databytecounts'])
+            ]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+        print("TIFF %s %s %s, page0 %s, stack %s, axes %s? (cached index)" % (
+            self.shape, self.axes, self.dtype, self.shape[self.stack_ndim:], self.shape[0:self.stack_ndim], self.axes
+        ))
+        return True
+
+    def _save_index(self):
+        """Save series description and page layout to index sidecar file, if possible."""
+        if self.filename is None or os.getenv('VOLSPY_TIFF_INDEX', 'true').lower() == 'false':
+            return
+        page0 = self._pages[0]
+        for page in self._pages:
+            if page[0:6] != page0[0:6]:
+                # page layouts differ, leave description to tifffile
+                return
+        st = os.stat(self.filename)
+        doc = {
+            'version': self.index_version,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'shape': list(self.shape),
+            'axes': self.axes,
+            'dtype': np.dtype(self.dtype).str,
+            'byteorder': self.byteorder,
+            'stack_ndim': self.stack_ndim,
+            'micron_spacing': self.micron_spacing and list(self.micron_spacing),
+            'page': {
+                'shape': list(page0.shape),
+                'dtype': page0.dtype,
+                'compression': page0.compression,
+                'predictor': page0.predictor,
+                'tile': page0.tile and list(page0.tile),
+                'rowsperstrip': page0.rowsperstrip,
+            },
+            'dataoffsets': [ list(page.dataoffsets) for page in self._pages ],
+            'databytecounts': [ list(page.databytecounts) for page in self._pages ],
+        }
+        fname = self._index_filename()
+        tmpname = '%s.tmp%d' % (fname, os.getpid())
+        try:
+            with open(tmpname, 'w') as f:
+                json.dump(doc, f)
+            os.rename(tmpname, fname)
+        except (IOError, OSError) as e:
+            print('Could not save TIFF index %s: %s' % (fname, e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def contiguous(self, page):
+        """Return (offset, nbytes) if page data is uncompressed and contiguous, else None."""
+        pages = self.pages
+        if pages is not None:
+            return page_contiguous(pages[page])
+        with self.io_lock:
+            page = self.tf.series[0].pages[page]
+            if page.shape != self.shape[self.stack_ndim:]:
+                return None
+            return page.is_contiguous
+
+    def decode_page(self, page, fh=None, region=None):
+        """Return page array decoded directly from indexed strips or tiles, or None if unsupported.
+
+           Reads via the given file handle, or else the shared handle
+           while holding io_lock.  With region=(y0, y1, x0, x1), only
+           decodes strips or tiles intersecting that window and
+           returns the window.
+        """
+        pages = self.pages
+        if pages is None or pages[page].shape != self.shape[self.stack_ndim:]:
+            return None
+        if fh is not None:
+            return decode_page(fh, pages[page], region)
+        with self.io_lock:
+            return decode_page(self.fh, pages[page], region)
+
+class TiffLazyNDArray (LazyNDArray):
+    """Lazy wrapper for large TIFF image stacks.
+
+       Supports some basic ND-array compatibility for data access,
+       with an intended use case of sub-block decomposition of large
+       TIFF stacks, where it is not desirable to hold the entire image
+       array in RAM at one time.
+
+       Slicing via the usual __getitem__ interface will perform
+       memmapped file I/O to build and return an actual numpy
+       ND-array.  When the whole series is uncompressed and
+       contiguous in the file, reads use one series_memmap instead of
+       page-by-page I/O, and force() returns a zero-copy view.
+
+       Basic min/max methods use per-channel statistics gathered in
+       one streaming pass over the view, buffering one slab of image
+       data at a time, and cached alongside the file for later runs.
+
+       The iter_blocks() and map_blocks() methods visit the view as a
+       grid of blocks with optional halos, the latter applying a
+       function to all blocks in parallel worker processes.
+
+       Decoded pages of compressed files are kept in the shared
+       cache.page_cache so repeated reads of the same pages do not
+       decode them again.  Pages of compressed files are decoded
+       concurrently by VOLSPY_IO_WORKERS threads, each with its own
+       file handle.  With VOLSPY_PREFETCH set, a background thread
+       reads ahead of page accesses that advance with a steady
+       stride, e.g. stepping through Z.
+
+    """
+
+    def __init__(self, src, _output_plan=None):
+        """Wrap an image source given by filename or an existing tifffile.TiffFile instance."""
+        if isinstance(src, TiffLazyNDArray):
+            self.source = src.source
+        elif isinstance(src, str):
+            self.source = TiffSource(os.path.abspath(src))
+        elif isinstance(src, tifffile.TiffFile):
+            self.source = TiffSource(getattr(getattr(src, 'filehandle', None), 'path', None), src)
+
+        self.io_lock = self.source.io_lock
+        self.filename = self.source.filename
+        if isinstance(src, TiffLazyNDArray):
+            self.cache_key = src.cache_key
+        else:
+            # identify file in shared page cache
+            self.cache_key = self.filename
+
+        if isinstance(src, TiffLazyNDArray):
+            # derived views keep any transformation of page data
+            self.dtype = src.dtype
+            self.page_transform = src.page_transform
+            self.page_transform_key = src.page_transform_key
+        else:
+            self.dtype = self.source.dtype
+            self.page_transform = None
+            self.page_transform_key = None
+        self.tf_shape = self.source.shape
+        self.tf_axes = self.source.axes
+        self.input_shape = self.tf_shape
+        self.input_axes = self.tf_axes
+        self.stack_ndim = self.source.stack_ndim
+        self.stack_shape = self.tf_shape[0:self.stack_ndim]
+        self.npages = reduce(lambda a,b: a*b, self.stack_shape, 1)
+
+        self._init_output_plan(_output_plan)
+
+        if isinstance(src, TiffLazyNDArray):
+            # preserve existing metadata
+            if hasattr(src, 'micron_spacing'):
+                self.micron_spacing = src.micron_spacing
+            if 'series_memmap' in src.__dict__:
+                # share mapping already detected by src
+                self.series_memmap = src.series_memmap
+        elif self.source.micron_spacing is not None:
+            self.micron_spacing = self.source.micron_spacing
+
+    def __getstate__(self):
+        """Pickle view by filename, so that other processes reopen the file themselves."""
+        assert self.filename is not None, "cannot pickle view of TIFF file without filename"
+        state = dict(self.__dict__)
+        for k in ['source', 'io_lock', 'series_memmap', 'is_memmappable', 'stats', 'min_max']:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.source = TiffSource(self.filename)
+        self.io_lock = self.source.io_lock
+
+    @property
+    def tf(self):
+        return self.source.tf
+
+    def _view_key(self):
+        key = LazyNDArray._view_key(self)
+        if self.page_transform_key is not None:
+            key += self.page_transform_key
+        return key
+
+    def _read_page(self, page, private_handle=False):
+        """Return read-only page array, using shared page cache for decoded pages.
+
+           Memory-mapped pages of uncompressed files are cheap to
+           re-read and bypass the cache.
+
+           Indexed pages are read directly from the file, falling
+           back to tifffile for unsupported compression schemes.  With
+           private_handle=True, read the page via a file handle
+           private to the calling thread rather than the shared handle.
+        """
+        prefetcher = self.source.prefetcher
+        if prefetcher is not None:
+            prefetcher.advise(page)
+
+        key = (self.cache_key, page)
+        if self.cache_key is not None:
+            p = page_cache.get(key)
+            if p is not None:
+                return p
+
+        contig = self.source.pages is not None and self.source.contiguous(page)
+        p = None
+        if contig:
+            p = np.memmap(
+                self.filename,
+                dtype=np.dtype(self.source.dtype).newbyteorder(self.source.byteorder),
+                mode='r',
+                offset=contig[0],
+                shape=self.tf_shape[self.stack_ndim:]
+            )
+        elif prefetcher is not None:
+            # page may have been decoded ahead
+            p = prefetcher.take(page)
+
+        if p is None and private_handle:
+            p = self.source.decode_page(page, self.source.thread_handles.file())
+            if p is None:
+                p = self.source.thread_handles.tifffile().series[0].pages[page].asarray(memmap=True)
+        elif p is None:
+            p = self.source.decode_page(page)
+            if p is None:
+                with self.io_lock:
+                    p = self.tf.series[0].pages[page].asarray(memmap=True)
+
+        if isinstance(p, np.memmap):
+            # don't bother caching or counting misses for this file
+            self.cache_key = None
+        elif self.cache_key is not None:
+            p.flags.writeable = False
+            page_cache.put(key, p)
+        return p
+
+    def _page_data(self, page, page_slice, private_handle=False):
+        """Return page_slice of page data, after page_transform if any.
+
+           Partial reads of compressed or tiled pages that are not
+           already cached decode only the strips or tiles intersecting
+           page_slice, without caching the partial page.
+        """
+        p = None
+        if self.source.pages is not None and not self.is_memmappable \
+           and (self.cache_key is None or (self.cache_key, page) not in page_cache):
+            region = page_region(page_slice, self.tf_shape[self.stack_ndim:])
+            if region is not None:
+                p = self.source.decode_page(page, private_handle and self.source.thread_handles.file() or None, region[0])
+                if p is not None:
+                    p = p[region[1]]
+        if p is None:
+            p = self._read_page(page, private_handle)[page_slice]
+        if self.page_transform is not None:
+            p = self.page_transform(self, page, page_slice, p)
+        return p
+
+    def with_page_transform(self, transform, dtype, key):
+        """Return view whose page data is mapped by transform as pages are read.
+
+           transform: callable (view, page, page_slice, data) returning
+             the transformed page_slice of the given page, where
+             data is that slice of the raw page
+           dtype: dtype of transformed data
+           key: string identifying transform in cached statistics
+
+           The transform is fused into page-by-page reads, so derived
+           views and block reads never materialize the raw image.  It
+           should be picklable for use with map_blocks().
+        """
+        view = TiffLazyNDArray(self, self.output_plan)
+        view.dtype = np.dtype(dtype)
+        view.page_transform = transform
+        view.page_transform_key = key
+        return view
+
+    def _read(self, output_plan, copy=True):
+        """Return ND-array for output_plan.
+
+           With copy=False, return a read-only view of the
+           series_memmap if one is available.
+        """
         # skip fake dimensions for intermediate buffer
         buffer_plan = [
             (tf_axis, in_slice, out_slice)
@@ -244,7 +1007,7 @@ class TiffLazyNDArray (object):
         # input will be untransposed with dimension in TIFF order
         input_plan = list(buffer_plan)
         input_plan.sort(key=lambda p: p[0])
-        assert len(input_plan) == len(tfimg.shape)
+        assert len(input_plan) == len(self.tf_shape)
         
         # buffer may have fewer dimensions than input slicing due to integer keys
         buffer_shape = tuple([
@@ -256,7 +1019,19 @@ class TiffLazyNDArray (object):
             tf_axis
             for tf_axis, in_slice, out_slice in input_plan
             if isinstance(in_slice, slice)
-        ]        
+        ]
+
+        if self.page_transform is None:
+            series_memmap = self.series_memmap
+        else:
+            series_memmap = None
+        if series_memmap is not None:
+            # strided view of all requested pages in one mapping
+            buffer = series_memmap[tuple([ p[1] for p in input_plan ])]
+            if copy:
+                buffer = np.array(buffer, dtype=self.dtype)
+            return self._transpose_buffer(buffer, buffer_axes, output_plan)
+
         buffer = np.empty(buffer_shape, self.dtype)
 
         # generate page-by-page slicing
@@ -267,9 +1042,9 @@ class TiffLazyNDArray (object):
             if stack_plan:
                 tf_axis, in_slice, out_slice = stack_plan[0]
                 if isinstance(in_slice, slice):
-                    for x in range(in_slice.start, in_slice.stop):
+                    for x in range(in_slice.start, in_slice.stop, in_slice.step):
                         for outslc, inslc in generate_io_slices(stack_plan[1:], page_plan):
-                            yield ((x - in_slice.start,) + outslc, (x,) + inslc)
+                            yield (((x - in_slice.start) // in_slice.step,) + outslc, (x,) + inslc)
                 elif isinstance(in_slice, int):
                     for outslc, inslc in generate_io_slices(stack_plan[1:], page_plan):
                         yield (outslc, (in_slice,) + inslc)
@@ -283,104 +1058,64 @@ class TiffLazyNDArray (object):
             for i in range(self.stack_ndim)
         ]
 
-        # perform actual pixel I/O
-        for out_slicing, in_slicing in generate_io_slices(stack_plan, page_plan):
-            page = sum(map(lambda c, s: c*s, in_slicing[0:self.stack_ndim], stack_spans))
-            page_slice = in_slicing[self.stack_ndim:]
-            buffer[out_slicing] = tfimg.pages[page].asarray(memmap=True)[page_slice]
-            
-        # apply current transposition to buffered dimensions
-        buffer_axis = dict([(buffer_axes[d], d) for d in range(len(buffer_axes))])
-        transposition = [
-            buffer_axis[tf_axis]
-            for tf_axis, in_slice, out_slice in output_plan
-            if isinstance(in_slice, slice)
-        ]
-        buffer = buffer.transpose(tuple(transposition))
-        
-        out_slicing = [
-            in_slice is not None and out_slice or in_slice
-            for tf_axis, in_slice, out_slice in output_plan
-            if isinstance(in_slice, slice) or in_slice is None
-        ]
-        return buffer[tuple(out_slicing)]
-        
-    def transpose(self, *transposition):
-        output_plan = [
-            (tf_axis, in_slice, out_slice)
-            for tf_axis, in_slice, out_slice in self.output_plan
-            if out_slice is None
-        ]
-        current_plan = [ # FIFO of dimensions projected by key
-            (tf_axis, in_slice, out_slice)
-            for tf_axis, in_slice, out_slice in self.output_plan
-            if out_slice is not None
+        io_slices = [
+            (
+                out_slicing,
+                sum(map(lambda c, s: c*s, in_slicing[0:self.stack_ndim], stack_spans)),
+                in_slicing[self.stack_ndim:]
+            )
+            for out_slicing, in_slicing in generate_io_slices(stack_plan, page_plan)
         ]
 
-        for d in transposition:
-            assert current_plan[d] is not None, "transpose cannot repeat same dimension"
-            p = current_plan[d]
-            current_plan[d] = None
-            output_plan.append(p)
-
-        assert len([p for p in current_plan if p is not None]) == 0, "transpose must include dimensions"
-        return TiffLazyNDArray(self, output_plan)
+        # perform actual pixel I/O
+        workers = default_io_workers()
+        if workers > 1 and len(io_slices) > 1 and self.filename is not None and not self.is_memmappable:
+            # decode concurrently, each thread filling its own region of buffer
+            def read_page(io):
+                out_slicing, page, page_slice = io
+                buffer[out_slicing] = self._page_data(page, page_slice, private_handle=True)
+            io_pool(workers).map(read_page, io_slices, chunksize=1)
+        else:
+            for out_slicing, page, page_slice in io_slices:
+                buffer[out_slicing] = self._page_data(page, page_slice)
 
-    def lazyget(self, key):
-        output_plan = self._plan_slicing(key)
-        return TiffLazyNDArray(self, output_plan)
+        return self._transpose_buffer(buffer, buffer_axes, output_plan)
 
-    def force(self):
-        return self[tuple(slice(None) for d in self.shape)]
-    
-    @property
-    def ndim(self):
-        return len([p for p in self.output_plan if p[2] is not None])
-    
-    @property
-    def shape(self):
-        return tuple(p[2].stop for p in self.output_plan if p[2] is not None)
-
-    @property
-    def axes(self):
-        return ''.join(p[0] is not None and self.tf_axes[p[0]] or 'Q' for p in self.output_plan if p[2] is not None)
+    @lazyattr
+    def series_memmap(self):
+        """Memory-map of whole series in TIFF axis order, or None.
+
+           Only available when all pages are uncompressed and stored
+           back-to-back in the file, so the series is one contiguous
+           ND-array on disk.
+        """
+        if self.filename is None:
+            return None
+        page_nbytes = reduce(lambda a, b: a*b, self.tf_shape[self.stack_ndim:], 1) * np.dtype(self.source.dtype).itemsize
+        offset = None
+        for i in range(self.npages):
+            contig = self.source.contiguous(i)
+            if not contig or contig[1] != page_nbytes:
+                return None
+            if offset is None:
+                offset = contig[0]
+            elif contig[0] != offset + i * page_nbytes:
+                return None
+        print("TIFF series is contiguous at offset %d, using memory-map" % offset)
+        return np.memmap(
+            self.filename,
+            dtype=np.dtype(self.source.dtype).newbyteorder(self.source.byteorder),
+            mode='r',
+            offset=offset,
+            shape=self.tf_shape
+        )
 
-    @property
-    def strides(self):
-        plan = [(p[0], p[2].stop) for p in self.output_plan if p[2] is not None]
-        plan = [(i,) + plan[i] for i in range(len(plan))]
-        plan.sort(key=lambda p: p[1])
-        strides = []
-        for i in range(len(plan)):
-            strides.append((plan[i][0], reduce(lambda a, b: a*b, [p[2] for p in plan[i+1:]], 1)))
-        strides.sort(key=lambda p: p[0])
-        strides = [p[1] for p in strides]
-        return strides
-        
     @lazyattr
-    def min_max(self):
-        amin = None
-        amax = None
-        tfimg = self.tf.series[0]
-        for tfpage in tfimg.pages:
-            p = tfpage.asarray(memmap=True)
-            pmin = float(p.min())
-            pmax = float(p.max())
-            if amin is not None:
-                amin = min(amin, pmin)
-            else:
-                amin = pmin
-            if amax is not None:
-                amax = max(amax, pmax)
-            else:
-                amax = pmax
-        return (amin, amax)
-                
-    def max(self):
-        return self.min_max[1]
-            
-    def min(self):
-        return self.min_max[0]
+    def is_memmappable(self):
+        """True if pages are read via memory-mapping rather than decoding."""
+        if self.source.pages is not None:
+            return bool(self.source.contiguous(0))
+        return isinstance(self._read_page(0), np.memmap)
 
 def canonicalize(data):
     """Restructure to preferred TCZYX or CZYX form..."""
@@ -425,13 +1160,368 @@ def load_tiff(fname):
         md = None
     return data, md
 
+def load_array_metadata(fname):
+    """Return dictionary of metadata sidecar for array file fname, or empty dictionary.
+
+       The <fname>.volspy-meta.json sidecar may set "axes" (e.g.
+       "ZYXC"), "micron_spacing" as [Z, Y, X], and for raw files also
+       "shape", "dtype" and byte "offset".
+    """
+    try:
+        with open(sidecar_filename(fname, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except IOError:
+        return dict()
+
+def load_array(fname, array, meta):
+    """Return (data, metadata) for array loaded from fname with metadata sidecar meta."""
+    axes = meta.get('axes', {3: 'ZYX', 4: 'ZYXC', 5: 'TZYXC'}.get(array.ndim))
+    data = ArrayLazyNDArray(array, axes)
+    if meta.get('micron_spacing'):
+        data.micron_spacing = tuple(map(float, meta['micron_spacing']))
+    data = canonicalize(data)
+    try:
+        z_microns, y_microns, x_microns = data.micron_spacing
+        md = ImageMetadata(x_microns, y_microns, z_microns, data.axes)
+    except AttributeError as e:
+        print('got error %s fetching metadata during load_array' % e)
+        md = None
+    return data, md
+
+def load_npy(fname):
+    """Load named .npy file as read-only memmap, returning (data, metadata)."""
+    array = np.load(fname, mmap_mode='r')
+    print("NPY %s %s memory-mapped from %s" % (array.shape, array.dtype, fname))
+    return load_array(fname, array, load_array_metadata(fname))
+
+def load_raw(fname):
+    """Load named raw array file as read-only memmap, returning (data, metadata).
+
+       The metadata sidecar must describe the shape and dtype.
+    """
+    meta = load_array_metadata(fname)
+    assert 'shape' in meta and 'dtype' in meta, "raw file %s needs shape and dtype in %s" % (
+        fname, sidecar_filename(fname, 'meta.json')
+    )
+    array = np.memmap(fname, dtype=meta['dtype'], mode='r', offset=meta.get('offset', 0), shape=tuple(meta['shape']))
+    print("RAW %s %s memory-mapped from %s" % (array.shape, array.dtype, fname))
+    return load_array(fname, array, meta)
+
+def load_chunked(fname):
+    from .chunked import load_chunked
+    return load_chunked(fname)
+
+def is_chunked(fname):
+    from .chunked import is_chunked
+    return is_chunked(fname)
+
+def load_stack(fname):
+    from .stack import load_stack
+    return load_stack(fname)
+
+def is_stack(fname):
+    from .stack import is_stack
+    return is_stack(fname)
+
+# registry of (load, extensions, magics, match) consulted in order by load_image
+_loaders = []
+
+def register_loader(load, extensions=(), magics=(), match=None, first=False):
+    """Register image loader for load_image().
+
+       load: function(fname) returning (data, metadata) with data
+         in CZYX form as by canonicalize()
+       extensions: lower-case filename suffixes handled, e.g. ('.npy',)
+       magics: byte strings matching start of files handled
+       match: optional function(fname) returning True if handled,
+         e.g. for directories
+       first: consult before previously registered loaders
+
+       Loaders matching by match function or magic bytes take
+       precedence over loaders matching only by extension.
+    """
+    entry = (load, tuple(extensions), tuple(magics), match)
+    if first:
+        _loaders.insert(0, entry)
+    else:
+        _loaders.append(entry)
+
+register_loader(load_tiff, ('.tif', '.tiff', '.lsm'), (b'II*\0', b'MM\0*', b'II+\0', b'MM\0+'))
+register_loader(load_chunked, match=is_chunked)
+register_loader(load_stack, match=is_stack)
+register_loader(load_npy, ('.npy',), (b'\x93NUMPY',))
+register_loader(load_raw, ('.raw',))
+
 def load_image(fname):
-    """Load named file, returning (data, metadata).
+    """Load named file, chunked volume or plane stack directory, returning (data, metadata).
 
-       Keep temporarily for backward-compatibility...
+       The loader is chosen from the registry by match function or
+       magic bytes, then by filename extension, falling back to the
+       TIFF reader.
     """
+    head = b''
+    if os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            head = f.read(16)
+    for load, extensions, magics, match in _loaders:
+        if match is not None and match(fname):
+            return load(fname)
+        for magic in magics:
+            if head.startswith(magic):
+                return load(fname)
+    for load, extensions, magics, match in _loaders:
+        if fname.lower().endswith(extensions):
+            return load(fname)
     return load_tiff(fname)
 
+def znoise_field(I, ntile, slab_bytes=64*2**20):
+    """Return (C,Y,X) field of ntile percentile values over Z of CZYX data.
+
+       The exact percentile with linear interpolation, as by
+       np.percentile(I, ntile, axis=1), is found from the two order
+       statistics being interpolated, with memory bounded by about
+       slab_bytes:
+
+       -- if the m smallest (or largest) values per voxel column
+          needed to hold both order statistics fit in slab_bytes,
+          Z-slabs are streamed through one buffer of m + slab planes
+          of float32, partitioned in place to keep those values
+
+       -- otherwise, see _znoise_histogram(), histogram passes over
+          bands of rows narrow them down with per-voxel counts
+    """
+    C, D, H, W = I.shape
+    pos = (D - 1) * ntile / 100.
+    k = min(int(np.floor(pos)), D - 1)
+    k1 = min(k + 1, D - 1)
+    frac = pos - k
+
+    m = min(k1 + 1, D - k)
+    if m * C * H * W * 4 > slab_bytes and np.dtype(I.dtype).kind in 'uif':
+        vk, vk1 = _znoise_histogram(I, k, k1, slab_bytes)
+    else:
+        vk, vk1 = _znoise_select(I, k, k1, slab_bytes)
+    return vk + (vk1 - vk) * np.float32(frac)
+
+def _znoise_select(I, k, k1, slab_bytes):
+    """Return float32 (C,Y,X) fields of Z order statistics k and k1 by streaming selection."""
+    C, D, H, W = I.shape
+    low = k1 + 1 <= D - k
+    if low:
+        # keep ranks 0..k1
+        m = k1 + 1
+    else:
+        # keep ranks k..D-1 as smallest negated values
+        m = D - k
+
+    step = max(slab_bytes // (C * H * W * 4), 1)
+    buf = np.empty((C, m + step, H, W), dtype=np.float32)
+    n = 0
+    for z0 in range(0, D, step):
+        z1 = min(z0 + step, D)
+        slab = buf[:, n:n + z1 - z0]
+        slab[...] = I[:, z0:z1, :, :]
+        if not low:
+            np.negative(slab, out=slab)
+        n += z1 - z0
+        if n > m:
+            buf[:, 0:n].partition(m - 1, axis=1)
+            n = m
+
+    keep = buf[:, 0:n]
+    keep.sort(axis=1)
+    if low:
+        return keep[:, k].copy(), keep[:, k1].copy()
+    else:
+        return -keep[:, D - 1 - k], -keep[:, D - 1 - k1]
+
+def _znoise_keys(dtype):
+    """Return (to_keys, from_keys, nbits) mapping values of dtype to uint64 keys of the same order."""
+    nbits = dtype.itemsize * 8
+    sign = np.uint64(1 << (nbits - 1))
+    udtype = np.dtype('u%d' % dtype.itemsize)
+    if dtype.kind == 'u':
+        return (lambda v: v.astype(np.uint64)), (lambda key: key.astype(dtype)), nbits
+    elif dtype.kind == 'i':
+        # offset by flipping sign bit
+        return (
+            lambda v: v.view(udtype).astype(np.uint64) ^ sign,
+            lambda key: (key ^ sign).astype(udtype).view(dtype),
+            nbits
+        )
+    mask = np.uint64((1 << nbits) - 1)
+    def to_keys(v):
+        # flip all bits of negative floats, else just sign bit
+        u = v.view(udtype).astype(np.uint64)
+        return np.where(u & sign, ~u & mask, u | sign)
+    def from_keys(key):
+        return np.where(key & sign, key ^ sign, ~key & mask).astype(udtype).view(dtype)
+    return to_keys, from_keys, nbits
+
+def _znoise_row_align(I):
+    """Return number of rows partial Y reads of CZYX data I decode together, e.g. TIFF strip height."""
+    H = I.shape[2]
+    if isinstance(I, TiffLazyNDArray) and not I.is_memmappable:
+        pages = I.source.pages
+        if pages is None or len(pages[0].shape) != 2:
+            # whole pages decoded for any read
+            return H
+        info = pages[0]
+        return min(info.tile is not None and info.tile[0] or info.rowsperstrip, H)
+    return 1
+
+def _znoise_histogram(I, k, k1, slab_bytes):
+    """Return float32 (C,Y,X) fields of Z order statistics k and k1 of integer or float data.
+
+       Values are mapped to unsigned integer keys of the same order
+       and the order statistics selected one digit of key bits at a
+       time, working through bands of rows.  Each pass over all Z
+       planes of a band counts the next digit of keys sharing the
+       digits already found for rank k, locating rank k and telling
+       whether rank k1 shares its digit.  Where rank k1 moves to a
+       higher digit, it is the smallest key with a higher prefix,
+       found in the next pass or from the last pass's counts.
+
+       Counts for a band take about slab_bytes/2.  Bands are whole
+       multiples of the rows read together, e.g. TIFF strips, so each
+       strip is decoded once per pass.  When that would not fit,
+       digits are narrowed from 8 bits down to 1 bit, trading more
+       passes for smaller counts.
+    """
+    C, D, H, W = I.shape
+    to_keys, from_keys, nbits = _znoise_keys(np.dtype(I.dtype))
+    cdtype = D < 2**16 and np.uint16 or np.uint32
+    cbytes = np.dtype(cdtype).itemsize
+
+    align = _znoise_row_align(I)
+    for digit in [8, 4, 2, 1]:
+        if (1 << digit) * C * align * W * cbytes <= slab_bytes // 2:
+            break
+    nbins = 1 << digit
+    rows = max(slab_bytes // 2 // (nbins * C * W * cbytes) // align, 1) * align
+    rows = min(rows, H)
+    npasses = nbits // digit
+
+    vk = np.empty((C, H, W), dtype=np.float32)
+    vk1 = np.empty((C, H, W), dtype=np.float32)
+
+    def planes(y0, y1):
+        # generate keys of each Z plane of band, flattened
+        P = C * (y1 - y0) * W
+        step = max(slab_bytes // 4 // (P * np.dtype(I.dtype).itemsize), 1)
+        for z0 in range(0, D, step):
+            z1 = min(z0 + step, D)
+            block = np.asarray(I[:, z0:z1, y0:y1, :])
+            for z in range(z1 - z0):
+                yield to_keys(np.ascontiguousarray(block[:, z]).ravel())
+
+    def find_bins(counts, ranks):
+        # return bin holding each rank, and count of values below that bin
+        run = np.zeros(counts.shape[1], dtype=np.int64)
+        found = np.full(counts.shape[1], -1, dtype=np.int64)
+        below = np.zeros(counts.shape[1], dtype=np.int64)
+        for b in range(counts.shape[0]):
+            nxt = run + counts[b]
+            hit = (found < 0) & (nxt > ranks)
+            found[hit] = b
+            below[hit] = run[hit]
+            run = nxt
+        return found, below
+
+    for y0 in range(0, H, rows):
+        y1 = min(y0 + rows, H)
+        P = C * (y1 - y0) * W
+        idx = np.arange(P)
+        counts = np.empty((nbins, P), dtype=cdtype)
+
+        # key prefix found so far and rank within it for rank k
+        prefix = np.zeros(P, dtype=np.uint64)
+        rank = np.full(P, k, dtype=np.int64)
+        rank1 = np.full(P, k1, dtype=np.int64)
+        # rank k1 shares prefix, or else its key is in key1
+        shared = np.ones(P, dtype=bool)
+        pending = np.zeros(P, dtype=bool)
+        key1 = np.zeros(P, dtype=np.uint64)
+
+        for p in range(npasses):
+            shift = np.uint64(nbits - (p + 1) * digit)
+            counts[...] = 0
+            above = None
+            if pending.any():
+                above = np.full(P, np.iinfo(np.uint64).max, dtype=np.uint64)
+            for keys in planes(y0, y1):
+                if p == 0:
+                    counts[keys >> shift, idx] += 1
+                    continue
+                high = keys >> (shift + np.uint64(digit))
+                match = high == prefix
+                counts[(keys[match] >> shift) & np.uint64(nbins - 1), idx[match]] += 1
+                if above is not None:
+                    gt = pending & (high > prefix)
+                    above[gt] = np.minimum(above[gt], keys[gt])
+            if above is not None:
+                key1[pending] = above[pending]
+                pending[...] = False
+
+            bins, below = find_bins(counts, rank)
+            bins1, below1 = find_bins(counts, rank1)
+            moved = shared & (bins1 != bins)
+            if p == npasses - 1:
+                # rank k1 is next key within the last prefix
+                key1[moved] = ((prefix << np.uint64(digit)) | bins1.astype(np.uint64))[moved]
+            else:
+                pending = moved
+            shared &= ~moved
+            rank -= below
+            rank1 -= below
+            prefix = (prefix << np.uint64(digit)) | bins.astype(np.uint64)
+
+        key1[shared] = prefix[shared]
+        band = (slice(None), slice(y0, y1), slice(None))
+        vk[band] = from_keys(prefix).reshape((C, y1 - y0, W))
+        vk1[band] = from_keys(key1).reshape((C, y1 - y0, W))
+
+    return vk, vk1
+
+class ZNoiseTransform (object):
+    """Page transform subtracting a (C,Y,X) noise field and clamping to a zero level.
+
+       Maps pages of a CZYX TiffLazyNDArray view whose Y and X axes
+       are the full TIFF page and whose C axis, if any, is a stack
+       axis.
+    """
+
+    def __init__(self, I, zerofield, zero):
+        self.zerofield = zerofield
+        self.zero = np.float32(zero)
+        c_axis, c_slice, out_slice = I.output_plan[[ p[2] is not None for p in I.output_plan ].index(True)]
+        self.c_axis = c_axis
+        self.c_slice = c_slice
+
+    @staticmethod
+    def supports(I):
+        """Return True if pages of CZYX view I map onto zerofield channels and rows."""
+        if not isinstance(I, TiffLazyNDArray) or len(I.tf_shape) != I.stack_ndim + 2:
+            return False
+        plan = [ p for p in I.output_plan if p[2] is not None ]
+        c_axis, c_slice, out_slice = plan[0]
+        if c_axis is not None and (c_axis >= I.stack_ndim or not isinstance(c_slice, slice)):
+            return False
+        for (tf_axis, in_slice, out_slice), page_axis in zip(plan[2:4], [ I.stack_ndim, I.stack_ndim + 1 ]):
+            if tf_axis != page_axis or in_slice != slice(0, I.tf_shape[page_axis], 1):
+                return False
+        return True
+
+    def __call__(self, view, page, page_slice, data):
+        if self.c_axis is None:
+            c = 0
+        else:
+            c = (np.unravel_index(page, view.stack_shape)[self.c_axis] - self.c_slice.start) // self.c_slice.step
+        out = np.array(data, dtype=np.float32)
+        out -= self.zerofield[c][page_slice]
+        np.maximum(out, self.zero, out)
+        return out
+
 class wrapper (np.ndarray):
     """Subtype to allow extra attributes"""
     pass
@@ -440,7 +1530,7 @@ def load_and_mangle_image(fname):
     """Load and mangle TIFF image file.
 
        Arguments:
-         fname: LSM or OME-TIFF input file name
+         fname: LSM or OME-TIFF input file name or chunked volume directory
 
        Environment parameters:
          ZYX_SLICE: selects ROI within full image
@@ -473,16 +1563,21 @@ def load_and_mangle_image(fname):
     # temporary pre-processing hacks to investigate XY-correlated sensor artifacts...
     try:
         ntile = int(os.getenv('ZNOISE_PERCENTILE'))
-        I = I.force().astype(np.float32)
-        zerofield = np.percentile(I, ntile, axis=1)
+    except:
+        ntile = None
+    if ntile is not None:
+        zerofield = znoise_field(I, ntile)
         print('Image %d percentile value over Z-axis ranges [%f,%f]' % (ntile, zerofield.min(), zerofield.max()))
-        I -= zerofield
-        print('Image offset by %d percentile XY value to new range [%f,%f]' % (ntile, I.min(), I.max()))
         zero = float(os.getenv('ZNOISE_ZERO_LEVEL', 0))
-        I = I * (I >= 0.)
-        print('Image clamped to range [%f,%f]' % (I.min(), I.max()))
-    except:
-        pass
+        if ZNoiseTransform.supports(I):
+            # subtract and clamp as pages are read
+            I = I.with_page_transform(ZNoiseTransform(I, zerofield, zero), np.float32, 'znoise%d_%s' % (ntile, zero))
+            print('Image offset by %d percentile XY value and clamped to %f during reads' % (ntile, zero))
+        else:
+            I = I.force().astype(np.float32)
+            I -= zerofield[:,None,:,:]
+            np.maximum(I, zero, I)
+            print('Image offset by %d percentile XY value and clamped to range [%f,%f]' % (ntile, I.min(), I.max()))
 
     I = I.transpose(1,2,3,0)
 
@@ -527,7 +1622,7 @@ def load_and_mangle_image(fname):
         slc = tuple([
             slice(None),
             slice(None),
-            slice(0,I.shape[2]/16*16),
+            slice(0,I.shape[2]//16*16),
             slice(None)
         ])
         if hasattr(I, 'lazyget'):
@@ -16,6 +16,7 @@ from vispy import app
 from vispy import visuals
 
 from .data import ImageManager
+from .reload import TextureReload
 from .render import maxtexsize, VolumeRenderer, rotate, translate, scale
 from .util import bin_reduce, clamp
 
@@ -63,7 +64,8 @@ class Canvas(app.Canvas):
             title='%s %s' % (os.path.basename(sys.argv[0]).replace('-viewer', ''), os.path.basename(filename)),
             )
 
-        self.vol_cropper = ImageManager(filename, self._reform_image)
+        progressive = os.getenv('VIEW_PROGRESSIVE', 'false').lower() == 'true'
+        self.vol_cropper = ImageManager(filename, self._reform_image, progressive, int(maxtexsize))
         nc = self.vol_cropper.data.shape[3]
         try:
             channel = int(os.getenv('VIEW_CHANNEL'))
@@ -83,7 +85,8 @@ class Canvas(app.Canvas):
         self.vol_texture = self.vol_cropper.get_texture3d()
         self.vol_zoom = 1.0
 
-        W = self.vol_texture.shape[2]
+        # size window for view grid even while showing a preview
+        W = self.vol_cropper.view_shape[2]
         self.size = W, W
         self.prev_size = self.size
         self.perspective = True
@@ -91,15 +94,26 @@ class Canvas(app.Canvas):
             nc = len(self.vol_channels)
         else:
             nc = self.vol_cropper.data.shape[3]
+        self.viewport1 = (0, 0) + self.size
+
+        # ray entry/exit buffer resolution relative to viewport
+        try:
+            self.supersample = float(os.getenv('VIEW_SUPERSAMPLE', 1))
+            assert self.supersample > 0
+        except (ValueError, AssertionError):
+            print('Invalid VIEW_SUPERSAMPLE "%s", using 1.0 instead' % os.getenv('VIEW_SUPERSAMPLE'))
+            self.supersample = 1.0
+
         self.volume_renderer = VolumeRenderer(
             self.vol_cropper,
             self.vol_texture,
             nc,
             _default_view.copy(), # view
-            (int(maxtexsize * 4), int(maxtexsize * 4)), # fbo_size
+            self._fbo_size(), # fbo_size
             frag_glsl_dicts=self._frag_glsl_dicts,
             pick_glsl_index=self._pick_glsl_index,
-            vol_interp=self._vol_interp
+            vol_interp=self._vol_interp,
+            analytic_rays=os.getenv('VIEW_RAYCAST', 'twopass').lower() == 'analytic'
             )
 
         self.toggle_color_mode.__func__._keydocs = {
@@ -132,6 +146,7 @@ class Canvas(app.Canvas):
         self.key_press_handlers = dict(
             [
                 ('P', self.toggle_projection),
+                ('A', self.toggle_analytic_rays),
                 ('B', self.toggle_color_mode),
                 ('C', self.toggle_channel),
                 ('Z', self.adjust_zoom),
@@ -154,11 +169,10 @@ class Canvas(app.Canvas):
             'u_picked': None,
             'u_floorlvl': 'zero point',
             'u_gain': 'gain',
+            'reload': 'texture',
         }
 
         self.hud_value_rewrite = {}
-        
-        self.viewport1 = (0, 0) + self.size
 
         try:
             self.font_scale = float(os.getenv('FONT_SCALE', 1))
@@ -166,6 +180,23 @@ class Canvas(app.Canvas):
             print('Invalid FONT_SCALE "%s", using 1.0 instead')
             self.font_scale = 2.0
             
+        # background texture reload state, see reload_data()
+        self.async_reload = os.getenv('VIEW_ASYNC_RELOAD', 'false').lower() == 'true' or progressive
+        try:
+            upload_chunk_bytes = int(float(os.getenv('VIEW_UPLOAD_CHUNK_MB', 16)) * 2**20)
+        except ValueError:
+            print('Invalid VIEW_UPLOAD_CHUNK_MB "%s", using 16 instead' % os.getenv('VIEW_UPLOAD_CHUNK_MB'))
+            upload_chunk_bytes = 16 * 2**20
+        self._reload = TextureReload(
+            self.vol_cropper.prepare_view,
+            self._new_reload_texture,
+            self._commit_reload,
+            upload_chunk_bytes,
+            # refine progressive preview before other reloads
+            self.vol_cropper.preview_source is not None and self._refine_preview or None
+        )
+        self._reload_timer = None
+
         self.text_hud = visuals.TextVisual('', color="white", font_size=12 * self.font_scale, anchor_x="left", bold=True)
         if not hasattr(self.text_hud, 'transforms'):
             # temporary backwards compatibility
@@ -173,6 +204,7 @@ class Canvas(app.Canvas):
         
         if reset:
             self.reset_ui()
+        self._start_reload()
 
     def help(self, event=None):
         """Show brief help text for UI."""
@@ -207,10 +239,56 @@ Resize viewing window using native window-manager controls.
         
 
     def reload_data(self):
-        self.vol_cropper.set_view(channels=self.vol_channels)
+        if self.async_reload:
+            # latest request wins if several arrive during one reload
+            self._reload.submit(self.vol_channels, self.zoom)
+            self._start_reload()
+            return
+        self.vol_cropper.set_view(channels=self.vol_channels, zoom=self.zoom)
         self.vol_cropper.get_texture3d(self.vol_texture)
         self.update()
 
+    def _start_reload(self):
+        """Prepare texture data for pending reload in a worker thread.
+
+           The current texture keeps rendering meanwhile, see
+           TextureReload for the upload and texture swap.
+        """
+        self._set_reload_status(self._reload.start())
+
+    def _set_reload_status(self, status):
+        if status is not None:
+            self.volume_renderer.uniform_changes['reload'] = status
+        if self._reload.busy() and self._reload_timer is None:
+            # keep frames coming to poll the worker and upload chunks
+            self._reload_timer = app.Timer(interval=0.05, start=True, app=self.app, connect=self._on_reload_timer)
+
+    def _refine_preview(self):
+        return self.vol_cropper.refine_view(self.vol_channels)
+
+    def _new_reload_texture(self, result):
+        reduction, data, channels, payload = result
+        if reduction == self.vol_cropper.level and channels == self.vol_cropper.last_channels:
+            # current texture already shows this view
+            return None
+        return self.vol_cropper.new_texture3d(channels, data)
+
+    def _commit_reload(self, result, texture):
+        reduction, data, channels, payload = result
+        old_texture = self.vol_texture
+        self.vol_cropper.commit_view(reduction, data, channels)
+        self.vol_texture = texture
+        self.volume_renderer.set_vol_texture(texture)
+        old_texture.delete()
+        self.update_view()
+
+    def _on_reload_timer(self, event):
+        self._set_reload_status(self._reload.poll())
+        if not self._reload.busy():
+            self._reload_timer.stop()
+            self._reload_timer = None
+        self.update()
+
     def reorient(self, event):
         """Reorient to view down Z axis; or Y axis with 'Control' modifier; or X axis with 'Alt' modifier."""
         self.xform = _default_view.copy()
@@ -310,6 +388,12 @@ Resize viewing window using native window-manager controls.
             self.volume_renderer.set_vol_projection(ortho(-1, 1, -1, 1, -1000, 1000))
             self.volume_renderer.uniform_changes['projection'] = 'orthographic'
             
+    def toggle_analytic_rays(self, event=None):
+        """Toggle between analytic and two-pass ray entry/exit for volume rendering."""
+        self.volume_renderer.set_analytic_rays(not self.volume_renderer.analytic_rays)
+        self.volume_renderer.uniform_changes['ray entry'] = self.volume_renderer.analytic_rays and 'analytic' or 'two-pass'
+        self.update()
+
     def adjust_zoom(self, event):
         """Increase ('Z') or decrease ('z') rendered zoom-level."""
         if 'Shift' in event.modifiers:
@@ -388,6 +472,14 @@ Resize viewing window using native window-manager controls.
         else:
             print('no handler for key %s' % event.key)
 
+    def _fbo_size(self):
+        """Return ray entry/exit buffer size for viewport1 and VIEW_SUPERSAMPLE."""
+        # ray-cast quad spans twice the viewport, so the viewport
+        # samples the central half of the entry/exit buffers
+        W = int(round(2 * self.viewport1[2] * self.supersample))
+        W = max(1, min(W, int(maxtexsize * 4)))
+        return (W, W)
+
     def on_resize(self, event):
         width, height = event.size
 
@@ -402,6 +494,8 @@ Resize viewing window using native window-manager controls.
         else:
             self.viewport1 = (width - height)/2, 0, height, height # final ray-casts
 
+        self.volume_renderer.set_fbo_size(self._fbo_size())
+
         if hasattr(self.text_hud, 'transforms'):
             self.text_hud.transforms.configure(canvas=self, viewport=(0, 0) + self.size)
         else:
@@ -557,6 +651,7 @@ Resize viewing window using native window-manager controls.
     def update_view(self, on_timer=False):
 
         s = self.vol_cropper.min_pixel_step_size(outtexture=self.vol_texture)
+        self.volume_renderer.set_step_size(s)
 
         prev_view = self.view
         view = _default_view.copy()
@@ -590,12 +685,19 @@ Resize viewing window using native window-manager controls.
     def on_draw(self, event, color_mask=(True, True, True, True), pick=None, on_pick=None):
         if self.fps_count >= 10:
             t1 = datetime.datetime.now()
-            print("%f FPS" % (10.0 / (t1 - self.fps_t0).total_seconds()))
+            print("%f FPS, %d clip rebuilds, %d skipped" % (
+                10.0 / (t1 - self.fps_t0).total_seconds(),
+                self.volume_renderer.clip_rebuilds,
+                self.volume_renderer.clip_rebuilds_skipped
+            ))
             self.fps_t0 = t1
             self.fps_count = 1
         else:
             self.fps_count += 1
 
+        if self._reload.upload is not None:
+            self._set_reload_status(self._reload.upload_chunk())
+
         gloo.set_viewport(* self.viewport1 )
         #print 'draw %d' % self.frame
         self.frame += 1